@@ -0,0 +1,233 @@
+"""
+Per-child activity calendar for Children's Castle application.
+
+Each child has one child_activity_calendars row holding a bitset of the days
+they were active (bit i is set when the child was active on start_date + i
+days), about 46 bytes per year. Streaks and "days active this week/month" are
+computed with integer bit operations on it instead of scanning sessions,
+progress or daily reports, and dashboards, milestones and reports share it.
+
+Days are UTC days, like the session and completion times the calendar is
+backfilled from. A day is marked at most once per child and process: later
+activity on the same day is answered from memory without touching the
+database.
+"""
+
+import threading
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import event, func
+from sqlalchemy.dialects import postgresql, sqlite
+
+from db import db
+from models import ChildActivityCalendar, Session, CompletionEvent
+
+_lock = threading.Lock()
+_marked = {}  # child_id -> last day known to be stored in this process
+
+
+def utc_today():
+    """The current UTC day"""
+    return datetime.utcnow().date()
+
+
+def _insert():
+    """Get the dialect's INSERT construct that supports ON CONFLICT"""
+    if db.session.get_bind().dialect.name == 'postgresql':
+        return postgresql.insert
+    return sqlite.insert
+
+
+def _to_int(days):
+    """Decode a stored bitset"""
+    return int.from_bytes(days or b'', 'little')
+
+
+def _to_bytes(bits):
+    """Encode a bitset for storage"""
+    return bits.to_bytes((bits.bit_length() + 7) // 8, 'little')
+
+
+def streak_ending_at(bits, index):
+    """Length of the run of set bits ending at bit index (0 if that bit is clear)"""
+    if index < 0:
+        return 0
+    window = bits & ((1 << (index + 1)) - 1)
+    gaps = ~window & ((1 << (index + 1)) - 1)
+    # The highest clear bit at or below index ends the run; without one the run reaches bit 0
+    return index - (gaps.bit_length() - 1) if gaps else index + 1
+
+
+def longest_run(bits):
+    """Length of the longest run of set bits"""
+    length = 0
+    while bits:
+        bits &= bits >> 1
+        length += 1
+    return length
+
+
+def count_days(bits, first, last):
+    """Number of set bits from index first to last, inclusive"""
+    first = max(first, 0)
+    if last < first:
+        return 0
+    return ((bits >> first) & ((1 << (last - first + 1)) - 1)).bit_count()
+
+
+def _after_commit(session):
+    """Remember the days marked in a committed transaction"""
+    marked = session.info.pop('activity_marked', None)
+    if marked:
+        with _lock:
+            for child_id, day in marked.items():
+                if _marked.get(child_id) is None or day > _marked[child_id]:
+                    _marked[child_id] = day
+
+
+def _after_rollback(session):
+    """Forget the days marked in a rolled back transaction"""
+    session.info.pop('activity_marked', None)
+
+
+event.listen(db.session, 'after_commit', _after_commit)
+event.listen(db.session, 'after_rollback', _after_rollback)
+
+
+def mark_active(child_id, day=None):
+    """
+    Mark a day (default today, UTC) as active for a child. Nothing is committed.
+
+    Returns:
+        bool: True if the day wasn't marked before
+    """
+    day = day or utc_today()
+    with _lock:
+        if _marked.get(child_id) == day:
+            return False
+
+    # Concurrent first writes for a child must not both insert the row
+    db.session.execute(
+        _insert()(ChildActivityCalendar.__table__).values(
+            child_id=child_id, start_date=day, days=b''
+        ).on_conflict_do_nothing(index_elements=['child_id'])
+    )
+    calendar = ChildActivityCalendar.query.filter_by(
+        child_id=child_id
+    ).with_for_update().populate_existing().one()
+    bits = _to_int(calendar.days)
+    if day < calendar.start_date:
+        # Rebase so the new day is bit 0
+        bits <<= (calendar.start_date - day).days
+        calendar.start_date = day
+
+    index = (day - calendar.start_date).days
+    newly_active = not (bits >> index) & 1
+    if newly_active:
+        calendar.days = _to_bytes(bits | (1 << index))
+
+    db.session.info.setdefault('activity_marked', {})[child_id] = day
+    return newly_active
+
+
+def get_bits(child_id):
+    """
+    Load a child's calendar.
+
+    Returns:
+        tuple: (start_date, bits) or (None, 0) if the child was never active
+    """
+    row = db.session.query(
+        ChildActivityCalendar.start_date, ChildActivityCalendar.days
+    ).filter_by(child_id=child_id).first()
+    if row is None:
+        return None, 0
+    return row[0], _to_int(row[1])
+
+
+def current_streak(child_id, today=None, calendar=None):
+    """
+    Number of consecutive active days ending today, or ending yesterday if the
+    child hasn't been active yet today.
+    """
+    today = today or utc_today()
+    start, bits = calendar or get_bits(child_id)
+    if start is None:
+        return 0
+    index = (today - start).days
+    return streak_ending_at(bits, index) or streak_ending_at(bits, index - 1)
+
+
+def longest_streak(child_id, start_day=None, end_day=None, calendar=None):
+    """Longest run of active days, optionally within a date range"""
+    start, bits = calendar or get_bits(child_id)
+    if start is None:
+        return 0
+    if start_day is not None:
+        first = max((start_day - start).days, 0)
+        bits = (bits >> first) << first
+    if end_day is not None:
+        last = (end_day - start).days
+        bits &= (1 << (last + 1)) - 1 if last >= 0 else 0
+    return longest_run(bits)
+
+
+def days_active(child_id, start_day, end_day, calendar=None):
+    """Number of active days between two dates, inclusive"""
+    start, bits = calendar or get_bits(child_id)
+    if start is None:
+        return 0
+    return count_days(bits, (start_day - start).days, (end_day - start).days)
+
+
+def summary(child_id, today=None):
+    """Current and longest streak and days active this week and month, from one row"""
+    today = today or utc_today()
+    calendar = get_bits(child_id)
+    week_start = today - timedelta(days=today.weekday())
+    return {
+        'current_streak': current_streak(child_id, today, calendar),
+        'longest_streak': longest_streak(child_id, calendar=calendar),
+        'days_active_this_week': days_active(child_id, week_start, today, calendar),
+        'days_active_this_month': days_active(child_id, today.replace(day=1), today, calendar)
+    }
+
+
+def backfill(child_ids=None):
+    """
+    Add the days of past sessions and completions to the calendars.
+
+    Returns:
+        int: Number of calendars written
+    """
+    days_by_child = {}
+
+    sessions = db.session.query(Session.user_id, func.date(Session.start_time)).filter(
+        Session.user_type == 'child', Session.start_time.isnot(None)
+    )
+    completion_day = func.cast(CompletionEvent.completed_at / 86400, db.Integer)
+    completions = db.session.query(CompletionEvent.child_id, completion_day)
+    if child_ids is not None:
+        sessions = sessions.filter(Session.user_id.in_(child_ids))
+        completions = completions.filter(CompletionEvent.child_id.in_(child_ids))
+
+    for child_id, day in sessions.distinct():
+        days_by_child.setdefault(child_id, set()).add(
+            day if isinstance(day, date) else date.fromisoformat(day)
+        )
+    for child_id, epoch_day in completions.distinct():
+        days_by_child.setdefault(child_id, set()).add(date(1970, 1, 1) + timedelta(days=int(epoch_day)))
+
+    for child_id, days in days_by_child.items():
+        # Keep the days already marked, e.g. activity without a session or completion
+        existing_start, existing_bits = get_bits(child_id)
+        start = min(days | {existing_start} if existing_start else days)
+        bits = existing_bits << (existing_start - start).days if existing_start else 0
+        for day in days:
+            bits |= 1 << (day - start).days
+        db.session.merge(ChildActivityCalendar(child_id=child_id, start_date=start, days=_to_bytes(bits)))
+
+    db.session.commit()
+    with _lock:
+        _marked.clear()
+    return len(days_by_child)
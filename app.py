@@ -27,6 +27,9 @@ STORIES_DIR = "static/stories"
 IMAGES_DIR = "static/images/stories"
 AUDIO_DIR = "static/audio"
 
+# Maximum number of updates accepted by /api/track-progress/batch
+MAX_PROGRESS_BATCH_SIZE = 500
+
 # Use our db object 
 from db import db
 
@@ -38,6 +41,19 @@ from models import (
     StoryMood
 )
 from reports import generate_daily_report, generate_weekly_report, get_report_data_for_period, generate_chart_data
+import story_catalog
+import book_catalog
+import story_search
+import story_pagination
+import session_activity
+import unit_of_work
+import favorites
+import report_counters
+import story_bundle
+import story_responses
+
+# Build the story catalog index once at startup
+story_catalog.refresh(force=True)
 
 def detect_device_type(user_agent_string):
     """
@@ -106,8 +122,15 @@ app.config['WTF_CSRF_TIME_LIMIT'] = 3600  # 1 hour
 # Initialize CSRF protection
 csrf = CSRFProtect(app)
 
+# Write session activities buffered during a request when it ends
+session_activity.init_app(app)
+
+# Commit tracking, milestone and reward changes once per request
+unit_of_work.init_app(app)
+
 # Exempt API endpoints from CSRF protection
 csrf.exempt('/api/track-progress')
+csrf.exempt('/api/track-progress/batch')
 csrf.exempt('/api/get-progress')
 csrf.exempt('/api/get-rewards')
 csrf.exempt('/api/child-activity')
@@ -361,6 +384,7 @@ def parent_login():
         new_session.record_activity('login')
         db.session.add(new_session)
         db.session.commit()
+        session_activity.remember_session(new_session)
         
         # Redirect to next page or dashboard
         next_page = request.args.get('next')
@@ -529,17 +553,13 @@ def guest_login():
                 points_value=10,
                 achievement_level='bronze'
             )
-            db.session.add(demo_reward)
+            report_counters.add_reward(demo_reward)
             
             if books:
-                demo_progress = Progress(
-                    child_id=demo_child.id,
-                    content_type='story',
-                    content_id=books[0].id,
-                    progress_value=50,
-                    completed=False
+                tracking.upsert_progress(
+                    demo_child.id, 'story', os.path.splitext(books[0].file_name)[0],
+                    content_title=books[0].title
                 )
-                db.session.add(demo_progress)
                 db.session.commit()
         else:
             # Get the demo child for this parent
@@ -566,6 +586,7 @@ def guest_login():
         new_session.record_activity('guest_login')
         db.session.add(new_session)
         db.session.commit()
+        session_activity.remember_session(new_session)
         
         flash('Welcome to Children\'s Castle! You are signed in as a guest with access to both parent and child features.', 'success')
         return redirect(url_for('guest_dashboard'))
@@ -612,7 +633,9 @@ def child_login():
         )
         new_session.record_activity('login')
         db.session.add(new_session)
+        tracking.record_child_activity(child.id)
         db.session.commit()
+        session_activity.remember_session(new_session)
         
         return redirect(url_for('child_dashboard'))
     
@@ -628,17 +651,14 @@ def logout():
     """Logout the current user"""
     # Update session end time
     if 'user_type' in session:
-        user_session = Session.query.filter_by(
-            user_type=session['user_type'], 
-            user_id=current_user.id,
-            end_time=None
-        ).order_by(Session.start_time.desc()).first()
+        user_session = session_activity.get_active_session()
         
         if user_session:
             user_session.record_activity('logout')
             user_session.close()  # This sets end_time and calculates duration
             db.session.commit()
     
+    session_activity.forget_session()
     logout_user()
     session.pop('user_type', None)
     flash('You have been logged out', 'info')
@@ -674,15 +694,7 @@ def guest_dashboard():
     rewards = Reward.query.filter_by(child_id=demo_child.id).all()
     
     # Record dashboard access in session activity log
-    user_session = Session.query.filter_by(
-        user_type='guest',
-        user_id=guest_parent.id,
-        end_time=None
-    ).order_by(Session.start_time.desc()).first()
-    
-    if user_session:
-        user_session.record_activity('view_guest_dashboard')
-        db.session.commit()
+    session_activity.record_current('view_guest_dashboard')
     
     return render_template('guest_dashboard.html', 
                           parent=guest_parent,
@@ -707,15 +719,7 @@ def parent_dashboard():
     age_groups = AgeGroup.query.order_by(AgeGroup.min_age).all()
     
     # Record dashboard access in session activity log
-    user_session = Session.query.filter_by(
-        user_type='parent',
-        user_id=current_user.id,
-        end_time=None
-    ).order_by(Session.start_time.desc()).first()
-    
-    if user_session:
-        user_session.record_activity('view_dashboard')
-        db.session.commit()
+    session_activity.record_current('view_dashboard')
     
     return render_template('parent_dashboard.html', children=children, age_groups=age_groups)
 
@@ -875,15 +879,7 @@ def child_dashboard():
     rewards = Reward.query.filter_by(child_id=current_user.id).all()
     
     # Record dashboard access in session activity log
-    user_session = Session.query.filter_by(
-        user_type='child',
-        user_id=current_user.id,
-        end_time=None
-    ).order_by(Session.start_time.desc()).first()
-    
-    if user_session:
-        user_session.record_activity('view_dashboard')
-        db.session.commit()
+    session_activity.record_current('view_dashboard')
     
     return render_template('child_dashboard.html', progress=progress, rewards=rewards)
 
@@ -981,13 +977,7 @@ def parent_settings():
             settings.sync_frequency = request.form.get('sync_frequency')
         
         # Record settings update in session activity log
-        user_session = Session.query.filter_by(
-            user_type='parent',
-            user_id=current_user.id,
-            end_time=None
-        ).order_by(Session.start_time.desc()).first()
-        
-        if user_session:
+        if session_activity.get_active_session_id():
             settings_changed = []
             if request.form.get('allow_external_games') == 'on' != settings.allow_external_games:
                 settings_changed.append('allow_external_games')
@@ -996,7 +986,7 @@ def parent_settings():
             if int(request.form.get('content_age_filter', 4)) != settings.content_age_filter:
                 settings_changed.append('content_age_filter')
             
-            user_session.record_activity('update_settings', None, {
+            session_activity.record_current('update_settings', None, {
                 'settings_changed': settings_changed
             })
         
@@ -1212,17 +1202,12 @@ def get_child_approved_books():
     if not child:
         return jsonify({'success': False, 'message': 'Child not found'}), 404
     
-    # Get approved books for this child
-    approved_books = ApprovedBooks.query.filter_by(child_id=child_id).all()
-    approved_book_ids = [ab.book_id for ab in approved_books]
-    
-    # Get all books with their details
-    books = Book.query.all()
+    # Get all books with their age group and approval status in one query
+    books = book_catalog.query_books_for_child(child.id)
     
     # Format the books data
     books_data = []
-    for book in books:
-        age_group = AgeGroup.query.get(book.age_group_id)
+    for book, age_group, is_approved in books:
         books_data.append({
             'id': book.id,
             'title': book.title,
@@ -1237,7 +1222,7 @@ def get_child_approved_books():
             'reading_time_minutes': book.reading_time_minutes,
             'is_interactive': book.is_interactive,
             'has_audio': book.has_audio,
-            'is_approved': book.id in approved_book_ids
+            'is_approved': is_approved
         })
     
     return jsonify({
@@ -1294,6 +1279,7 @@ def approve_books():
                 new_approvals.append(book_id)
     
     db.session.commit()
+    book_catalog.add_approvals(child.id, new_approvals)
     
     return jsonify({
         'success': True,
@@ -1336,6 +1322,7 @@ def unapprove_books():
             db.session.delete(approval)
     
     db.session.commit()
+    book_catalog.remove_approvals(child.id, book_ids)
     
     return jsonify({
         'success': True,
@@ -1344,6 +1331,40 @@ def unapprove_books():
     })
 
 
+@app.route('/api/books/search', methods=['GET'])
+@login_required
+def search_books():
+    """API endpoint to search books and stories with age group, difficulty and theme facets"""
+    if session.get('user_type') != 'parent':
+        return jsonify({'success': False, 'message': 'Unauthorized'}), 403
+    
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'success': False, 'message': 'Search query is required'}), 400
+    
+    try:
+        limit = min(max(int(request.args.get('limit', 20)), 1), 100)
+        offset = max(int(request.args.get('offset', 0)), 0)
+        age_group_id = request.args.get('age_group_id', type=int)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Invalid paging parameters'}), 400
+    
+    try:
+        results = story_search.search(
+            query,
+            age_group_id=age_group_id,
+            difficulty_level=request.args.get('difficulty') or None,
+            theme=request.args.get('theme') or None,
+            limit=limit,
+            offset=offset
+        )
+    except Exception as e:
+        app.logger.error(f"Error searching books: {str(e)}")
+        return jsonify({'success': False, 'message': 'Search is currently unavailable'}), 500
+    
+    return jsonify({'success': True, 'query': query, **results})
+
+
 @app.route('/api/save-story-queue', methods=['POST'])
 @login_required
 @csrf.exempt
@@ -1685,9 +1706,6 @@ def story_mode():
         flash('Access denied. This page is for children only.', 'error')
         return redirect(url_for('index'))
     
-    # Get all age groups
-    age_groups = AgeGroup.query.order_by(AgeGroup.min_age).all()
-    
     # Get child's age and information
     child = Child.query.get(current_user.id)
     child_age = child.age if child else 4  # Default to 4 if not set
@@ -1703,70 +1721,25 @@ def story_mode():
     # Get parent settings for age filter
     parent_settings = None
     if child:
-        parent = Parent.query.get(child.parent_id)
-        if parent:
-            parent_settings = ParentSettings.query.filter_by(parent_id=parent.id).first()
+        parent_settings = ParentSettings.query.filter_by(parent_id=child.parent_id).first()
     
     # Apply content age filter if set in parent settings
     max_age_filter = None
     if parent_settings and parent_settings.content_age_filter:
         max_age_filter = parent_settings.content_age_filter
     
-    # Filter age groups if needed
-    if max_age_filter:
-        age_groups = [group for group in age_groups if group.max_age <= max_age_filter]
-    
-    # Get approved books for this child
-    approved_books_ids = []
+    # Age groups and books come from the catalog, filtered in SQL. Children with
+    # parent-approved books only see those; otherwise the shared shelf for their age filter.
     if child:
-        approved_books = ApprovedBooks.query.filter_by(child_id=child.id).all()
-        approved_books_ids = [ab.book_id for ab in approved_books]
-    
-    # Get all books and filter by approved books
-    all_books = Book.query.all()
-    
-    # If we have approved books, only show those; otherwise show all books that match age filter
-    if approved_books_ids:
-        # Only show parent-approved books
-        books = [book for book in all_books if book.id in approved_books_ids]
+        age_groups, books = book_catalog.get_child_shelf(child.id, max_age=max_age_filter)
     else:
-        # No approved books yet, so just filter by age (fallback behavior)
-        books = all_books
-        if max_age_filter:
-            filtered_book_ids = [book.id for book in books if book.age_group_id in [g.id for g in age_groups]]
-            books = [book for book in books if book.id in filtered_book_ids]
-    
-    # Check for enhanced stories with diverse audio narration (legacy support)
-    enhanced_stories = []
-    if os.path.exists(STORIES_DIR):
-        for file in os.listdir(STORIES_DIR):
-            if file.endswith('.json'):
-                story_id = os.path.splitext(file)[0]
-                try:
-                    with open(os.path.join(STORIES_DIR, file), 'r') as f:
-                        story_data = json.load(f)
-                    
-                    has_audio = all('audio' in page and page['audio'] 
-                                   for page in story_data.get('pages', []))
-                    
-                    enhanced_stories.append({
-                        'id': story_id,
-                        'title': story_data.get('title', f"Story {story_id}"),
-                        'has_audio': has_audio
-                    })
-                except Exception as e:
-                    app.logger.warning(f"Error reading story file {file}: {str(e)}")
+        age_groups, books = book_catalog.get_shelf(max_age=max_age_filter)
     
-    # Record story mode access in session activity log
-    user_session = Session.query.filter_by(
-        user_type='child',
-        user_id=current_user.id,
-        end_time=None
-    ).order_by(Session.start_time.desc()).first()
+    # Enhanced stories with diverse audio narration (legacy support), served from the catalog index
+    enhanced_stories = story_catalog.get_enhanced_stories()
     
-    if user_session:
-        user_session.record_activity('view_story_mode')
-        db.session.commit()
+    # Record story mode access in session activity log
+    session_activity.record_current('view_story_mode')
     
     return render_template('story_mode.html', age_groups=age_groups, books=books, 
                           enhanced_stories=enhanced_stories, child_age=child_age,
@@ -1805,16 +1778,7 @@ def game_mode():
         settings.age_filter_max = 15
     
     # Record game mode access in session activity log
-    from models import Session
-    user_session = Session.query.filter_by(
-        user_type=session.get('user_type'),
-        user_id=current_user.id,
-        end_time=None
-    ).order_by(Session.start_time.desc()).first()
-    
-    if user_session:
-        user_session.record_activity('view_game_mode')
-        db.session.commit()
+    session_activity.record_current('view_game_mode')
     
     return render_template('game_mode.html', settings=settings)
 
@@ -1832,19 +1796,27 @@ def rewards():
     child_rewards = Reward.query.filter_by(child_id=current_user.id).all()
     
     # Record rewards page access in session activity log
-    user_session = Session.query.filter_by(
-        user_type=session.get('user_type'),
-        user_id=current_user.id,
-        end_time=None
-    ).order_by(Session.start_time.desc()).first()
-    
-    if user_session:
-        user_session.record_activity('view_rewards')
-        db.session.commit()
+    session_activity.record_current('view_rewards')
     
     return render_template('rewards.html', rewards=child_rewards)
 
 
+def _record_progress_activity(entry):
+    """Record a merged progress update in the current session's activity log"""
+    content_type = entry['content_type']
+    activity_type = f"{content_type}_{'completion' if entry['completions'] else 'progress'}"
+    details = {
+        'content_title': entry['content_title'] or entry['content_id'],
+        'time_spent': entry['time_spent']
+    }
+    if content_type == 'game' and entry['score'] is not None:
+        details['score'] = entry['score']
+    elif content_type == 'story' and entry['pages_read'] > 0:
+        details['pages_read'] = entry['pages_read']
+    
+    session_activity.record_current(activity_type, entry['content_id'], details)
+
+
 @app.route('/api/track-progress', methods=['POST'])
 @login_required
 @csrf.exempt
@@ -1853,149 +1825,21 @@ def track_progress():
     if session.get('user_type') not in ['child', 'guest']:
         return jsonify({'success': False, 'message': 'Unauthorized'}), 403
     
-    data = request.json
-    content_type = data.get('content_type')  # 'story' or 'game'
-    content_id = data.get('content_id')
-    content_title = data.get('content_title', '')
-    completed = data.get('completed', False)
-    time_spent = data.get('time_spent', 0)  # in seconds
-    pages_read = data.get('pages_read', 0)  # for stories
-    score = data.get('score')  # for games
-    difficulty_level = data.get('difficulty_level')  # 'easy', 'medium', 'hard'
-    is_favorite = data.get('is_favorite', False)  # Track if user marked as favorite
-    engagement_rating = data.get('engagement_rating')  # 1-5 rating
-    
-    # Find existing progress or create new
-    from models import Progress
-    progress = Progress.query.filter_by(
-        child_id=current_user.id,
-        content_type=content_type,
-        content_id=content_id
-    ).first()
+    try:
+        data = tracking.clean_progress_delta(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    content_type = data['content_type']  # 'story' or 'game'
+    content_id = data['content_id']
     
-    if progress:
-        # Update basic fields
-        progress.last_accessed = datetime.utcnow()
-        progress.time_spent += time_spent
-        progress.access_count += 1
-        progress.last_session_duration = time_spent
-        
-        # Update engagement rating if provided
-        if engagement_rating is not None:
-            progress.engagement_rating = engagement_rating
-        
-        # Update favorite status if explicitly set
-        if 'is_favorite' in data:
-            progress.is_favorite = is_favorite
-            
-        # Update content-specific metrics
-        if pages_read > progress.pages_read:
-            progress.pages_read = pages_read
-            
-        if score is not None and (progress.score is None or score > progress.score):
-            progress.score = score
-            
-        if difficulty_level and not progress.difficulty_level:
-            progress.difficulty_level = difficulty_level
-            
-        if content_title and not progress.content_title:
-            progress.content_title = content_title
-            
-        # Update streak information
-        progress.update_streak()
-        
-        if completed and not progress.completed:
-            progress.completed = True
-            progress.completion_count += 1
-            progress.add_completion_timestamp()
-            
-            # Add a reward if this is the first completion
-            if progress.completion_count == 1:
-                achievement_level = 'bronze'  # Default level
-                
-                # Determine level based on completion speed, score, etc.
-                if content_type == 'game' and score is not None:
-                    if score > 90:
-                        achievement_level = 'gold'
-                    elif score > 70:
-                        achievement_level = 'silver'
-                
-                if content_type == 'story':
-                    reward = Reward(
-                        child_id=current_user.id,
-                        badge_id=f"story_{content_id}",
-                        badge_name=f"Story Master: {content_title or content_id.title()}",
-                        badge_description=f"Completed the {content_title or content_id.title()} story",
-                        badge_image=f"badges/story_{content_id}.png",
-                        source_type='story',
-                        source_id=content_id,
-                        achievement_level=achievement_level,
-                        points_value=2  # Default points for story completion
-                    )
-                else:  # game
-                    reward = Reward(
-                        child_id=current_user.id,
-                        badge_id=f"game_{content_id}",
-                        badge_name=f"Game Master: {content_title or content_id.title()}",
-                        badge_description=f"Completed the {content_title or content_id.title()} game",
-                        badge_image=f"badges/game_{content_id}.png",
-                        source_type='game',
-                        source_id=content_id,
-                        achievement_level=achievement_level,
-                        points_value=3  # Default points for game completion
-                    )
-                
-                db.session.add(reward)
-        elif completed:
-            progress.completion_count += 1
-            progress.add_completion_timestamp()
-    else:
-        progress = Progress(
-            child_id=current_user.id,
-            content_type=content_type,
-            content_id=content_id,
-            content_title=content_title,
-            completed=completed,
-            completion_count=1 if completed else 0,
-            time_spent=time_spent,
-            pages_read=pages_read,
-            score=score,
-            difficulty_level=difficulty_level,
-            is_favorite=is_favorite,
-            engagement_rating=engagement_rating,
-            access_count=1,
-            last_session_duration=time_spent
-        )
-        
-        # Initialize streak information
-        progress.update_streak()
-        
-        if completed:
-            progress.add_completion_timestamp()
-            
-        db.session.add(progress)
+    # A single update is a batch of one
+    merged = tracking.merge_progress_deltas([data])
+    progress = tracking.apply_progress_deltas(current_user.id, merged)[(content_type, content_id)]
     
     # Record this activity in the current session
-    user_session = Session.query.filter_by(
-        user_type='child',
-        user_id=current_user.id,
-        end_time=None
-    ).order_by(Session.start_time.desc()).first()
-    
-    if user_session:
-        activity_type = f"{content_type}_{'completion' if completed else 'progress'}"
-        details = {
-            'content_title': content_title or content_id,
-            'time_spent': time_spent
-        }
-        if content_type == 'game' and score is not None:
-            details['score'] = score
-        elif content_type == 'story' and pages_read > 0:
-            details['pages_read'] = pages_read
-            
-        user_session.record_activity(activity_type, content_id, details)
+    _record_progress_activity(merged[(content_type, content_id)])
     
-    db.session.commit()
+    unit_of_work.commit()
     
     return jsonify({
         'success': True, 
@@ -2012,6 +1856,64 @@ def track_progress():
     })
 
 
+@app.route('/api/track-progress/batch', methods=['POST'])
+@login_required
+@csrf.exempt
+def track_progress_batch():
+    """
+    API endpoint to track a batch of progress updates.
+    Updates for the same content are merged and everything is written in one transaction.
+    """
+    if session.get('user_type') not in ['child', 'guest']:
+        return jsonify({'success': False, 'message': 'Unauthorized'}), 403
+    
+    data = request.get_json(silent=True) or {}
+    updates = data.get('updates')
+    if not isinstance(updates, list) or not updates:
+        return jsonify({'success': False, 'message': 'A non-empty list of updates is required'}), 400
+    if len(updates) > MAX_PROGRESS_BATCH_SIZE:
+        return jsonify({'success': False, 'message': f'At most {MAX_PROGRESS_BATCH_SIZE} updates per batch'}), 400
+    try:
+        updates = [tracking.clean_progress_delta(update) for update in updates]
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    
+    merged = tracking.merge_progress_deltas(updates)
+    
+    try:
+        results = tracking.apply_progress_deltas(current_user.id, merged)
+        
+        # Record the merged activities in the current session
+        for entry in merged.values():
+            _record_progress_activity(entry)
+        
+        unit_of_work.commit()
+    except Exception as e:
+        unit_of_work.rollback()
+        app.logger.error(f"Error tracking progress batch: {str(e)}")
+        return jsonify({'success': False, 'message': 'Error saving progress'}), 500
+    
+    return jsonify({
+        'success': True,
+        'received': len(updates),
+        'merged': len(merged),
+        'progress': [
+            {
+                'content_type': progress.content_type,
+                'content_id': progress.content_id,
+                'content_title': progress.content_title,
+                'completed': progress.completed,
+                'completion_count': progress.completion_count,
+                'time_spent': progress.time_spent,
+                'pages_read': progress.pages_read,
+                'score': progress.score,
+                'difficulty_level': progress.difficulty_level
+            }
+            for progress in results.values()
+        ]
+    })
+
+
 @app.route('/api/get-progress')
 @login_required
 @csrf.exempt
@@ -2078,6 +1980,53 @@ def get_progress():
     })
 
 
+def _load_story_payload(story_id, book=None):
+    """
+    Load the JSON payload served by /api/story/<story_id>.
+    Returns None if the story can't be found.
+    """
+    if book:
+        content = story_bundle.read_story_text(book.file_name)
+        if content is None:
+            raise FileNotFoundError(book.file_name)
+        
+        return {
+            'success': True,
+            'content': content,
+            'title': book.title,
+            'author': book.author,
+            'description': book.description,
+            'age_group': book.age_group.name,
+            'difficulty_level': book.difficulty_level,
+            'reading_time_minutes': book.reading_time_minutes
+        }
+    
+    # If not found in the database, try the legacy story files
+    content = story_bundle.read_story_text(f"{story_id}.txt")
+    if content is not None:
+        return {
+            'success': True,
+            'content': content,
+            'title': story_id.replace('_', ' ').title()
+        }
+    
+    # Check for enhanced JSON-based story
+    story_data = story_bundle.read_enhanced_story(story_id)
+    if story_data is not None:
+        # For enhanced stories, we combine all page content
+        content, _ = story_bundle.combine_enhanced_pages(story_data)
+        
+        return {
+            'success': True,
+            'content': content,
+            'title': story_data.get('title', story_id.replace('_', ' ').title()),
+            'enhanced': True,
+            'pages': story_data.get('pages', [])
+        }
+    
+    return None
+
+
 @app.route('/api/story/<story_id>')
 @login_required
 def get_story_content(story_id):
@@ -2086,189 +2035,193 @@ def get_story_content(story_id):
         return jsonify({'success': False, 'message': 'Unauthorized'}), 403
     
     # First try to find the book in the database
-    from models import Book, Child
+    from models import Book
     book = Book.query.filter_by(file_name=f"{story_id}.txt").first()
     
-    # Check if child exists in database using direct SQL to prevent ORM autoflush issues
-    child_exists = False
-    if session.get('user_type') == 'child':
-        from sqlalchemy import text
-        try:
-            # Directly check if child record exists
-            sql = text("SELECT COUNT(*) FROM children WHERE id = :child_id")
-            result = db.session.execute(sql, {"child_id": current_user.id}).scalar()
-            child_exists = result > 0
-            if not child_exists:
-                return jsonify({'success': False, 'message': 'Child account not found. Please log in again.'}), 404
-        except Exception as e:
-            app.logger.error(f"Error checking child record: {str(e)}")
-            # Continue anyway to serve content, just don't track progress
+    # Cache story payloads per revision: the book metadata or the story's source files
+    if book:
+        cache_key = ('book', story_id, book.updated_at, story_bundle.story_revision(story_id))
     else:
-        # For guest users, always allow access
-        child_exists = session.get('user_type') == 'guest'
+        cache_key = ('story', story_id, story_bundle.story_revision(story_id))
     
-    if book:
+    cached = story_responses.get(cache_key)
+    if cached is None:
         try:
-            with open(book.file_name, 'r') as f:
-                content = f.read()
-            
-            # Only track progress if we have a valid child record or it's a guest
-            if child_exists and current_user and current_user.id:
-                try:
-                    # Verify child record exists
-                    child = Child.query.get(current_user.id)
-                    if not child:
-                        app.logger.error(f"Child record not found for id {current_user.id}")
-                        return jsonify({'success': True, 'content': content})
-                    # Use no_autoflush to prevent foreign key errors
-                    with db.session.no_autoflush:
-                        # Track this story view
-                        progress = Progress.query.filter_by(
-                            child_id=current_user.id,
-                            content_type='story',
-                            content_id=story_id
-                        ).first()
-                        
-                        if not progress:
-                            progress = Progress(
-                                child_id=current_user.id,
-                                content_type='story',
-                                content_id=story_id,
-                                content_title=book.title,
-                                completed=False,
-                                access_count=1,
-                                last_session_duration=0
-                            )
-                            db.session.add(progress)
-                        else:
-                            progress.last_accessed = datetime.utcnow()
-                            progress.access_count += 1
-                        
-                        progress.update_streak()
-                        db.session.commit()
-                except Exception as e:
-                    # Log the progress tracking error but still return the story content
-                    app.logger.error(f"Error tracking progress: {str(e)}")
-                    db.session.rollback()
-            
-            return jsonify({
-                'success': True,
-                'content': content,
-                'title': book.title,
-                'author': book.author,
-                'description': book.description,
-                'age_group': book.age_group.name,
-                'difficulty_level': book.difficulty_level,
-                'reading_time_minutes': book.reading_time_minutes
-            })
+            payload = _load_story_payload(story_id, book)
         except Exception as e:
-            return jsonify({'success': False, 'message': f'Error reading story: {str(e)}'}), 500
-    
-    # If not found in the database, try the legacy story files
-    try:
-        # Check for .txt file
-        if os.path.exists(f"{story_id}.txt"):
-            with open(f"{story_id}.txt", 'r') as f:
-                content = f.read()
-            
-            # Only track progress if we have a valid child record (or guest)
-            if child_exists and Child.query.get(current_user.id):
-                try:
-                    # Use no_autoflush to prevent foreign key errors
-                    with db.session.no_autoflush:
-                        # Also track this view
-                        progress = Progress.query.filter_by(
-                            child_id=current_user.id,
-                            content_type='story',
-                            content_id=story_id
-                        ).first()
-                        
-                        if not progress:
-                            progress = Progress(
-                                child_id=current_user.id,
-                                content_type='story',
-                                content_id=story_id,
-                                content_title=story_id.replace('_', ' ').title(),
-                                completed=False,
-                                access_count=1,
-                                last_session_duration=0
-                            )
-                            db.session.add(progress)
-                        else:
-                            progress.last_accessed = datetime.utcnow()
-                            progress.access_count += 1
-                        
-                        progress.update_streak()
-                        db.session.commit()
-                except Exception as e:
-                    # Log the error but don't prevent loading the story
-                    app.logger.error(f"Error tracking progress for legacy story: {str(e)}")
-                    db.session.rollback()
-            
-            return jsonify({
-                'success': True,
-                'content': content,
-                'title': story_id.replace('_', ' ').title()
-            })
-        
-        # Check for enhanced JSON-based story
-        if os.path.exists(os.path.join(STORIES_DIR, f"{story_id}.json")):
-            with open(os.path.join(STORIES_DIR, f"{story_id}.json"), 'r') as f:
-                story_data = json.load(f)
-            
-            # For enhanced stories, we combine all page content
-            content = story_data.get('title', '')
-            for i, page in enumerate(story_data.get('pages', [])):
-                content += f"\n\n--- Page {i+1} ---\n\n"
-                content += page.get('text', '')
-            
-            # Only track progress if we have a valid child record (or guest)
-            if child_exists:
-                try:
-                    # Use no_autoflush to prevent foreign key errors
-                    with db.session.no_autoflush:
-                        # Track this view
-                        progress = Progress.query.filter_by(
-                            child_id=current_user.id,
-                            content_type='story',
-                            content_id=story_id
-                        ).first()
-                    
-                    if not progress:
-                        progress = Progress(
-                            child_id=current_user.id,
-                            content_type='story',
-                            content_id=story_id,
-                            content_title=story_data.get('title', story_id.replace('_', ' ').title()),
-                            completed=False,
-                            access_count=1,
-                            last_session_duration=0
-                        )
-                        db.session.add(progress)
-                    else:
-                        progress.last_accessed = datetime.utcnow()
-                        progress.access_count += 1
-                    
-                    progress.update_streak()
-                    db.session.commit()
-                except Exception as e:
-                    # Log the error but don't prevent loading the story
-                    app.logger.error(f"Error tracking progress for enhanced story: {str(e)}")
-                    db.session.rollback()
-            
-            return jsonify({
-                'success': True,
-                'content': content,
-                'title': story_data.get('title', story_id.replace('_', ' ').title()),
-                'enhanced': True,
-                'pages': story_data.get('pages', [])
-            })
+            return jsonify({'success': False, 'message': f'Error loading story: {str(e)}'}), 500
         
         # Story not found
-        return jsonify({'success': False, 'message': 'Story not found'}), 404
+        if payload is None:
+            return jsonify({'success': False, 'message': 'Story not found'}), 404
         
-    except Exception as e:
-        return jsonify({'success': False, 'message': f'Error loading story: {str(e)}'}), 500
+        cached = story_responses.store(cache_key, payload, book.updated_at if book else None)
+    
+    # Record the view; the progress update is written behind the request
+    if session.get('user_type') == 'child':
+        child_id = current_user.id
+    else:
+        child_id = session.get('guest_child_id')
+    
+    if child_id:
+        tracking.queue_story_view(child_id, story_id, cached.title)
+
+    return story_responses.respond(cached)
+
+
+def _story_media_url(story_id, path, media_dir):
+    """
+    Resolve an image or audio path from a story page to a static URL.
+    Paths with a directory are relative to static/, bare file names live in
+    the story's own folder (as written by create_story_pages.py).
+    """
+    if not path:
+        return None
+    if path.startswith('/') or '://' in path:
+        return path
+    if '/' not in path:
+        path = f"{media_dir}/{story_id}/{path}"
+    return url_for('static', filename=path)
+
+
+def _load_story_page_payload(story_id, page_number):
+    """
+    Load the JSON payload served by /api/story/<story_id>/pages/<page_number>.
+    Returns None if the story can't be found, and a payload without a page
+    if page_number is out of range.
+    """
+    result = story_bundle.read_story_page(story_id, page_number - 1)
+    if result is None:
+        return None
+
+    page, page_count, meta = result
+    payload = {
+        'success': page is not None,
+        'story_id': story_id,
+        'title': meta.get('title', story_id.replace('_', ' ').title()),
+        'page_number': page_number,
+        'total_pages': page_count
+    }
+    if page is None:
+        payload['message'] = 'Page not found'
+        return payload
+
+    payload['text'] = page.get('text', '')
+    payload['image'] = _story_media_url(story_id, page.get('image'), 'images/stories')
+    payload['audio'] = _story_media_url(story_id, page.get('audio'), 'audio/stories')
+    if page.get('character'):
+        payload['character'] = page['character']
+
+    # Media of the following page, sent as preload hints so the client can fetch it while this page is read
+    payload['next_page'] = None
+    payload['preload'] = []
+    if page_number < page_count:
+        payload['next_page'] = url_for('get_story_page', story_id=story_id, page_number=page_number + 1)
+        next_result = story_bundle.read_story_page(story_id, page_number)
+        next_page = next_result[0] if next_result else None
+        if next_page:
+            image = _story_media_url(story_id, next_page.get('image'), 'images/stories')
+            audio = _story_media_url(story_id, next_page.get('audio'), 'audio/stories')
+            if image:
+                payload['preload'].append(f"<{image}>; rel=preload; as=image")
+            if audio:
+                payload['preload'].append(f"<{audio}>; rel=preload; as=audio")
+
+    return payload
+
+
+@app.route('/api/story/<story_id>/pages/<int:page_number>')
+@login_required
+def get_story_page(story_id, page_number):
+    """API endpoint to get a single page of a story (page numbers start at 1)"""
+    if session.get('user_type') not in ['child', 'guest']:
+        return jsonify({'success': False, 'message': 'Unauthorized'}), 403
+
+    # Pages never depend on book metadata, so they are cached per story file revision only
+    cache_key = ('page', story_id, page_number, story_bundle.story_revision(story_id))
+    cached = story_responses.get(cache_key)
+    if cached is None:
+        try:
+            payload = _load_story_page_payload(story_id, page_number)
+        except Exception as e:
+            return jsonify({'success': False, 'message': f'Error loading story page: {str(e)}'}), 500
+
+        if payload is None:
+            return jsonify({'success': False, 'message': 'Story not found'}), 404
+        if not payload['success']:
+            return jsonify(payload), 404
+
+        cached = story_responses.store(cache_key, payload, links=payload['preload'])
+
+    # Opening the first page counts as opening the story
+    if page_number == 1:
+        if session.get('user_type') == 'child':
+            child_id = current_user.id
+        else:
+            child_id = session.get('guest_child_id')
+
+        if child_id:
+            tracking.queue_story_view(child_id, story_id, cached.title)
+
+    return story_responses.respond(cached)
+
+
+def _load_story_text(story_id):
+    """
+    Get the full text of a story and its title for re-pagination.
+    Returns None if the story can't be found.
+    """
+    content = story_bundle.read_story_text(f"{story_id}.txt")
+    if content is not None:
+        return content, story_id.replace('_', ' ').title()
+    
+    story_data = story_bundle.read_enhanced_story(story_id)
+    if story_data is not None:
+        content = '\n\n'.join(page.get('text', '') for page in story_data.get('pages', []))
+        return content, story_data.get('title', story_id.replace('_', ' ').title())
+    
+    return None
+
+
+@app.route('/api/story/<story_id>/paginate')
+@login_required
+def paginate_story(story_id):
+    """API endpoint to lay out a story's text into pages sized for the current reader"""
+    if session.get('user_type') not in ['child', 'guest']:
+        return jsonify({'success': False, 'message': 'Unauthorized'}), 403
+    
+    # Use the requested age, otherwise the child's own age
+    age = request.args.get('age', type=int)
+    if age is None and session.get('user_type') == 'child':
+        age = getattr(current_user, 'age', None)
+    seconds = request.args.get('seconds', type=int)
+    if seconds is not None and not 5 <= seconds <= 600:
+        return jsonify({'success': False, 'message': 'seconds must be between 5 and 600'}), 400
+    
+    # Readers with the same reading profile get the same layout, so cache per profile
+    words_per_minute, page_seconds = story_pagination.reading_profile(age)
+    cache_key = ('paginated', story_id, story_bundle.story_revision(story_id), words_per_minute, seconds or page_seconds)
+    
+    cached = story_responses.get(cache_key)
+    if cached is None:
+        story = _load_story_text(story_id)
+        if story is None:
+            return jsonify({'success': False, 'message': 'Story not found'}), 404
+        
+        content, title = story
+        pages = story_pagination.paginate(content, age=age, target_seconds=seconds)
+        cached = story_responses.store(cache_key, {
+            'success': True,
+            'story_id': story_id,
+            'title': title,
+            'words_per_minute': words_per_minute,
+            'seconds_per_page': seconds or page_seconds,
+            'reading_time_minutes': story_pagination.estimate_reading_time_minutes(content, age),
+            'total_pages': len(pages),
+            'pages': pages
+        })
+    
+    return story_responses.respond(cached)
 
 
 @app.route('/api/get-rewards')
@@ -2384,6 +2337,16 @@ def session_stats():
         'by_child': {}
     }
     
+    # Load the activity logs of every child's recent sessions in one query
+    recent_sessions = {}
+    for s in sorted(child_sessions, key=lambda x: x.start_time, reverse=True):
+        recent_sessions.setdefault(s.user_id, [])
+        if len(recent_sessions[s.user_id]) < 10:
+            recent_sessions[s.user_id].append(s)
+    recent_activities = session_activity.get_activities(
+        s.id for sessions in recent_sessions.values() for s in sessions
+    )
+    
     # Calculate per-child stats
     for child in children:
         child_data = {
@@ -2395,7 +2358,7 @@ def session_stats():
         child_session_list = [s for s in child_sessions if s.user_id == child.id]
         
         # Include recent sessions
-        for s in sorted(child_session_list, key=lambda x: x.start_time, reverse=True)[:10]:
+        for s in recent_sessions.get(child.id, []):
             session_data = {
                 'start_time': s.start_time.isoformat(),
                 'end_time': s.end_time.isoformat() if s.end_time else None,
@@ -2403,16 +2366,10 @@ def session_stats():
                 'device_type': s.device_type
             }
             
-            # Parse activities
-            if s.activities:
-                import json
-                try:
-                    activities = json.loads(s.activities)
-                    session_data['activities'] = activities
-                except:
-                    session_data['activities'] = []
-            else:
-                session_data['activities'] = []
+            # Sessions from before the activity table keep their legacy JSON log
+            session_data['activities'] = (
+                recent_activities.get(s.id) or session_activity.legacy_activities(s)
+            )
                 
             child_data['sessions'].append(session_data)
             
@@ -2447,9 +2404,10 @@ def track_event():
     if not event_type or not event_name:
         return jsonify({'success': False, 'message': 'Missing required fields'}), 400
     
-    event = tracking.track_custom_event(event_type, event_name, event_data)
+    # Events are written in batches in the background
+    tracking.track_custom_event(event_type, event_name, event_data)
     
-    return jsonify({'success': True, 'event_id': event.id})
+    return jsonify({'success': True, 'queued': True}), 202
 
 @app.route('/api/log-error', methods=['POST'])
 @login_required
@@ -2532,18 +2490,18 @@ def get_favorites():
     content_type = request.args.get('content_type')  # Optional filter for stories or games
     limit = int(request.args.get('limit', 5))
     
-    favorites = tracking.get_favorites(current_user.id, content_type, limit)
+    favorite_items = tracking.get_favorites(current_user.id, content_type, limit)
     
     # Format favorite data
     favorite_data = [{
-        'content_type': item.content_type,
-        'content_id': item.content_id,
-        'content_title': item.content_title,
-        'is_explicit_favorite': item.is_favorite,
-        'completion_count': item.completion_count,
-        'time_spent': item.time_spent,
-        'last_accessed': item.last_accessed.isoformat()
-    } for item in favorites]
+        'content_type': item['content_type'],
+        'content_id': item['content_id'],
+        'content_title': item['content_title'],
+        'is_explicit_favorite': item['is_favorite'],
+        'completion_count': item['completion_count'],
+        'time_spent': item['time_spent'],
+        'last_accessed': item['last_accessed']
+    } for item in favorite_items]
     
     return jsonify({
         'success': True,
@@ -2577,6 +2535,7 @@ def toggle_favorite():
     
     # Toggle favorite status
     progress.is_favorite = not progress.is_favorite
+    favorites.record(current_user.id)
     db.session.commit()
     
     # Track this as an event
@@ -2610,15 +2569,7 @@ def parent_reports_dashboard():
     children = Child.query.filter_by(parent_id=current_user.id).all()
     
     # Record dashboard access in session activity log
-    user_session = Session.query.filter_by(
-        user_type='parent',
-        user_id=current_user.id,
-        end_time=None
-    ).order_by(Session.start_time.desc()).first()
-    
-    if user_session:
-        user_session.record_activity('view_reports_dashboard')
-        db.session.commit()
+    session_activity.record_current('view_reports_dashboard')
     
     return render_template('parent_reports.html', children=children)
 
@@ -2659,15 +2610,7 @@ def child_reports(child_id):
     chart_data = generate_chart_data(report_data)
     
     # Record access in session activity log
-    user_session = Session.query.filter_by(
-        user_type='parent',
-        user_id=current_user.id,
-        end_time=None
-    ).order_by(Session.start_time.desc()).first()
-    
-    if user_session:
-        user_session.record_activity('view_child_report', str(child_id), {'period': period_type})
-        db.session.commit()
+    session_activity.record_current('view_child_report', str(child_id), {'period': period_type})
     
     return render_template(
         'child_reports.html', 
@@ -2839,13 +2782,6 @@ def api_record_emotional_feedback():
         'reaction': reaction
     }
     
-    # Find the current session
-    user_session = Session.query.filter_by(
-        user_type='child',
-        user_id=current_user.id,
-        end_time=None
-    ).order_by(Session.start_time.desc()).first()
-    
     # Create the event
     Event.track_event(
         user_type='child',
@@ -2853,7 +2789,7 @@ def api_record_emotional_feedback():
         event_type='emotional_feedback',
         event_name='emoji_reaction',
         event_data=event_data,
-        session_id=user_session.id if user_session else None
+        session_id=session_activity.get_active_session_id()
     )
     
     return jsonify({
@@ -2894,20 +2830,11 @@ def api_get_child_approved_books():
     else:
         return jsonify({'success': False, 'message': 'Not authorized'}), 403
     
-    # Get all books with approval status for this child
-    all_books = Book.query.all()
+    # Get all books with their age group and approval status for this child in one query
+    all_books = book_catalog.query_books_for_child(child_id)
     
-    # For each book, check if it's approved for this child
     books_with_status = []
-    for book in all_books:
-        approval = ApprovedBooks.query.filter_by(
-            child_id=child_id,
-            book_id=book.id
-        ).first()
-        
-        # Get the age group for the book
-        age_group = AgeGroup.query.get(book.age_group_id)
-        
+    for book, age_group, is_approved in all_books:
         books_with_status.append({
             'id': book.id,
             'title': book.title,
@@ -2920,7 +2847,7 @@ def api_get_child_approved_books():
                 'min_age': age_group.min_age,
                 'max_age': age_group.max_age
             },
-            'is_approved': approval is not None
+            'is_approved': is_approved
         })
     
     return jsonify({
@@ -2955,6 +2882,7 @@ def api_approve_books():
     
     # Approve each book
     approved_count = 0
+    approved_ids = []
     for book_id in book_ids:
         # Check if book exists
         book = Book.query.get(book_id)
@@ -2975,23 +2903,18 @@ def api_approve_books():
                 approved_by=current_user.id
             )
             db.session.add(approval)
+            approved_ids.append(book_id)
             approved_count += 1
     
     if approved_count > 0:
         # Log activity in parent session
-        user_session = Session.query.filter_by(
-            user_type='parent',
-            user_id=current_user.id,
-            end_time=None
-        ).order_by(Session.start_time.desc()).first()
-        
-        if user_session:
-            user_session.record_activity('approve_books', {
-                'child_id': child_id,
-                'book_count': approved_count
-            })
+        session_activity.record_current('approve_books', None, {
+            'child_id': child_id,
+            'book_count': approved_count
+        })
         
         db.session.commit()
+        book_catalog.add_approvals(child.id, approved_ids)
         
         return jsonify({
             'success': True,
@@ -3030,6 +2953,7 @@ def api_unapprove_books():
     
     # Remove approvals
     removed_count = 0
+    removed_ids = []
     for book_id in book_ids:
         # Delete the approval record
         deleted = ApprovedBooks.query.filter_by(
@@ -3038,23 +2962,18 @@ def api_unapprove_books():
         ).delete()
         
         if deleted:
+            removed_ids.append(book_id)
             removed_count += 1
     
     if removed_count > 0:
         # Log activity in parent session
-        user_session = Session.query.filter_by(
-            user_type='parent',
-            user_id=current_user.id,
-            end_time=None
-        ).order_by(Session.start_time.desc()).first()
-        
-        if user_session:
-            user_session.record_activity('unapprove_books', {
-                'child_id': child_id,
-                'book_count': removed_count
-            })
+        session_activity.record_current('unapprove_books', None, {
+            'child_id': child_id,
+            'book_count': removed_count
+        })
         
         db.session.commit()
+        book_catalog.remove_approvals(child.id, removed_ids)
         
         return jsonify({
             'success': True,
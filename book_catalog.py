@@ -0,0 +1,214 @@
+"""
+Book catalog queries for Children's Castle application.
+Builds the story shelf with a single joined SQL query per filter combination
+and keeps the unpersonalized shelves cached per age filter, along with each
+child's set of approved book IDs, so rendering story mode doesn't load and
+filter the whole book table in Python.
+"""
+
+import os
+import time
+import threading
+from collections import namedtuple
+
+from sqlalchemy import or_
+
+from db import db
+from models import AgeGroup, Book, ApprovedBooks
+
+# Number of seconds a cached shelf is served before it is rebuilt.
+# Books are only added by setup scripts, so a short TTL is enough to pick them up.
+CATALOG_TTL = float(os.environ.get('BOOK_CATALOG_TTL', 300))
+
+# Number of seconds a child's cached approved-book set is trusted. Approvals are
+# written through to the cache of the process that handled the change; the TTL
+# bounds how long other worker processes can serve a stale set. This is a
+# parental control, so a revoked book must disappear within seconds everywhere;
+# the cache only absorbs bursts of requests (e.g. a shelf and its page loads).
+APPROVAL_CACHE_TTL = float(os.environ.get('BOOK_APPROVAL_CACHE_TTL', 5))
+
+# Immutable snapshots of the rows the story shelf renders. They carry the same
+# attribute names as the models, so templates can use either.
+AgeGroupSummary = namedtuple('AgeGroupSummary', [
+    'id', 'name', 'min_age', 'max_age', 'description'
+])
+BookSummary = namedtuple('BookSummary', [
+    'id', 'title', 'file_name', 'author', 'description', 'age_group_id',
+    'age_group_name', 'difficulty_level', 'themes', 'is_interactive',
+    'has_illustrations', 'has_audio', 'reading_time_minutes'
+])
+
+_lock = threading.Lock()
+_shelves = {}  # (max_age, themes) -> (built_at, age_groups, books)
+_approvals = {}  # child_id -> (loaded_at, frozenset of approved book ids)
+
+
+def _theme_clause(themes):
+    """Match books whose JSON themes array contains any of the given themes"""
+    return or_(*[Book.themes.like(f'%"{theme}"%') for theme in themes])
+
+
+def query_age_groups(max_age=None):
+    """Get the age groups allowed by a content age filter, youngest first"""
+    query = db.session.query(
+        AgeGroup.id, AgeGroup.name, AgeGroup.min_age, AgeGroup.max_age, AgeGroup.description
+    )
+    if max_age:
+        query = query.filter(AgeGroup.max_age <= max_age)
+
+    return [AgeGroupSummary(*row) for row in query.order_by(AgeGroup.min_age).all()]
+
+
+def query_books(child_id=None, max_age=None, themes=None):
+    """
+    Get the books matching all of the given filters in one query.
+
+    Args:
+        child_id: Only books approved for this child
+        max_age: Only books whose age group's max_age is at most this (content_age_filter)
+        themes: Only books tagged with at least one of these themes
+
+    Returns:
+        list: BookSummary tuples ordered by age group and title
+    """
+    query = db.session.query(
+        Book.id, Book.title, Book.file_name, Book.author, Book.description,
+        Book.age_group_id, AgeGroup.name, Book.difficulty_level, Book.themes,
+        Book.is_interactive, Book.has_illustrations, Book.has_audio,
+        Book.reading_time_minutes
+    ).join(AgeGroup, Book.age_group_id == AgeGroup.id)
+
+    if child_id is not None:
+        query = query.join(
+            ApprovedBooks,
+            (ApprovedBooks.book_id == Book.id) & (ApprovedBooks.child_id == child_id)
+        )
+    if max_age:
+        query = query.filter(AgeGroup.max_age <= max_age)
+    if themes:
+        query = query.filter(_theme_clause(themes))
+
+    rows = query.order_by(AgeGroup.min_age, Book.title).all()
+    return [BookSummary(*row) for row in rows]
+
+
+def query_books_for_child(child_id):
+    """
+    Get the whole catalog annotated with each book's approval for a child, in one query.
+
+    Returns:
+        list: (BookSummary, AgeGroupSummary, is_approved) tuples ordered by book ID
+    """
+    approved = db.session.query(ApprovedBooks.book_id).filter(
+        ApprovedBooks.child_id == int(child_id)
+    ).distinct().subquery()
+
+    rows = db.session.query(
+        Book.id, Book.title, Book.file_name, Book.author, Book.description,
+        Book.age_group_id, AgeGroup.name, Book.difficulty_level, Book.themes,
+        Book.is_interactive, Book.has_illustrations, Book.has_audio,
+        Book.reading_time_minutes,
+        AgeGroup.id, AgeGroup.name, AgeGroup.min_age, AgeGroup.max_age, AgeGroup.description,
+        approved.c.book_id
+    ).join(
+        AgeGroup, Book.age_group_id == AgeGroup.id
+    ).outerjoin(
+        approved, approved.c.book_id == Book.id
+    ).order_by(Book.id).all()
+
+    return [
+        (BookSummary(*row[:13]), AgeGroupSummary(*row[13:18]), row[18] is not None)
+        for row in rows
+    ]
+
+
+def get_shelf(max_age=None, themes=None):
+    """
+    Get the age groups and books shown to children without approved books.
+
+    Results are cached per (max_age, themes), so the cost of a cache hit
+    doesn't depend on the number of books.
+
+    Returns:
+        tuple: (age_groups, books)
+    """
+    key = (max_age or None, tuple(sorted(themes)) if themes else None)
+    now = time.monotonic()
+
+    with _lock:
+        cached = _shelves.get(key)
+        if cached and now - cached[0] < CATALOG_TTL:
+            return cached[1], cached[2]
+
+    age_groups = query_age_groups(max_age)
+    books = query_books(max_age=max_age, themes=themes)
+
+    with _lock:
+        _shelves[key] = (now, age_groups, books)
+    return age_groups, books
+
+
+def get_child_shelf(child_id, max_age=None, themes=None):
+    """
+    Get the age groups and books shown to a child.
+
+    If the child has approved books only those are shown, whatever the age
+    filter (a parent's approval overrides it); otherwise the shared shelf for
+    the age filter is used. Both the shelf and the approved set are usually
+    served from memory, so this normally needs no query.
+
+    Returns:
+        tuple: (age_groups, books)
+    """
+    age_groups, books = get_shelf(max_age, themes)
+
+    approved_ids = get_approved_book_ids(child_id)
+    if approved_ids:
+        if max_age:
+            _, books = get_shelf(None, themes)
+        books = [book for book in books if book.id in approved_ids]
+
+    return age_groups, books
+
+
+def get_approved_book_ids(child_id):
+    """Get the IDs of the books approved for a child as a frozenset"""
+    child_id = int(child_id)
+    now = time.monotonic()
+
+    with _lock:
+        cached = _approvals.get(child_id)
+        if cached and now - cached[0] < APPROVAL_CACHE_TTL:
+            return cached[1]
+
+    rows = db.session.query(ApprovedBooks.book_id).filter_by(child_id=child_id).all()
+    approved_ids = frozenset(book_id for (book_id,) in rows)
+
+    with _lock:
+        _approvals[child_id] = (now, approved_ids)
+    return approved_ids
+
+
+def add_approvals(child_id, book_ids):
+    """Write newly committed approvals through to the child's cached set"""
+    child_id = int(child_id)
+    with _lock:
+        cached = _approvals.get(child_id)
+        if cached:
+            _approvals[child_id] = (cached[0], cached[1] | {int(book_id) for book_id in book_ids})
+
+
+def remove_approvals(child_id, book_ids):
+    """Write newly committed approval removals through to the child's cached set"""
+    child_id = int(child_id)
+    with _lock:
+        cached = _approvals.get(child_id)
+        if cached:
+            _approvals[child_id] = (cached[0], cached[1] - {int(book_id) for book_id in book_ids})
+
+
+def invalidate():
+    """Drop all cached shelves and approved sets, e.g. after books or age groups were changed"""
+    with _lock:
+        _shelves.clear()
+        _approvals.clear()
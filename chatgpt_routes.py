@@ -7,6 +7,7 @@ import logging
 from flask import Blueprint, jsonify, request, session, render_template, flash, redirect, url_for
 from flask_login import current_user, login_required
 import chatgpt_helper
+import session_activity
 from app import csrf, db
 
 # Create Blueprint for ChatGPT routes
@@ -22,16 +23,7 @@ def ai_assistant():
         return redirect(url_for('index'))
     
     # Record AI assistant access in session activity log
-    from models import Session
-    user_session = Session.query.filter_by(
-        user_type=session.get('user_type'),
-        user_id=current_user.id,
-        end_time=None
-    ).order_by(Session.start_time.desc()).first()
-    
-    if user_session:
-        user_session.record_activity('view_ai_assistant')
-        db.session.commit()
+    session_activity.record_current('view_ai_assistant')
     
     return render_template('ai_assistant.html')
 
@@ -12,6 +12,7 @@ import logging
 import argparse
 from pathlib import Path
 from generate_natural_voice import stories
+import story_pagination
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, 
@@ -135,35 +136,8 @@ def split_text_into_pages(text, pages=3):
     Returns:
         list: List of text segments for each page
     """
-    # Split by sentences (simple version - a real app would use NLP)
-    sentences = []
-    # Split on periods, question marks, and exclamation points
-    for part in text.replace('!', '.').replace('?', '.').split('.'):
-        if part.strip():
-            sentences.append(part.strip() + '.')
-    
-    # Group sentences into pages
-    if not sentences:
-        return []
-    
-    # Adjust page count if we have fewer sentences
-    page_count = min(pages, len(sentences))
-    sentences_per_page = max(1, len(sentences) // page_count)
-    
-    page_texts = []
-    for i in range(0, len(sentences), sentences_per_page):
-        page_sentences = sentences[i:i + sentences_per_page]
-        page_texts.append(' '.join(page_sentences))
-        
-        # Stop if we've created enough pages
-        if len(page_texts) >= page_count:
-            # Add any remaining sentences to the last page
-            if i + sentences_per_page < len(sentences):
-                remaining = ' '.join(sentences[i + sentences_per_page:])
-                page_texts[-1] = page_texts[-1] + ' ' + remaining
-            break
-    
-    return page_texts
+    # Sentence boundaries are cached by the pagination engine, and pages keep the original punctuation
+    return story_pagination.paginate(text, pages=pages)
 
 def create_story_json(story_id, title, text, pages=3):
     """
@@ -185,6 +159,7 @@ def create_story_json(story_id, title, text, pages=3):
     story_data = {
         "title": title,
         "author": "Children's Castle",
+        "reading_time_minutes": story_pagination.estimate_reading_time_minutes(text),
         "pages": []
     }
     
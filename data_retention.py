@@ -0,0 +1,347 @@
+"""
+Time partitioning and retention for Children's Castle application.
+
+The events and sessions tables grow without bound, and reports and the admin
+dashboard read them by time range.
+
+On PostgreSQL both tables are range-partitioned by month (events by
+occurred_at, sessions by start_time), plus a DEFAULT partition for rows
+outside the created months. Time-range queries only touch the partitions
+they need, and old months are removed by dropping their partition.
+
+SQLite has no partitioning; the same monthly ranges are simulated with the
+(occurred_at) and (start_time) indexes: range queries use the index and old
+months are removed with one range DELETE.
+
+Reports read daily_reports rows, which are kept up to date as activity is
+recorded. Before the retention job removes an expired month of events or
+sessions, it generates the daily reports still missing for that month from
+the raw rows, in the same transaction as the removal, so the job can be
+interrupted and re-run safely. Reports of days older than the retention
+periods are never recomputed (see retained_since).
+
+Run from cron:
+    flask database ensure-partitions      (monthly, creates upcoming months)
+    flask database apply-retention        (daily or weekly)
+"""
+
+import os
+import logging
+from datetime import datetime, date
+
+from sqlalchemy import func, text
+
+from db import db
+from models import Child, DailyReport, Event, Session, SessionActivity, ErrorLog
+
+logger = logging.getLogger(__name__)
+
+# Months of raw events and sessions kept, counting the current month
+EVENT_RETENTION_MONTHS = int(os.environ.get('EVENT_RETENTION_MONTHS', 13))
+SESSION_RETENTION_MONTHS = int(os.environ.get('SESSION_RETENTION_MONTHS', 13))
+
+# Months of partitions created ahead of the current month
+PARTITION_MONTHS_AHEAD = int(os.environ.get('PARTITION_MONTHS_AHEAD', 3))
+
+# Partitioned tables and their partition key
+PARTITIONED_TABLES = {
+    'events': 'occurred_at',
+    'sessions': 'start_time'
+}
+
+_MODELS = {'events': Event, 'sessions': Session}
+
+
+def _dialect():
+    """Get the name of the configured database dialect"""
+    return db.session.get_bind().dialect.name
+
+
+def month_start(value):
+    """Get the first day of a date's month as a datetime"""
+    return datetime(value.year, value.month, 1)
+
+
+def add_months(month, months):
+    """Move a month start by a number of months"""
+    index = month.year * 12 + month.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def retention_cutoff(months, today=None):
+    """Get the start of the oldest month kept when keeping the given number of months"""
+    return add_months(month_start(today or date.today()), -(months - 1))
+
+
+def retained_since(today=None):
+    """Get the first day whose raw events and sessions are both still kept"""
+    return max(
+        retention_cutoff(EVENT_RETENTION_MONTHS, today),
+        retention_cutoff(SESSION_RETENTION_MONTHS, today)
+    ).date()
+
+
+def partition_name(table, month):
+    """Name of a table's partition for a month, e.g. events_2025_01"""
+    return f"{table}_{month:%Y_%m}"
+
+
+def is_partitioned(table):
+    """Check whether a table is a partitioned table (always False outside PostgreSQL)"""
+    if _dialect() != 'postgresql':
+        return False
+    return db.session.execute(text(
+        "SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid "
+        "WHERE c.relname = :table"
+    ), {'table': table}).first() is not None
+
+
+def list_partitions(table):
+    """Get the names of a partitioned table's partitions"""
+    if not is_partitioned(table):
+        return []
+    rows = db.session.execute(text(
+        "SELECT child.relname FROM pg_inherits i "
+        "JOIN pg_class parent ON parent.oid = i.inhparent "
+        "JOIN pg_class child ON child.oid = i.inhrelid "
+        "WHERE parent.relname = :table ORDER BY child.relname"
+    ), {'table': table})
+    return [name for (name,) in rows]
+
+
+def _create_partition(table, month):
+    """Create a month's partition, moving any of its rows out of the DEFAULT partition"""
+    column = PARTITIONED_TABLES[table]
+    name = partition_name(table, month)
+    default = f"{table}_default"
+    bounds = {'start': month, 'end': add_months(month, 1)}
+
+    in_default = db.session.execute(text(
+        f"SELECT 1 FROM {default} WHERE {column} >= :start AND {column} < :end LIMIT 1"
+    ), bounds).first() is not None
+
+    if not in_default:
+        db.session.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} "
+            f"FOR VALUES FROM ('{bounds['start']:%Y-%m-%d}') TO ('{bounds['end']:%Y-%m-%d}')"
+        ))
+        return
+
+    # A new partition can't overlap rows already in the DEFAULT partition
+    db.session.execute(text(f"ALTER TABLE {table} DETACH PARTITION {default}"))
+    db.session.execute(text(
+        f"CREATE TABLE {name} PARTITION OF {table} "
+        f"FOR VALUES FROM ('{bounds['start']:%Y-%m-%d}') TO ('{bounds['end']:%Y-%m-%d}')"
+    ))
+    db.session.execute(text(
+        f"INSERT INTO {table} SELECT * FROM {default} WHERE {column} >= :start AND {column} < :end"
+    ), bounds)
+    db.session.execute(text(
+        f"DELETE FROM {default} WHERE {column} >= :start AND {column} < :end"
+    ), bounds)
+    db.session.execute(text(f"ALTER TABLE {table} ATTACH PARTITION {default} DEFAULT"))
+
+
+def ensure_partitions(months_ahead=PARTITION_MONTHS_AHEAD, today=None):
+    """
+    Create the partitions of the current month and the months ahead.
+
+    Returns:
+        list: Names of the partitions that were created
+    """
+    created = []
+    current = month_start(today or date.today())
+    for table in PARTITIONED_TABLES:
+        if not is_partitioned(table):
+            continue
+        existing = set(list_partitions(table))
+        for offset in range(months_ahead + 1):
+            month = add_months(current, offset)
+            if partition_name(table, month) not in existing:
+                _create_partition(table, month)
+                created.append(partition_name(table, month))
+    db.session.commit()
+    return created
+
+
+def ensure_indexes():
+    """Create the time-range indexes on tables created before they were added to the models"""
+    for model in (Event, Session):
+        for index in model.__table__.indexes:
+            index.create(bind=db.session.connection(), checkfirst=True)
+    db.session.commit()
+
+
+def convert_to_partitioned(table, months_ahead=PARTITION_MONTHS_AHEAD):
+    """
+    Convert a plain PostgreSQL table into a monthly partitioned table.
+
+    The rows are copied into a new partitioned table with a partition for
+    every month that has data, and the old table is dropped, all in one
+    transaction. The primary key becomes (id, partition key), as PostgreSQL
+    requires; foreign keys referencing the table are dropped, and the
+    retention job clears references before it removes old rows instead.
+    """
+    column = PARTITIONED_TABLES[table]
+    legacy = f"{table}_legacy"
+
+    try:
+        sequence = db.session.execute(
+            text("SELECT pg_get_serial_sequence(:table, 'id')"), {'table': table}
+        ).scalar()
+
+        # The partition key becomes part of the primary key, so it can't be NULL
+        db.session.execute(text(
+            f"UPDATE {table} SET {column} = CURRENT_TIMESTAMP WHERE {column} IS NULL"
+        ))
+        first, last = db.session.execute(text(f"SELECT min({column}), max({column}) FROM {table}")).one()
+
+        db.session.execute(text(f"ALTER TABLE {table} RENAME TO {legacy}"))
+        db.session.execute(text(
+            f"CREATE TABLE {table} (LIKE {legacy} INCLUDING DEFAULTS) PARTITION BY RANGE ({column})"
+        ))
+        db.session.execute(text(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT"))
+
+        current = month_start(date.today())
+        month = month_start(first) if first else current
+        last_month = add_months(max(month_start(last) if last else current, current), months_ahead)
+        while month <= last_month:
+            _create_partition(table, month)
+            month = add_months(month, 1)
+
+        db.session.execute(text(f"INSERT INTO {table} SELECT * FROM {legacy}"))
+        if sequence:
+            db.session.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY {table}.id"))
+        db.session.execute(text(f"DROP TABLE {legacy} CASCADE"))
+        db.session.execute(text(f"ALTER TABLE {table} ADD PRIMARY KEY (id, {column})"))
+
+        for index in _MODELS[table].__table__.indexes:
+            index.create(bind=db.session.connection(), checkfirst=True)
+
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def _active_days(model, user_column, time_column, start, end):
+    """Get the (child_id, day) pairs of a table's rows of existing children in a time range"""
+    day = func.date(time_column)
+    rows = db.session.query(user_column, day).join(Child, Child.id == user_column).filter(
+        model.user_type == 'child',
+        time_column >= start,
+        time_column < end
+    ).distinct()
+    return {
+        (child_id, value if isinstance(value, date) else date.fromisoformat(value))
+        for child_id, value in rows
+    }
+
+
+def preserve_daily_reports(start, end):
+    """
+    Generate the missing daily reports of the children active in a time range
+    from its raw events and sessions, before they are removed. Nothing is committed.
+
+    Returns:
+        int: Number of reports generated
+    """
+    import reports
+
+    active = (
+        _active_days(Event, Event.user_id, Event.occurred_at, start, end)
+        | _active_days(Session, Session.user_id, Session.start_time, start, end)
+    )
+    existing = set(db.session.query(DailyReport.child_id, DailyReport.report_date).filter(
+        DailyReport.report_date >= start.date(),
+        DailyReport.report_date < end.date()
+    ))
+    missing = sorted(active - existing)
+    for child_id, day in missing:
+        reports.recompute_daily_report(child_id, day)
+    return len(missing)
+
+
+def _clear_session_references(start, end):
+    """Detach the rows that reference the sessions of a time range"""
+    sessions_in_range = db.select(Session.id).where(Session.start_time >= start, Session.start_time < end)
+    db.session.execute(
+        SessionActivity.__table__.delete().where(SessionActivity.session_id.in_(sessions_in_range))
+    )
+    for model in (Event, ErrorLog):
+        db.session.execute(
+            model.__table__.update().where(model.session_id.in_(sessions_in_range)).values(session_id=None)
+        )
+
+
+def _remove_month(table, month, partitions):
+    """Drop a month's partition, or delete its rows where there is no partition"""
+    column = PARTITIONED_TABLES[table]
+    name = partition_name(table, month)
+    if name in partitions:
+        db.session.execute(text(f"DROP TABLE {name}"))
+        return
+
+    model = _MODELS[table]
+    key = getattr(model, column)
+    db.session.execute(
+        model.__table__.delete().where(key >= month, key < add_months(month, 1))
+    )
+
+
+def _expired_months(table, cutoff):
+    """Get the months of a table older than the cutoff, oldest first"""
+    model = _MODELS[table]
+    oldest = db.session.query(func.min(getattr(model, PARTITIONED_TABLES[table]))).scalar()
+    if oldest is None:
+        return []
+
+    months = []
+    month = month_start(oldest)
+    while month < cutoff:
+        months.append(month)
+        month = add_months(month, 1)
+    return months
+
+
+def apply_retention(event_months=EVENT_RETENTION_MONTHS, session_months=SESSION_RETENTION_MONTHS, today=None):
+    """
+    Remove events and sessions older than the retention periods.
+
+    Each month's missing daily reports are generated and its rows removed in
+    one transaction.
+
+    Returns:
+        dict: Months removed and daily reports generated per table
+    """
+    summary = {
+        'events': {'months': [], 'reports': 0},
+        'sessions': {'months': [], 'reports': 0}
+    }
+
+    event_partitions = set(list_partitions('events'))
+    for month in _expired_months('events', retention_cutoff(event_months, today)):
+        try:
+            summary['events']['reports'] += preserve_daily_reports(month, add_months(month, 1))
+            _remove_month('events', month, event_partitions)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        summary['events']['months'].append(f"{month:%Y-%m}")
+        logger.info(f"Removed events of {month:%Y-%m}")
+
+    session_partitions = set(list_partitions('sessions'))
+    for month in _expired_months('sessions', retention_cutoff(session_months, today)):
+        try:
+            summary['sessions']['reports'] += preserve_daily_reports(month, add_months(month, 1))
+            _clear_session_references(month, add_months(month, 1))
+            _remove_month('sessions', month, session_partitions)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        summary['sessions']['months'].append(f"{month:%Y-%m}")
+        logger.info(f"Removed sessions of {month:%Y-%m}")
+
+    return summary
@@ -127,6 +127,278 @@ def create_milestone_table():
         except Exception as e:
             click.echo(f"Error creating milestones table: {e}")
 
+@database.command()
+def add_progress_unique_index():
+    """Merge duplicate progress rows and add the unique index progress upserts rely on."""
+    from sqlalchemy import inspect, text, func
+
+    key_columns = ['child_id', 'content_type', 'content_id']
+
+    with app.app_context():
+        # Merge duplicates into the oldest row of each (child, content) key
+        duplicates = db.session.query(
+            Progress.child_id, Progress.content_type, Progress.content_id
+        ).group_by(
+            Progress.child_id, Progress.content_type, Progress.content_id
+        ).having(func.count(Progress.id) > 1).all()
+
+        merged_count = 0
+        for child_id, content_type, content_id in duplicates:
+            rows = Progress.query.filter_by(
+                child_id=child_id, content_type=content_type, content_id=content_id
+            ).order_by(Progress.id).all()
+            keeper, extras = rows[0], rows[1:]
+
+            for row in extras:
+                keeper.access_count = (keeper.access_count or 0) + (row.access_count or 0)
+                keeper.time_spent = (keeper.time_spent or 0) + (row.time_spent or 0)
+                keeper.completion_count = (keeper.completion_count or 0) + (row.completion_count or 0)
+                keeper.completed = bool(keeper.completed or row.completed)
+                keeper.pages_read = max(keeper.pages_read or 0, row.pages_read or 0)
+                if row.score is not None and (keeper.score is None or row.score > keeper.score):
+                    keeper.score = row.score
+                if row.last_accessed and (not keeper.last_accessed or row.last_accessed > keeper.last_accessed):
+                    keeper.last_accessed = row.last_accessed
+                keeper.is_favorite = bool(keeper.is_favorite or row.is_favorite)
+                db.session.delete(row)
+                merged_count += 1
+
+        db.session.commit()
+        click.echo(f"Merged {merged_count} duplicate progress row(s) in {len(duplicates)} group(s)")
+
+        # Add the unique index unless the table already has one on the key
+        inspector = inspect(db.engine)
+        existing = [c['column_names'] for c in inspector.get_unique_constraints('progress')]
+        existing += [i['column_names'] for i in inspector.get_indexes('progress') if i.get('unique')]
+        if any(sorted(columns) == sorted(key_columns) for columns in existing):
+            click.echo("Progress unique index already exists")
+            return
+
+        try:
+            db.session.execute(text(
+                "CREATE UNIQUE INDEX IF NOT EXISTS unique_child_content "
+                "ON progress (child_id, content_type, content_id)"
+            ))
+            db.session.commit()
+            click.echo("Progress unique index created successfully!")
+        except Exception as e:
+            db.session.rollback()
+            click.echo(f"Error creating progress unique index: {e}")
+
+@database.command()
+def backfill_completion_events():
+    """Copy legacy progress completion_history JSON into the completion_events table."""
+    import json
+
+    with app.app_context():
+        # Keys that already have events were written by the new code path and are skipped
+        migrated = set(db.session.query(
+            CompletionEvent.child_id, CompletionEvent.content_type, CompletionEvent.content_id
+        ).distinct().all())
+
+        rows = []
+        progress_count = 0
+        for progress in Progress.query.filter(Progress.completion_history.isnot(None)).yield_per(500):
+            if (progress.child_id, progress.content_type, progress.content_id) in migrated:
+                continue
+            try:
+                history = json.loads(progress.completion_history or '[]')
+            except (TypeError, ValueError):
+                click.echo(f"Skipping unreadable completion history of progress {progress.id}")
+                continue
+
+            for timestamp in history:
+                try:
+                    completed_at = datetime.fromisoformat(timestamp)
+                except (TypeError, ValueError):
+                    continue
+                rows.append({
+                    'child_id': progress.child_id,
+                    'content_type': progress.content_type,
+                    'content_id': progress.content_id,
+                    'completed_at': CompletionEvent.epoch(completed_at)
+                })
+            if history:
+                progress_count += 1
+
+        try:
+            if rows:
+                db.session.execute(CompletionEvent.__table__.insert(), rows)
+            db.session.commit()
+            click.echo(f"Backfilled {len(rows)} completion event(s) from {progress_count} progress row(s)!")
+        except Exception as e:
+            db.session.rollback()
+            click.echo(f"Error backfilling completion events: {e}")
+
+@database.command()
+def backfill_activity_calendar():
+    """Build the children's activity calendars from past sessions and completions."""
+    import activity_calendar
+
+    with app.app_context():
+        try:
+            count = activity_calendar.backfill()
+            click.echo(f"Backfilled activity calendars of {count} child(ren)!")
+        except Exception as e:
+            db.session.rollback()
+            click.echo(f"Error backfilling activity calendars: {e}")
+
+@database.command()
+def replay_event_spill():
+    """Write events spilled to disk while the database was unavailable."""
+    import event_pipeline
+
+    with app.app_context():
+        try:
+            count = event_pipeline.replay_spill()
+            click.echo(f"Replayed {count} spilled event(s)!")
+        except Exception as e:
+            click.echo(f"Error replaying spilled events (they were kept): {e}")
+
+@database.command()
+@click.option('--idle-hours', default=None, type=float, help='Hours without activity before an open session is closed.')
+def close_stale_sessions(idle_hours):
+    """Close abandoned sessions at their last activity and count them in the daily reports."""
+    import session_activity
+
+    with app.app_context():
+        try:
+            count = session_activity.close_stale_sessions(
+                idle_hours if idle_hours is not None else session_activity.STALE_SESSION_HOURS
+            )
+            db.session.commit()
+            click.echo(f"Closed {count} stale session(s)!")
+        except Exception as e:
+            db.session.rollback()
+            click.echo(f"Error closing stale sessions: {e}")
+
+@database.command()
+@click.option('--months-ahead', default=None, type=int, help='Months of partitions to create ahead of the current one.')
+def partition_tables(months_ahead):
+    """Convert the events and sessions tables to monthly partitions (PostgreSQL)."""
+    import data_retention
+    
+    with app.app_context():
+        if db.engine.dialect.name != 'postgresql':
+            # SQLite has no partitioning; monthly ranges use the time indexes instead
+            data_retention.ensure_indexes()
+            click.echo("Partitioning needs PostgreSQL; created the time-range indexes instead")
+            return
+        
+        for table in data_retention.PARTITIONED_TABLES:
+            if data_retention.is_partitioned(table):
+                click.echo(f"Table '{table}' is already partitioned")
+                continue
+            try:
+                data_retention.convert_to_partitioned(
+                    table, months_ahead if months_ahead is not None else data_retention.PARTITION_MONTHS_AHEAD
+                )
+                click.echo(f"Table '{table}' converted to monthly partitions!")
+            except Exception as e:
+                click.echo(f"Error partitioning table '{table}': {e}")
+
+@database.command()
+@click.option('--months-ahead', default=None, type=int, help='Months of partitions to create ahead of the current one.')
+def ensure_partitions(months_ahead):
+    """Create the partitions of the current and upcoming months."""
+    import data_retention
+    
+    with app.app_context():
+        try:
+            created = data_retention.ensure_partitions(
+                months_ahead if months_ahead is not None else data_retention.PARTITION_MONTHS_AHEAD
+            )
+            click.echo(f"Created {len(created)} partition(s): {', '.join(created) or 'none needed'}")
+        except Exception as e:
+            click.echo(f"Error creating partitions: {e}")
+
+@database.command()
+@click.option('--event-months', default=None, type=int, help='Months of raw events to keep.')
+@click.option('--session-months', default=None, type=int, help='Months of sessions to keep.')
+def apply_retention(event_months, session_months):
+    """Generate missing daily reports, then remove old events and sessions."""
+    import data_retention
+    
+    with app.app_context():
+        try:
+            summary = data_retention.apply_retention(
+                event_months or data_retention.EVENT_RETENTION_MONTHS,
+                session_months or data_retention.SESSION_RETENTION_MONTHS
+            )
+        except Exception as e:
+            click.echo(f"Error applying retention: {e}")
+            return
+        
+        for table in ('events', 'sessions'):
+            removed = summary[table]
+            click.echo(f"{table.capitalize()}: removed {len(removed['months'])} month(s) "
+                       f"{', '.join(removed['months'])}, generated {removed['reports']} daily report(s)")
+
+@database.command()
+@click.option('--start', 'start_day', default=None, type=click.DateTime(formats=['%Y-%m-%d']), help='First day (default: yesterday).')
+@click.option('--end', 'end_day', default=None, type=click.DateTime(formats=['%Y-%m-%d']), help='Last day (default: the first day).')
+@click.option('--workers', default=None, type=int, help='Worker processes (default: CPU count).')
+@click.option('--chunk-size', default=None, type=int, help='Children per chunk.')
+@click.option('--daily-only', is_flag=True, help='Skip the weekly reports.')
+@click.option('--restart', is_flag=True, help='Ignore the checkpoint of an interrupted run.')
+def generate_reports(start_day, end_day, workers, chunk_size, daily_only, restart):
+    """Generate the daily and weekly reports of every child for a date range."""
+    from datetime import timedelta
+    import report_batch
+
+    start_day = start_day.date() if start_day else datetime.now().date() - timedelta(days=1)
+    end_day = end_day.date() if end_day else start_day
+    if end_day < start_day:
+        click.echo("The end day is before the start day")
+        return
+
+    with app.app_context():
+        click.echo(f"Generating reports from {start_day} to {end_day}...")
+        try:
+            totals = report_batch.run(
+                start_day, end_day,
+                workers=workers,
+                chunk_size=chunk_size or report_batch.DEFAULT_CHUNK_SIZE,
+                weekly=not daily_only,
+                restart=restart,
+                progress=click.echo
+            )
+        except Exception as e:
+            click.echo(f"Error generating reports: {e}")
+            return
+
+        click.echo(f"Generated {totals['reports']} report(s) for {totals['children']} child(ren) "
+                   f"in {totals['chunks']} chunk(s)")
+        for child_id, error in list(totals['errors'].items())[:20]:
+            click.echo(f"- Child {child_id}: {error}")
+        if totals['errors']:
+            click.echo(f"{len(totals['errors'])} child(ren) failed; run the command again to retry them")
+
+@database.command()
+def rebuild_report_rollups():
+    """Recompute the weekly and monthly report rollups from the daily reports."""
+    import report_rollups
+
+    with app.app_context():
+        try:
+            count = report_rollups.rebuild()
+            click.echo(f"Rebuilt {count} report rollup(s)!")
+        except Exception as e:
+            db.session.rollback()
+            click.echo(f"Error rebuilding report rollups: {e}")
+
+@database.command()
+def build_search_index():
+    """Build the full-text story search index."""
+    import story_search
+    
+    with app.app_context():
+        try:
+            count = story_search.build_index()
+            click.echo(f"Indexed {count} books and stories for search!")
+        except Exception as e:
+            click.echo(f"Error building search index: {e}")
+
 @database.command()
 def stats():
     """Show database statistics."""
@@ -0,0 +1,211 @@
+"""
+Event ingestion pipeline for Children's Castle application.
+
+Event.track_event used to insert and commit one row per call, so an
+event-heavy game held a request worker on a commit per click. Events are now
+queued in memory and written by the write-behind thread in batches:
+    - PostgreSQL: COPY ... FROM STDIN
+    - SQLite and others: one executemany INSERT
+
+When the queue is full, producers wait briefly for the writer to catch up.
+Events that still can't be queued, and batches that fail to write (e.g. while
+the database is down), are appended to a JSON-lines spill file, which is
+replayed before the next batch is written. The spill file is shared by all
+worker processes: appends hold an exclusive flock, and replay renames the file
+aside under that lock before reading it.
+
+Configuration (environment variables):
+    EVENT_BATCH_SIZE       events per write (default 1000)
+    EVENT_FLUSH_INTERVAL   seconds between writes (default 1)
+    EVENT_QUEUE_MAX        events held in memory before backpressure (default 50000)
+    EVENT_PUT_TIMEOUT      seconds a producer waits for room (default 0.05)
+    EVENT_SPILL_FILE       spill file path (default instance/event_spill.jsonl)
+"""
+
+import io
+import os
+import csv
+import json
+import uuid
+import fcntl
+import logging
+import threading
+from datetime import datetime
+
+from db import db
+from models import Event, Session
+from write_behind import create_queue
+import report_counters
+
+logger = logging.getLogger(__name__)
+
+EVENT_BATCH_SIZE = int(os.environ.get('EVENT_BATCH_SIZE', 1000))
+EVENT_FLUSH_INTERVAL = float(os.environ.get('EVENT_FLUSH_INTERVAL', 1))
+EVENT_QUEUE_MAX = int(os.environ.get('EVENT_QUEUE_MAX', 50000))
+EVENT_PUT_TIMEOUT = float(os.environ.get('EVENT_PUT_TIMEOUT', 0.05))
+EVENT_SPILL_FILE = os.environ.get(
+    'EVENT_SPILL_FILE',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'event_spill.jsonl')
+)
+
+# Columns written for every event, in COPY order
+COLUMNS = ['user_type', 'user_id', 'event_type', 'event_name', 'event_data', 'occurred_at', 'session_id']
+
+_spill_lock = threading.Lock()
+
+
+def _open_spill_file(mode):
+    """Open the spill file locked against the other worker processes (None if it doesn't exist)"""
+    while True:
+        try:
+            f = open(EVENT_SPILL_FILE, mode, encoding='utf-8')
+        except FileNotFoundError:
+            return None
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            if os.fstat(f.fileno()).st_ino == os.stat(EVENT_SPILL_FILE).st_ino:
+                return f
+        except FileNotFoundError:
+            pass
+        # Another process took the file while we waited for the lock; open the current one
+        f.close()
+
+
+def spill(rows):
+    """Append event rows to the spill file"""
+    directory = os.path.dirname(EVENT_SPILL_FILE)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    with _spill_lock:
+        with _open_spill_file('a') as f:
+            for row in rows:
+                f.write(json.dumps(dict(row, occurred_at=row['occurred_at'].isoformat())) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+    logger.warning(f"Spilled {len(rows)} event(s) to {EVENT_SPILL_FILE}")
+
+
+def _take_spilled():
+    """Remove and return the rows of the spill file"""
+    taken_path = f"{EVENT_SPILL_FILE}.{os.getpid()}.{uuid.uuid4().hex}.taken"
+    with _spill_lock:
+        f = _open_spill_file('r')
+        if f is None:
+            return []
+        with f:
+            # Move the file aside under the lock, so appends of other processes go to a new file
+            os.replace(EVENT_SPILL_FILE, taken_path)
+            lines = f.readlines()
+        os.remove(taken_path)
+
+    rows = []
+    for line in lines:
+        try:
+            row = json.loads(line)
+            row['occurred_at'] = datetime.fromisoformat(row['occurred_at'])
+            rows.append(row)
+        except (TypeError, ValueError, KeyError):
+            logger.error(f"Skipping unreadable spilled event: {line.strip()[:200]}")
+    return rows
+
+
+def _copy_rows(rows):
+    """Write rows with PostgreSQL COPY in the session's transaction"""
+    buffer = io.StringIO()
+    # Strings are quoted and None is written unquoted, which COPY's CSV format reads as NULL
+    writer = csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC)
+    for row in rows:
+        writer.writerow([
+            row['user_type'],
+            row['user_id'],
+            row['event_type'],
+            row['event_name'],
+            json.dumps(row['event_data']) if row['event_data'] is not None else None,
+            row['occurred_at'].isoformat(),
+            row['session_id']
+        ])
+    buffer.seek(0)
+
+    connection = db.session.connection().connection.driver_connection
+    with connection.cursor() as cursor:
+        cursor.copy_expert(
+            f"COPY {Event.__tablename__} ({', '.join(COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+            buffer
+        )
+
+
+def write_events(rows):
+    """Write a batch of event rows, including any spilled earlier, in one transaction"""
+    spilled = _take_spilled()
+    rows = spilled + list(rows)
+    if not rows:
+        return 0
+
+    try:
+        # Events of sessions deleted in the meantime keep no session, like ON DELETE SET NULL
+        session_ids = {row['session_id'] for row in rows if row['session_id'] is not None}
+        if session_ids:
+            existing = {
+                session_id for (session_id,) in
+                db.session.query(Session.id).filter(Session.id.in_(session_ids))
+            }
+            rows = [
+                row if row['session_id'] in existing or row['session_id'] is None else dict(row, session_id=None)
+                for row in rows
+            ]
+
+        # Daily report counters are updated in the same transaction as the events
+        report_counters.record_events(rows)
+
+        if db.session.get_bind().dialect.name == 'postgresql':
+            _copy_rows(rows)
+        else:
+            db.session.execute(Event.__table__.insert(), rows)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        # The replayed rows aren't part of the queue's batch, so put them back here
+        if spilled:
+            spill(spilled)
+        raise
+
+    if spilled:
+        logger.info(f"Replayed {len(spilled)} spilled event(s)")
+    return len(rows)
+
+
+event_queue = create_queue(
+    'events',
+    write_events,
+    flush_interval=EVENT_FLUSH_INTERVAL,
+    batch_size=EVENT_BATCH_SIZE,
+    max_items=EVENT_QUEUE_MAX,
+    put_timeout=EVENT_PUT_TIMEOUT,
+    spill_fn=spill
+)
+
+
+def enqueue(user_type, user_id, event_type, event_name, event_data=None, session_id=None, occurred_at=None, app=None):
+    """
+    Queue an event for the background writer.
+
+    Returns:
+        dict: The queued event row
+    """
+    row = {
+        'user_type': user_type,
+        'user_id': user_id,
+        'event_type': event_type,
+        'event_name': event_name,
+        'event_data': event_data,
+        'occurred_at': occurred_at or datetime.utcnow(),
+        'session_id': session_id
+    }
+    event_queue.put(row, app=app)
+    return row
+
+
+def replay_spill():
+    """Write the spilled events now. Returns the number of events written."""
+    return write_events([])
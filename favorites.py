@@ -0,0 +1,185 @@
+"""
+Precomputed favorites for Children's Castle application.
+
+Each child has one child_favorites row holding the top FAVORITES_PER_TYPE
+progress entries of every content type, best first, so the dashboard reads
+favorites with a single primary-key fetch instead of querying the progress
+table.
+
+Progress writes don't touch the row: when a transaction that changed a
+child's progress commits, the child is put on a write-behind queue, and the
+background writer rebuilds the rows of every child queued since its last
+flush (each child once) from the committed progress rows. Favorites therefore
+lag progress by up to the queue's flush interval, and reading them never
+writes.
+
+Ranking: explicit favorites come first, then content by engagement decayed by
+recency (halved every FAVORITE_HALF_LIFE_DAYS since last access). Decayed
+values are compared by their logarithm, log(engagement) + last access * ln 2 /
+half-life; the "now" term is the same for every entry, so stored ranks never
+need recomputing as time passes.
+"""
+
+import os
+import json
+import math
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql, sqlite
+
+from db import db
+from models import ChildFavorites, Progress
+from write_behind import create_queue
+
+FAVORITES_PER_TYPE = int(os.environ.get('FAVORITES_PER_TYPE', 10))
+FAVORITE_HALF_LIFE_DAYS = float(os.environ.get('FAVORITE_HALF_LIFE_DAYS', 14))
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def engagement(row):
+    """Engagement score of a progress row"""
+    return (
+        1
+        + 3 * (row.completion_count or 0)
+        + (row.access_count or 0)
+        + (row.time_spent or 0) / 300  # One point per five minutes
+        + 2 * (row.engagement_rating or 0)
+    )
+
+
+def rank(row):
+    """Log of the row's engagement decayed to a fixed point in time"""
+    last_accessed = row.last_accessed or _EPOCH
+    days = (last_accessed - _EPOCH).total_seconds() / 86400
+    return math.log(engagement(row)) + days * math.log(2) / FAVORITE_HALF_LIFE_DAYS
+
+
+def to_entry(row):
+    """Stored form of a progress row"""
+    return {
+        'content_type': row.content_type,
+        'content_id': row.content_id,
+        'content_title': row.content_title,
+        'is_favorite': bool(row.is_favorite),
+        'completion_count': row.completion_count or 0,
+        'time_spent': row.time_spent or 0,
+        'last_accessed': row.last_accessed.isoformat() if row.last_accessed else None,
+        'rank': rank(row)
+    }
+
+
+def _sort_key(entry):
+    return (entry['is_favorite'], entry['rank'])
+
+
+def _top(entries):
+    """Best first, keeping FAVORITES_PER_TYPE entries of each content type"""
+    kept = []
+    per_type = {}
+    for entry in sorted(entries, key=_sort_key, reverse=True):
+        count = per_type.get(entry['content_type'], 0)
+        if count < FAVORITES_PER_TYPE:
+            per_type[entry['content_type']] = count + 1
+            kept.append(entry)
+    return kept
+
+
+def _insert():
+    """Get the dialect's INSERT construct that supports ON CONFLICT"""
+    if db.session.get_bind().dialect.name == 'postgresql':
+        return postgresql.insert
+    return sqlite.insert
+
+
+def compute(child_id):
+    """Rank a child's favorites from their progress rows without storing them"""
+    return _top(to_entry(row) for row in Progress.query.filter_by(child_id=child_id))
+
+
+def rebuild(child_ids):
+    """
+    Recompute the favorites of several children with one progress query. Nothing is committed.
+
+    Returns:
+        dict: child_id -> entries
+    """
+    child_ids = set(child_ids)
+    entries = {child_id: [] for child_id in child_ids}
+    for row in Progress.query.filter(Progress.child_id.in_(child_ids)):
+        entries[row.child_id].append(to_entry(row))
+    entries = {child_id: _top(child_entries) for child_id, child_entries in entries.items()}
+
+    if entries:
+        table = ChildFavorites.__table__
+        stmt = _insert()(table).values([
+            {'child_id': child_id, 'entries': json.dumps(child_entries), 'updated_at': datetime.utcnow()}
+            for child_id, child_entries in entries.items()
+        ])
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=['child_id'],
+            set_={'entries': stmt.excluded.entries, 'updated_at': stmt.excluded.updated_at}
+        ))
+    return entries
+
+
+def _flush(child_ids):
+    """Rebuild the favorites of the queued children (runs on the write-behind thread)"""
+    try:
+        rebuild(child_ids)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+favorites_queue = create_queue('favorites', _flush)
+
+
+def record(child_id):
+    """Queue a rebuild of a child's favorites for when the current transaction commits"""
+    db.session.info.setdefault('favorites_changed', set()).add(child_id)
+
+
+def _after_commit(session):
+    """Queue the children whose progress a committed transaction changed"""
+    child_ids = session.info.pop('favorites_changed', None)
+    if child_ids:
+        app = current_app._get_current_object()
+        for child_id in child_ids:
+            favorites_queue.put(child_id, app=app)
+
+
+def _after_rollback(session):
+    session.info.pop('favorites_changed', None)
+
+
+event.listen(db.session, 'after_commit', _after_commit)
+event.listen(db.session, 'after_rollback', _after_rollback)
+
+
+def get(child_id, content_type=None, limit=5):
+    """
+    Get a child's favorites, best first, from their precomputed row. Never writes.
+
+    Lists longer than the stored top list, and children whose row hasn't been
+    built yet, are ranked from the progress table.
+    """
+    if limit > FAVORITES_PER_TYPE:
+        query = Progress.query.filter_by(child_id=child_id)
+        if content_type:
+            query = query.filter_by(content_type=content_type)
+        return sorted((to_entry(row) for row in query), key=_sort_key, reverse=True)[:limit]
+
+    row = db.session.query(ChildFavorites.entries).filter_by(child_id=child_id).first()
+    if row is not None:
+        entries = json.loads(row[0])
+    else:
+        entries = compute(child_id)
+        # Build the row in the background for the next read
+        favorites_queue.put(child_id)
+    if content_type:
+        entries = [e for e in entries if e['content_type'] == content_type]
+    return entries[:limit]
@@ -10,6 +10,7 @@ from flask_login import login_user, logout_user, current_user
 import firebase_admin
 from firebase_admin import auth, credentials
 from models import db, Parent, ParentSettings
+import session_activity
 
 # Initialize Firebase Admin SDK
 cred = None
@@ -165,6 +166,7 @@ def handle_firebase_auth():
         new_session.record_activity('login')
         db.session.add(new_session)
         db.session.commit()
+        session_activity.remember_session(new_session)
         
         return jsonify({
             'success': True, 
@@ -266,6 +268,7 @@ def handle_token():
         new_session.record_activity('login')
         db.session.add(new_session)
         db.session.commit()
+        session_activity.remember_session(new_session)
         
         return jsonify({
             'success': True, 
@@ -0,0 +1,317 @@
+"""
+Milestone engine for Children's Castle application.
+
+Milestones are declared as rules over named per-child counters (child_counters).
+Progress writes increment the counters in the same transaction, and only the
+rules that read a changed counter are evaluated, so recording progress never
+rescans a child's history.
+
+Counters:
+    completed:<content_type>  distinct stories/games/... completed at least once
+    seconds_spent             total time spent on content
+    login_streak              current daily login streak (set, not incremented)
+"""
+
+import logging
+from datetime import datetime
+
+from sqlalchemy import func
+from sqlalchemy.dialects import postgresql, sqlite
+
+from db import db
+from models import ChildCounter, Milestone, Progress, Reward
+import book_catalog
+import report_counters
+
+logger = logging.getLogger(__name__)
+
+# Counter marking that a child's counters were seeded from their Progress rows
+SEEDED_COUNTER = 'seeded'
+
+
+def story_catalog_size():
+    """Number of stories in the catalog (served from the cached shelf), None while it is empty"""
+    _, books = book_catalog.get_shelf()
+    return len(books) or None
+
+
+# Rules: counter value / unit is the milestone's progress; target is a number
+# or a function returning one (evaluated when the milestone is checked, and
+# the rule is skipped while it returns None).
+MILESTONE_RULES = [
+    # Story milestones
+    {
+        'id': 'read_first_story',
+        'type': 'completion',
+        'name': 'First Story',
+        'description': 'Read your first story',
+        'counter': 'completed:story',
+        'target': 1
+    },
+    {
+        'id': 'read_5_stories',
+        'type': 'completion',
+        'name': 'Story Explorer',
+        'description': 'Read 5 different stories',
+        'counter': 'completed:story',
+        'target': 5
+    },
+    {
+        'id': 'read_all_stories',
+        'type': 'completion',
+        'name': 'Story Master',
+        'description': 'Read all available stories',
+        'counter': 'completed:story',
+        'target': story_catalog_size
+    },
+
+    # Game milestones
+    {
+        'id': 'play_first_game',
+        'type': 'completion',
+        'name': 'First Game',
+        'description': 'Complete your first game',
+        'counter': 'completed:game',
+        'target': 1
+    },
+    {
+        'id': 'play_5_games',
+        'type': 'completion',
+        'name': 'Game Explorer',
+        'description': 'Play 5 different games',
+        'counter': 'completed:game',
+        'target': 5
+    },
+
+    # Time spent milestones
+    {
+        'id': 'time_spent_60',
+        'type': 'engagement',
+        'name': 'One Hour Wonder',
+        'description': 'Spend at least 60 minutes learning and having fun',
+        'counter': 'seconds_spent',
+        'unit': 60,
+        'target': 60
+    },
+
+    # Streak milestones
+    {
+        'id': 'daily_login_3',
+        'type': 'streak',
+        'name': '3-Day Streak',
+        'description': 'Log in for 3 days in a row',
+        'counter': 'login_streak',
+        'target': 3
+    },
+    {
+        'id': 'daily_login_7',
+        'type': 'streak',
+        'name': 'Weekly Streak',
+        'description': 'Log in for 7 days in a row',
+        'counter': 'login_streak',
+        'target': 7
+    }
+]
+
+RULES = {rule['id']: rule for rule in MILESTONE_RULES}
+
+# counter name -> rules that read it
+RULES_BY_COUNTER = {}
+for _rule in MILESTONE_RULES:
+    RULES_BY_COUNTER.setdefault(_rule['counter'], []).append(_rule)
+
+
+def _insert():
+    """Get the dialect's INSERT construct that supports ON CONFLICT"""
+    if db.session.get_bind().dialect.name == 'postgresql':
+        return postgresql.insert
+    return sqlite.insert
+
+
+def _target(rule):
+    """Evaluate a rule's target"""
+    target = rule['target']
+    return target() if callable(target) else target
+
+
+def _write_counter(child_id, name, value, increment):
+    """Add to (or set) one counter in a single upsert and return its new value"""
+    table = ChildCounter.__table__
+    stmt = _insert()(table).values(child_id=child_id, name=name, value=value)
+    new_value = table.c.value + stmt.excluded.value if increment else stmt.excluded.value
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['child_id', 'name'],
+        set_={'value': new_value}
+    ).returning(table.c.value)
+    return db.session.execute(stmt).scalar()
+
+
+def increment_counters(child_id, deltas):
+    """
+    Add deltas to a child's counters. Nothing is committed.
+
+    Returns:
+        dict: counter name -> new value, for the counters that changed
+    """
+    return {
+        name: _write_counter(child_id, name, delta, increment=True)
+        for name, delta in deltas.items() if delta
+    }
+
+
+def set_counter(child_id, name, value):
+    """Set a counter to an absolute value. Nothing is committed."""
+    return _write_counter(child_id, name, value, increment=False)
+
+
+def seed_counters(child_id):
+    """
+    Compute a child's counters from their Progress rows with one aggregate query.
+
+    Used once per child created before counters existed; later progress
+    writes keep the counters up to date.
+    """
+    rows = db.session.query(
+        Progress.content_type,
+        func.count(Progress.id).filter(Progress.completed.is_(True)),
+        func.coalesce(func.sum(Progress.time_spent), 0)
+    ).filter(Progress.child_id == child_id).group_by(Progress.content_type).all()
+
+    counters = {'seconds_spent': 0}
+    for content_type, completed_count, seconds in rows:
+        counters[f"completed:{content_type}"] = completed_count
+        counters['seconds_spent'] += int(seconds)
+
+    for name, value in counters.items():
+        set_counter(child_id, name, value)
+    set_counter(child_id, SEEDED_COUNTER, 1)
+    return counters
+
+
+def is_seeded(child_id):
+    """Check whether a child's counters were seeded"""
+    return db.session.query(ChildCounter.id).filter_by(child_id=child_id, name=SEEDED_COUNTER).first() is not None
+
+
+def get_counters(child_id):
+    """Get all of a child's counters, seeding them on first use"""
+    counters = {
+        name: value for name, value in
+        db.session.query(ChildCounter.name, ChildCounter.value).filter_by(child_id=child_id)
+    }
+    if SEEDED_COUNTER not in counters:
+        counters.update(seed_counters(child_id))
+    return counters
+
+
+def award(child_id, milestone):
+    """Add the reward for a completed milestone"""
+    reward = Reward(
+        child_id=child_id,
+        badge_id=f"milestone_{milestone.milestone_id}",
+        badge_name=f"Achievement: {milestone.milestone_name}",
+        badge_description=milestone.milestone_description or f"Completed {milestone.milestone_name}",
+        badge_image=f"badges/milestone_{milestone.milestone_id}.png",
+        source_type='milestone',
+        source_id=milestone.milestone_id,
+        achievement_level='gold',  # Milestones are higher value
+        points_value=5  # Higher points for milestones
+    )
+    report_counters.add_reward(reward)
+
+
+def evaluate(child_id, counters, create_missing=True):
+    """
+    Evaluate the rules that read the given counters.
+
+    Loads only the child's milestones for the affected rules (one query),
+    updates the uncompleted ones and awards newly completed ones. Nothing is committed.
+
+    Returns:
+        tuple: (milestones created, milestones completed)
+    """
+    rules = [rule for name in counters for rule in RULES_BY_COUNTER.get(name, [])]
+    if not rules:
+        return [], []
+
+    milestones = {
+        m.milestone_id: m for m in Milestone.query.filter(
+            Milestone.child_id == child_id,
+            Milestone.milestone_id.in_([rule['id'] for rule in rules])
+        )
+    }
+
+    created = []
+    completed = []
+    for rule in rules:
+        milestone = milestones.get(rule['id'])
+        if milestone is not None and milestone.completed:
+            continue
+        target = _target(rule)
+        if target is None:
+            continue
+
+        if milestone is None:
+            if not create_missing:
+                continue
+            milestone = Milestone(
+                child_id=child_id,
+                milestone_type=rule['type'],
+                milestone_id=rule['id'],
+                milestone_name=rule['name'],
+                milestone_description=rule['description'],
+                progress=0,
+                target_value=target
+            )
+            db.session.add(milestone)
+            created.append(milestone)
+        else:
+            # Dynamic targets (like the catalog size) follow the current value
+            milestone.target_value = target
+
+        milestone.progress = min(counters[rule['counter']] // rule.get('unit', 1), milestone.target_value)
+        if milestone.progress >= milestone.target_value:
+            milestone.completed = True
+            milestone.earned_at = datetime.utcnow()
+            award(child_id, milestone)
+            completed.append(milestone)
+
+    return created, completed
+
+
+def record_progress(child_id, content_type, time_spent=0, first_completion=False):
+    """
+    Update the counters and milestones affected by one progress write.
+
+    Called by tracking.upsert_progress in the same transaction, after the
+    progress row was written. Nothing is committed.
+    """
+    if not is_seeded(child_id):
+        # Children from before the counters start from their Progress rows, which include this write
+        return evaluate(child_id, seed_counters(child_id))[1]
+
+    changed = increment_counters(child_id, {
+        f"completed:{content_type}": 1 if first_completion else 0,
+        'seconds_spent': time_spent or 0
+    })
+    if changed:
+        return evaluate(child_id, changed)[1]
+    return []
+
+
+def record_login_streak(child_id, current_streak):
+    """Store a child's current login streak and update the streak milestones. Nothing is committed."""
+    return evaluate(child_id, {'login_streak': set_counter(child_id, 'login_streak', current_streak)})[1]
+
+
+def sync_milestones(child_id):
+    """
+    Create the milestones a child doesn't have yet, with their current progress.
+
+    Returns:
+        list: The created milestones
+    """
+    counters = get_counters(child_id)
+    counters = {rule['counter']: counters.get(rule['counter'], 0) for rule in MILESTONE_RULES}
+    created, _ = evaluate(child_id, counters)
+    return created
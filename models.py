@@ -1,6 +1,7 @@
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from calendar import timegm
 import secrets
 import os
 from time import time
@@ -193,7 +194,7 @@ class Progress(db.Model):
     last_accessed = db.Column(db.DateTime, default=datetime.utcnow)
     time_spent = db.Column(db.Integer, default=0)  # seconds
     first_accessed = db.Column(db.DateTime, default=datetime.utcnow)  # When first read/played
-    completion_history = db.Column(db.String(1024), default='[]')  # JSON array of completion timestamps
+    completion_history = db.Column(db.String(1024), default='[]')  # Legacy JSON history, superseded by CompletionEvent
     pages_read = db.Column(db.Integer, default=0)  # For stories: number of pages read
     score = db.Column(db.Integer)  # For games: highest score achieved
     difficulty_level = db.Column(db.String(32))  # 'easy', 'medium', 'hard'
@@ -215,17 +216,6 @@ class Progress(db.Model):
         db.UniqueConstraint('child_id', 'content_type', 'content_id', name='unique_child_content'),
     )
     
-    def add_completion_timestamp(self):
-        """Add current timestamp to completion history"""
-        import json
-        try:
-            history = json.loads(self.completion_history)
-        except:
-            history = []
-        
-        history.append(datetime.utcnow().isoformat())
-        self.completion_history = json.dumps(history)
-    
     def update_streak(self):
         """Update the access streak for this content"""
         today = datetime.now().date()
@@ -268,6 +258,35 @@ class Progress(db.Model):
         return f'<Progress {self.content_type}:{self.content_id} for child_id {self.child_id}>'
 
 
+class CompletionEvent(db.Model):
+    """Append-only log of content completions (replaces Progress.completion_history)"""
+    __tablename__ = 'completion_events'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    child_id = db.Column(db.Integer, db.ForeignKey('children.id'), nullable=False)
+    content_type = db.Column(db.String(64), nullable=False)
+    content_id = db.Column(db.String(64), nullable=False)
+    completed_at = db.Column(db.Integer, nullable=False)  # Unix epoch seconds (UTC)
+    
+    __table_args__ = (
+        db.Index('ix_completion_events_child_time', 'child_id', 'completed_at'),
+        db.Index('ix_completion_events_content', 'child_id', 'content_type', 'content_id', 'completed_at'),
+    )
+    
+    @staticmethod
+    def epoch(moment=None):
+        """Convert a naive UTC datetime (default: now) to epoch seconds"""
+        return timegm((moment or datetime.utcnow()).utctimetuple())
+    
+    @property
+    def completed_datetime(self):
+        """Completion time as a naive UTC datetime"""
+        return datetime.fromtimestamp(self.completed_at, timezone.utc).replace(tzinfo=None)
+    
+    def __repr__(self):
+        return f'<CompletionEvent {self.content_type}:{self.content_id} for child_id {self.child_id}>'
+
+
 class Reward(db.Model):
     """Child's rewards model"""
     __tablename__ = 'rewards'
@@ -500,6 +519,29 @@ class WeeklyReport(db.Model):
         return f'<WeeklyReport for child_id {self.child_id} week of {self.week_start}>'
 
 
+class ReportRollup(db.Model):
+    """Weekly or monthly totals of a child's daily reports, kept in step with them"""
+    __tablename__ = 'report_rollups'
+
+    id = db.Column(db.Integer, primary_key=True)
+    child_id = db.Column(db.Integer, db.ForeignKey('children.id', ondelete='CASCADE'), nullable=False)
+    period = db.Column(db.String(8), nullable=False)  # 'week' (starts Monday) or 'month'
+    period_start = db.Column(db.Date, nullable=False)
+    stories_read = db.Column(db.Integer, default=0, nullable=False)
+    games_played = db.Column(db.Integer, default=0, nullable=False)
+    time_spent = db.Column(db.Integer, default=0, nullable=False)  # minutes
+    stars_earned = db.Column(db.Integer, default=0, nullable=False)
+    emotional_feedback = db.Column(db.Text, default='{}')  # JSON object of emoji reaction counts
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint('child_id', 'period', 'period_start', name='unique_child_rollup'),
+    )
+
+    def __repr__(self):
+        return f'<ReportRollup {self.period} of {self.period_start} for child_id {self.child_id}>'
+
+
 class DevicePairing(db.Model):
     """Device pairing model"""
     __tablename__ = 'device_pairings'
@@ -531,39 +573,71 @@ class Session(db.Model):
     ip_address = db.Column(db.String(45))  # Store IP address (IPv4 or IPv6)
     user_agent = db.Column(db.String(255))  # Store browser/device info
     device_type = db.Column(db.String(32))  # 'desktop', 'tablet', 'mobile'
-    activities = db.Column(db.String(1024), default='[]')  # JSON array of activity logs
+    activities = db.Column(db.String(1024), default='[]')  # Legacy JSON activity log, superseded by SessionActivity
     
     # Relationships
     events = db.relationship('Event', backref='session', lazy=True, cascade="all, delete-orphan")
     error_logs = db.relationship('ErrorLog', backref='session', lazy=True, cascade="all, delete-orphan")
+    activity_log = db.relationship('SessionActivity', backref='session', lazy='dynamic', cascade="all, delete-orphan")
+    
+    __table_args__ = (
+        db.Index('ix_sessions_start_time', 'start_time'),
+        db.Index('ix_sessions_user_time', 'user_type', 'user_id', 'start_time'),
+    )
     
     def record_activity(self, activity_type, content_id=None, details=None):
-        """Add activity to the session log"""
-        import json
-        activities = json.loads(self.activities if self.activities else '[]')
-        
-        activity = {
-            'timestamp': datetime.utcnow().isoformat(),
-            'type': activity_type,  # 'login', 'story_view', 'game_play', 'reward_earned', etc.
-            'content_id': content_id,
-            'details': details or {}
-        }
-        
-        activities.append(activity)
-        self.activities = json.dumps(activities)
+        """Add activity to the session log (buffered and written at the end of the request)"""
+        import session_activity
+        session_activity.record(self, activity_type, content_id, details)
     
     def close(self):
-        """Close the session and calculate duration"""
+        """Close the session, calculate duration and write its buffered activities"""
         if not self.end_time:
             self.end_time = datetime.utcnow()
             if self.start_time:
                 delta = self.end_time - self.start_time
                 self.duration = int(delta.total_seconds())
+            
+            # Count the session's minutes in the child's daily report
+            import report_counters
+            report_counters.record_session(self)
+        
+        import session_activity
+        session_activity.flush_session(self)
     
     def __repr__(self):
         return f'<Session {self.id} for {self.user_type} {self.user_id}>'
 
 
+class SessionActivity(db.Model):
+    """One entry of a session's activity log (replaces Session.activities)"""
+    __tablename__ = 'session_activities'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    session_id = db.Column(db.Integer, db.ForeignKey('sessions.id', ondelete='CASCADE'), nullable=False)
+    activity_type = db.Column(db.String(64), nullable=False)  # 'login', 'story_view', 'game_play', 'reward_earned', etc.
+    content_id = db.Column(db.String(64))
+    details = db.Column(db.Text)  # JSON object
+    occurred_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    
+    __table_args__ = (
+        db.Index('ix_session_activities_session_time', 'session_id', 'occurred_at'),
+    )
+    
+    def to_dict(self):
+        """Activity in the format of the legacy JSON log"""
+        import json
+        return {
+            'timestamp': self.occurred_at.isoformat(),
+            'type': self.activity_type,
+            'content_id': self.content_id,
+            'details': json.loads(self.details) if self.details else {}
+        }
+    
+    def __repr__(self):
+        return f'<SessionActivity {self.activity_type} for session {self.session_id}>'
+
+
 class Milestone(db.Model):
     """Milestone/Achievement tracking model"""
     __tablename__ = 'milestones'
@@ -602,6 +676,48 @@ class Milestone(db.Model):
         return f'<Milestone {self.milestone_id} for child_id {self.child_id}>'
 
 
+class ChildCounter(db.Model):
+    """Running per-child total that milestone rules are evaluated against"""
+    __tablename__ = 'child_counters'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    child_id = db.Column(db.Integer, db.ForeignKey('children.id'), nullable=False)
+    name = db.Column(db.String(64), nullable=False)  # e.g. 'completed:story', 'seconds_spent'
+    value = db.Column(db.Integer, nullable=False, default=0)
+    
+    __table_args__ = (
+        db.UniqueConstraint('child_id', 'name', name='unique_child_counter'),
+    )
+    
+    def __repr__(self):
+        return f'<ChildCounter {self.name}={self.value} for child_id {self.child_id}>'
+
+
+class ChildActivityCalendar(db.Model):
+    """Bitset of the days a child was active: bit i is start_date + i days"""
+    __tablename__ = 'child_activity_calendars'
+    
+    child_id = db.Column(db.Integer, db.ForeignKey('children.id'), primary_key=True)
+    start_date = db.Column(db.Date, nullable=False)
+    days = db.Column(db.LargeBinary, nullable=False, default=b'')  # little-endian bitset
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<ChildActivityCalendar for child_id {self.child_id} since {self.start_date}>'
+
+
+class ChildFavorites(db.Model):
+    """Precomputed top favorites of a child, maintained by progress writes"""
+    __tablename__ = 'child_favorites'
+
+    child_id = db.Column(db.Integer, db.ForeignKey('children.id'), primary_key=True)
+    entries = db.Column(db.Text, nullable=False, default='[]')  # JSON list, best first
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<ChildFavorites for child_id {self.child_id}>'
+
+
 class Event(db.Model):
     """Custom event tracking model"""
     __tablename__ = 'events'
@@ -615,10 +731,20 @@ class Event(db.Model):
     occurred_at = db.Column(db.DateTime, default=datetime.utcnow)
     session_id = db.Column(db.Integer, db.ForeignKey('sessions.id', ondelete='SET NULL'))
     
+    __table_args__ = (
+        db.Index('ix_events_occurred_at', 'occurred_at'),
+        db.Index('ix_events_user_time', 'user_type', 'user_id', 'occurred_at'),
+    )
+    
     @classmethod
     def track_event(cls, user_type, user_id, event_type, event_name, event_data=None, session_id=None):
-        """Create and save a new event"""
-        event = cls(
+        """
+        Queue a new event; it is written in the background with other events (see event_pipeline).
+
+        Returns the event, which isn't saved yet and has no id.
+        """
+        import event_pipeline
+        row = event_pipeline.enqueue(
             user_type=user_type,
             user_id=user_id,
             event_type=event_type,
@@ -626,9 +752,7 @@ class Event(db.Model):
             event_data=event_data,
             session_id=session_id
         )
-        db.session.add(event)
-        db.session.commit()
-        return event
+        return cls(**row)
     
     def __repr__(self):
         return f'<Event {self.event_type}:{self.event_name} for {self.user_type} {self.user_id}>'
@@ -882,6 +1006,9 @@ class StoryMood(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     last_used = db.Column(db.DateTime, nullable=True)
     
+    # Relationships
+    child = db.relationship('Child', back_populates='story_moods')
+    
     # Define standard moods
     @staticmethod
     def get_standard_moods():
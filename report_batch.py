@@ -0,0 +1,179 @@
+"""
+Batch report generation for Children's Castle application.
+
+Generates the daily (and weekly) reports of every child for a date range, so
+report pages only read precomputed rows. Child ids are split into chunks that
+a process pool works through; every worker process opens its own database
+engine. Completed chunks are recorded in a checkpoint file, so an interrupted
+run resumes where it stopped.
+"""
+
+import os
+import json
+import time
+import logging
+from datetime import timedelta
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from db import db
+from models import Child
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 500
+DEFAULT_CHECKPOINT_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'instance', 'report_batch_checkpoint.json'
+)
+
+_app_context = None
+
+
+def _init_worker():
+    """Give a worker process its own engine and application context"""
+    global _app_context
+    from app import app
+
+    _app_context = app.app_context()
+    _app_context.push()
+    # Connections inherited from the parent process must not be shared
+    db.engine.dispose(close=False)
+
+
+def _days(start_day, end_day):
+    day = start_day
+    while day <= end_day:
+        yield day
+        day += timedelta(days=1)
+
+
+def _week_starts(start_day, end_day):
+    week_start = start_day - timedelta(days=start_day.weekday())
+    while week_start <= end_day:
+        yield week_start
+        week_start += timedelta(days=7)
+
+
+def generate_chunk(child_ids, start_day, end_day, weekly=True):
+    """
+    Generate the reports of a chunk of children (runs in a worker process).
+
+    Returns:
+        dict: children, reports and errors (child_id -> message) of the chunk
+    """
+    from reports import generate_daily_report, generate_weekly_report
+
+    result = {'children': 0, 'reports': 0, 'errors': {}}
+    for child_id in child_ids:
+        try:
+            for day in _days(start_day, end_day):
+                generate_daily_report(child_id, day)
+                result['reports'] += 1
+            if weekly:
+                for week_start in _week_starts(start_day, end_day):
+                    if generate_weekly_report(child_id, week_start):
+                        result['reports'] += 1
+            result['children'] += 1
+        except Exception as e:
+            db.session.rollback()
+            result['errors'][child_id] = str(e)
+    db.session.remove()
+    return result
+
+
+def _load_checkpoint(path, key):
+    """Get the child id ranges a previous run of the same job completed"""
+    if not path or not os.path.exists(path):
+        return []
+    try:
+        with open(path, encoding='utf-8') as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable report checkpoint {path}: {e}")
+        return []
+    if checkpoint.get('job') != key:
+        logger.info(f"Report checkpoint {path} is for another job, starting over")
+        return []
+    return checkpoint.get('completed', [])
+
+
+def _save_checkpoint(path, key, completed):
+    """Write the checkpoint atomically"""
+    if not path:
+        return
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump({'job': key, 'completed': completed}, f)
+    os.replace(temp_path, path)
+
+
+def run(start_day, end_day, workers=None, chunk_size=DEFAULT_CHUNK_SIZE, weekly=True,
+        checkpoint_path=DEFAULT_CHECKPOINT_FILE, restart=False, progress=None):
+    """
+    Generate the reports of every child for a date range.
+
+    Args:
+        workers (int): worker processes (default: CPU count)
+        chunk_size (int): children per chunk
+        checkpoint_path (str): checkpoint file, None to disable
+        restart (bool): ignore an existing checkpoint
+        progress (callable): called with a status line after each chunk
+
+    Returns:
+        dict: children, reports, chunks and errors of the run
+    """
+    key = f"{start_day.isoformat()}:{end_day.isoformat()}:{'weekly' if weekly else 'daily'}"
+    completed = [] if restart else _load_checkpoint(checkpoint_path, key)
+
+    # Children in id ranges that were completed before are skipped
+    child_ids = [
+        child_id for (child_id,) in db.session.query(Child.id).order_by(Child.id)
+        if not any(first <= child_id <= last for first, last in completed)
+    ]
+    chunks = [child_ids[i:i + chunk_size] for i in range(0, len(child_ids), chunk_size)]
+    totals = {'children': 0, 'reports': 0, 'chunks': len(chunks), 'errors': {}}
+    if not chunks:
+        return totals
+
+    # Don't hand the parent's open connections to the workers
+    db.session.remove()
+    db.engine.dispose()
+
+    started = time.monotonic()
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=_init_worker) as pool:
+        futures = {
+            pool.submit(generate_chunk, chunk, start_day, end_day, weekly): chunk
+            for chunk in chunks
+        }
+        for done, future in enumerate(as_completed(futures), start=1):
+            chunk = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                # The chunk stays out of the checkpoint and runs again on resume
+                logger.error(f"Report chunk {chunk[0]}-{chunk[-1]} failed: {e}")
+                totals['errors'].update({child_id: str(e) for child_id in chunk})
+                continue
+
+            totals['children'] += result['children']
+            totals['reports'] += result['reports']
+            totals['errors'].update(result['errors'])
+            if not result['errors']:
+                completed.append([chunk[0], chunk[-1]])
+                _save_checkpoint(checkpoint_path, key, completed)
+
+            if progress:
+                elapsed = time.monotonic() - started
+                remaining = elapsed / done * (len(chunks) - done)
+                progress(
+                    f"Chunk {done}/{len(chunks)}: {totals['children']} children, "
+                    f"{totals['reports']} reports, {len(totals['errors'])} errors, "
+                    f"{elapsed:.0f}s elapsed, ~{remaining:.0f}s left"
+                )
+
+    if not totals['errors'] and checkpoint_path and os.path.exists(checkpoint_path):
+        # The job is complete; a later run of it starts over
+        os.remove(checkpoint_path)
+    return totals
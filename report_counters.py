@@ -0,0 +1,199 @@
+"""
+Running daily report counters for Children's Castle application.
+
+A child's DailyReport row is kept up to date as activity is recorded, instead
+of being recomputed from sessions, events and progress when a report is
+requested:
+    - events (story, game and emotional feedback) as the event pipeline writes them
+    - completions as tracking records them
+    - reward points (stars) as rewards are granted
+    - session time when a session is closed
+
+Time spent is the day's closed-session seconds (kept per session in the
+activity breakdown) rounded to minutes once, so it matches a recomputed
+report instead of drifting by a rounding per session. Sessions that are never
+closed (e.g. the browser was shut without logging out) only count once
+session_activity.close_stale_sessions closes them at their last activity.
+
+The distinct stories and games of the day are kept in the report's
+activity_breakdown lists, so stories_read and games_played count each content
+once. Every update is one locked read-modify-write of the child's row for that
+day, in the caller's transaction.
+"""
+
+import json
+from datetime import datetime
+
+from sqlalchemy.dialects import postgresql, sqlite
+
+from db import db
+from models import Child, DailyReport
+import report_rollups  # noqa: F401  (keeps the week and month rollups in step with the reports)
+
+STORY_EVENT_NAMES = ('story_complete', 'story_page_complete')
+GAME_EVENT_NAMES = ('game_complete', 'game_start')
+
+# content type -> (activity_breakdown list, DailyReport counter)
+CONTENT_FIELDS = {
+    'story': ('stories', 'stories_read'),
+    'game': ('games', 'games_played')
+}
+
+
+def _insert():
+    """Get the dialect's INSERT construct that supports ON CONFLICT"""
+    if db.session.get_bind().dialect.name == 'postgresql':
+        return postgresql.insert
+    return sqlite.insert
+
+
+def _locked_report(child_id, day):
+    """Get a child's report for a day, creating it if needed, locked until the transaction ends"""
+    db.session.execute(
+        _insert()(DailyReport.__table__).values(
+            child_id=child_id, report_date=day
+        ).on_conflict_do_nothing(index_elements=['child_id', 'report_date'])
+    )
+    return DailyReport.query.filter_by(
+        child_id=child_id, report_date=day
+    ).with_for_update().populate_existing().one()
+
+
+def load_json(value, default):
+    """Parse a JSON report column, falling back to default"""
+    try:
+        return json.loads(value) if value else default
+    except (json.JSONDecodeError, TypeError):
+        return default
+
+
+def apply(child_id, day, content=None, session=None, stars=0, emotions=None):
+    """
+    Add activity to a child's daily report. Nothing is committed.
+
+    Args:
+        content (dict): content type -> content ids (only stories and games are counted)
+        session (dict): closed session's entry for the activity breakdown (see session_entry)
+        stars (int): stars earned
+        emotions (dict): emoji -> count
+    """
+    report = _locked_report(child_id, day)
+    breakdown = load_json(report.activity_breakdown, {})
+    for key in ('stories', 'games', 'sessions'):
+        breakdown.setdefault(key, [])
+
+    for content_type, content_ids in (content or {}).items():
+        if content_type not in CONTENT_FIELDS:
+            continue
+        list_key, counter = CONTENT_FIELDS[content_type]
+        known = set(breakdown[list_key])
+        breakdown[list_key].extend(
+            content_id for content_id in dict.fromkeys(content_ids) if content_id not in known
+        )
+        setattr(report, counter, len(breakdown[list_key]))
+
+    if session:
+        breakdown['sessions'].append(session)
+        report.time_spent = minutes(sum(session_seconds(entry) for entry in breakdown['sessions']))
+    report.activity_breakdown = json.dumps(breakdown)
+
+    report.stars_earned = (report.stars_earned or 0) + stars
+
+    if emotions:
+        feedback = load_json(report.emotional_feedback, {})
+        for emoji, count in emotions.items():
+            feedback[emoji] = feedback.get(emoji, 0) + count
+        report.emotional_feedback = json.dumps(feedback)
+
+    return report
+
+
+def record_events(rows):
+    """Count a batch of event rows (see event_pipeline) into the daily reports"""
+    updates = {}
+    for row in rows:
+        if row['user_type'] != 'child':
+            continue
+        data = row['event_data']
+        if isinstance(data, str):
+            data = load_json(data, None)
+        if not isinstance(data, dict):
+            continue
+
+        update = updates.setdefault((row['user_id'], row['occurred_at'].date()), {'content': {}, 'emotions': {}})
+        event_type, event_name = row['event_type'], row['event_name']
+        if event_type == 'emotional_feedback' and data.get('emoji'):
+            update['emotions'][data['emoji']] = update['emotions'].get(data['emoji'], 0) + 1
+        elif data.get('content_id') and (
+            (event_type == 'story' and event_name in STORY_EVENT_NAMES)
+            or (event_type == 'game' and event_name in GAME_EVENT_NAMES)
+        ):
+            update['content'].setdefault(event_type, []).append(data['content_id'])
+
+    # Skip events of users that aren't children (e.g. guests)
+    child_ids = {child_id for child_id, _ in updates}
+    existing_children = {
+        child_id for (child_id,) in
+        db.session.query(Child.id).filter(Child.id.in_(child_ids))
+    } if child_ids else set()
+
+    # Sorted, so concurrent writers lock the rows in the same order
+    for (child_id, day), update in sorted(updates.items()):
+        if child_id in existing_children and (update['content'] or update['emotions']):
+            apply(child_id, day, content=update['content'], emotions=update['emotions'])
+
+
+def record_completions(child_id, completions, completed_at=None):
+    """Count completions ((content_type, content_id) -> count) into the daily report"""
+    content = {}
+    for content_type, content_id in completions:
+        content.setdefault(content_type, []).append(content_id)
+    if any(content_type in CONTENT_FIELDS for content_type in content):
+        apply(child_id, (completed_at or datetime.utcnow()).date(), content=content)
+
+
+def record_reward(child_id, points, earned_at=None):
+    """Count a reward's points as stars earned"""
+    if points:
+        apply(child_id, (earned_at or datetime.utcnow()).date(), stars=points)
+
+
+def add_reward(reward):
+    """Add a new Reward to the session and count its points; every reward is granted this way"""
+    db.session.add(reward)
+    record_reward(reward.child_id, reward.points_value, reward.earned_at)
+
+
+def minutes(seconds):
+    """Whole minutes, rounded half up like SQL ROUND"""
+    return int(seconds / 60 + 0.5)
+
+
+def session_seconds(entry):
+    """Duration of an activity breakdown session entry (older entries only have minutes)"""
+    if 'duration_seconds' in entry:
+        return entry['duration_seconds']
+    return (entry.get('duration_minutes') or 0) * 60
+
+
+def record_session(user_session):
+    """Count a closed child session's time into the report of the day it started"""
+    if user_session.user_type != 'child' or not user_session.start_time or not user_session.end_time:
+        return
+    apply(
+        user_session.user_id,
+        user_session.start_time.date(),
+        session=session_entry(user_session)
+    )
+
+
+def session_entry(user_session):
+    """Activity breakdown entry of a closed session"""
+    seconds = (user_session.end_time - user_session.start_time).total_seconds()
+    return {
+        'start': user_session.start_time.isoformat(),
+        'end': user_session.end_time.isoformat(),
+        'duration_seconds': seconds,
+        'duration_minutes': minutes(seconds),
+        'device': user_session.device_type
+    }
@@ -0,0 +1,369 @@
+"""
+Report rollup cube for Children's Castle application.
+
+Weekly and monthly totals of every child's daily reports are kept in
+report_rollups. Whenever a DailyReport is inserted, changed or deleted, the
+difference is added to its week and month rollups in the same flush, so the
+rollups stay consistent with the daily rows. The changes of a flush are merged
+per rollup, and counters are added with one upsert per rollup; only emoji
+changes read the rollup row. When create_all creates the table, it is filled
+from the existing daily reports in the same transaction, so there is no
+separate backfill to forget (rebuild-report-rollups recomputes it on demand).
+
+Only changes made through ORM objects are rolled up. Core or bulk statements
+on daily_reports (e.g. update(DailyReport) or bulk_update_mappings) skip
+_before_flush and leave the rollups stale until rebuild-report-rollups runs.
+
+A date range is answered from the coarsest rollups it fully covers plus single
+days at its edges (see decompose): a calendar year reads 12 month rows, and
+any range reads at most about 60 rows.
+"""
+
+import json
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import and_, event, inspect, or_, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from db import db
+from models import DailyReport, ReportRollup
+
+COUNTERS = ('stories_read', 'games_played', 'time_spent', 'stars_earned')
+
+# Ranges up to this many days are broken down per day, up to LONGEST_WEEKLY_BREAKDOWN per week, else per month
+LONGEST_DAILY_BREAKDOWN = 31
+LONGEST_WEEKLY_BREAKDOWN = 183
+
+
+def week_start(day):
+    """Monday of a day's week"""
+    return day - timedelta(days=day.weekday())
+
+
+def month_end(day):
+    """Last day of a day's month"""
+    next_month = date(day.year + 1, 1, 1) if day.month == 12 else date(day.year, day.month + 1, 1)
+    return next_month - timedelta(days=1)
+
+
+def _load_emotions(value):
+    try:
+        emotions = json.loads(value) if value else {}
+    except (json.JSONDecodeError, TypeError):
+        return {}
+    return emotions if isinstance(emotions, dict) else {}
+
+
+def _insert():
+    """Get the dialect's INSERT construct that supports ON CONFLICT"""
+    if db.session.get_bind().dialect.name == 'postgresql':
+        return postgresql.insert
+    return sqlite.insert
+
+
+# Keeping the rollups in step with the daily reports
+
+def _report_delta(report, deleted=False):
+    """Counter and emoji differences a pending daily report change makes"""
+    delta = {}
+    emotions = {}
+    if deleted:
+        # Deleting subtracts what the report had counted
+        for name in COUNTERS:
+            delta[name] = -(getattr(report, name) or 0)
+        for emoji, count in _load_emotions(report.emotional_feedback).items():
+            emotions[emoji] = -count
+        return delta, emotions
+
+    state = inspect(report)
+    for name in COUNTERS:
+        history = state.attrs[name].history
+        if history.has_changes():
+            old = (history.deleted[0] if history.deleted else 0) or 0
+            new = (history.added[0] if history.added else 0) or 0
+            if new != old:
+                delta[name] = new - old
+
+    history = state.attrs.emotional_feedback.history
+    if history.has_changes():
+        old = _load_emotions(history.deleted[0] if history.deleted else None)
+        new = _load_emotions(history.added[0] if history.added else None)
+        for emoji in set(old) | set(new):
+            if new.get(emoji, 0) != old.get(emoji, 0):
+                emotions[emoji] = new.get(emoji, 0) - old.get(emoji, 0)
+    return delta, emotions
+
+
+def _rollup_keys(child_id, day):
+    """(child_id, period, period_start) of the week and month rollups a day belongs to"""
+    return ((child_id, 'week', week_start(day)), (child_id, 'month', day.replace(day=1)))
+
+
+def apply_delta(child_id, period, period_start, delta, emotions):
+    """
+    Add daily report changes to a rollup. Nothing is committed.
+
+    The counters are added with one upsert, without reading the row; only
+    emoji changes need a locked read-modify-write of the JSON column.
+    """
+    table = ReportRollup.__table__
+    now = datetime.utcnow()
+    stmt = _insert()(table).values(
+        child_id=child_id, period=period, period_start=period_start,
+        emotional_feedback='{}', updated_at=now,
+        **{name: delta.get(name, 0) for name in COUNTERS}
+    )
+    set_ = {name: table.c[name] + stmt.excluded[name] for name in delta}
+    set_['updated_at'] = now
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=['child_id', 'period', 'period_start'], set_=set_
+    ))
+
+    if emotions:
+        key = and_(table.c.child_id == child_id, table.c.period == period, table.c.period_start == period_start)
+        totals = _load_emotions(db.session.execute(
+            select(table.c.emotional_feedback).where(key).with_for_update()
+        ).scalar())
+        for emoji, count in emotions.items():
+            totals[emoji] = totals.get(emoji, 0) + count
+            if not totals[emoji]:
+                del totals[emoji]
+        db.session.execute(table.update().where(key).values(emotional_feedback=json.dumps(totals)))
+
+
+def _before_flush(session, flush_context, instances):
+    """Roll the pending daily report changes up into their week and month"""
+    deltas = {}
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if not isinstance(obj, DailyReport):
+            continue
+        delta, emotions = _report_delta(obj, obj in session.deleted)
+        if not (delta or emotions):
+            continue
+        # Reports of the same week or month in one flush update their rollup once
+        for key in _rollup_keys(obj.child_id, obj.report_date):
+            merged_delta, merged_emotions = deltas.setdefault(key, ({}, {}))
+            for name, value in delta.items():
+                merged_delta[name] = merged_delta.get(name, 0) + value
+            for emoji, count in emotions.items():
+                merged_emotions[emoji] = merged_emotions.get(emoji, 0) + count
+
+    # Sorted, so concurrent writers lock the rollups in the same order
+    for (child_id, period, period_start), (delta, emotions) in sorted(deltas.items()):
+        apply_delta(child_id, period, period_start, delta, emotions)
+
+
+event.listen(db.session, 'before_flush', _before_flush)
+
+
+def _require_old_value(target, value, oldvalue, initiator):
+    """
+    Does nothing; it is registered with active_history=True, which makes
+    SQLAlchemy load an expired attribute's old value before it is set.
+    Without it, setting an expired counter (e.g. after a commit) records no
+    old value, and _before_flush would add the whole new value to the rollups.
+    """
+
+
+for _name in COUNTERS + ('emotional_feedback',):
+    event.listen(getattr(DailyReport, _name), 'set', _require_old_value, active_history=True)
+
+
+# Reading date ranges
+
+def decompose(start_day, end_day):
+    """
+    Split a date range into the fewest ('month' | 'week' | 'day', start) pieces.
+
+    Whole months are used first, then whole weeks (Monday to Sunday) that don't
+    reach into a month the range covers completely, then single days.
+    """
+    pieces = []
+    day = start_day
+    while day <= end_day:
+        last_of_month = month_end(day)
+        if day.day == 1 and last_of_month <= end_day:
+            pieces.append(('month', day))
+            day = last_of_month + timedelta(days=1)
+            continue
+
+        last_of_week = day + timedelta(days=6)
+        if day.weekday() == 0 and last_of_week <= end_day:
+            next_month = last_of_month + timedelta(days=1)
+            if not (last_of_week >= next_month and month_end(next_month) <= end_day):
+                pieces.append(('week', day))
+                day = last_of_week + timedelta(days=1)
+                continue
+
+        pieces.append(('day', day))
+        day += timedelta(days=1)
+    return pieces
+
+
+def _empty_totals():
+    totals = {name: 0 for name in COUNTERS}
+    totals['emotional_feedback'] = {}
+    return totals
+
+
+def _add(totals, values):
+    for name in COUNTERS:
+        totals[name] += values[name] or 0
+    for emoji, count in _load_emotions(values['emotional_feedback']).items():
+        totals['emotional_feedback'][emoji] = totals['emotional_feedback'].get(emoji, 0) + count
+
+
+def _fetch(child_id, pieces):
+    """Load the rows of a set of pieces with one rollup query and one daily report query"""
+    columns = [getattr(ReportRollup, name) for name in COUNTERS] + [ReportRollup.emotional_feedback]
+    weeks = [start for period, start in pieces if period == 'week']
+    months = [start for period, start in pieces if period == 'month']
+    days = [start for period, start in pieces if period == 'day']
+
+    rows = {}
+    if weeks or months:
+        for row in db.session.query(ReportRollup.period, ReportRollup.period_start, *columns).filter(
+            ReportRollup.child_id == child_id,
+            or_(
+                and_(ReportRollup.period == 'week', ReportRollup.period_start.in_(weeks)),
+                and_(ReportRollup.period == 'month', ReportRollup.period_start.in_(months))
+            )
+        ):
+            rows[(row.period, row.period_start)] = row
+    if days:
+        daily_columns = [getattr(DailyReport, name) for name in COUNTERS] + [DailyReport.emotional_feedback]
+        for row in db.session.query(DailyReport.report_date, *daily_columns).filter(
+            DailyReport.child_id == child_id,
+            DailyReport.report_date.in_(days)
+        ):
+            rows[('day', row.report_date)] = row
+    return rows
+
+
+def sum_range(child_id, start_day, end_day):
+    """
+    Totals of a child's daily reports in a date range.
+
+    Returns:
+        dict: stories_read, games_played, time_spent, stars_earned and emotional_feedback
+    """
+    pieces = decompose(start_day, end_day)
+    rows = _fetch(child_id, pieces)
+    totals = _empty_totals()
+    for piece in pieces:
+        if piece in rows:
+            _add(totals, rows[piece]._mapping)
+    return totals
+
+
+def breakdown(child_id, start_day, end_day):
+    """
+    Totals per day, week or month of a date range, depending on its length.
+
+    Returns:
+        list: dicts with date (first day of the bucket), period and the counters
+    """
+    length = (end_day - start_day).days + 1
+    if length <= LONGEST_DAILY_BREAKDOWN:
+        period = 'day'
+        bucket_starts = [start_day + timedelta(days=i) for i in range(length)]
+    elif length <= LONGEST_WEEKLY_BREAKDOWN:
+        period = 'week'
+        bucket_starts = [start_day] + [
+            week_start(start_day) + timedelta(days=7 * i)
+            for i in range(1, (end_day - week_start(start_day)).days // 7 + 1)
+        ]
+    else:
+        period = 'month'
+        bucket_starts = [start_day]
+        month = month_end(start_day) + timedelta(days=1)
+        while month <= end_day:
+            bucket_starts.append(month)
+            month = month_end(month) + timedelta(days=1)
+
+    buckets = []
+    for i, bucket_start in enumerate(bucket_starts):
+        bucket_end = bucket_starts[i + 1] - timedelta(days=1) if i + 1 < len(bucket_starts) else end_day
+        buckets.append((bucket_start, decompose(bucket_start, bucket_end)))
+
+    rows = _fetch(child_id, {piece for _, pieces in buckets for piece in pieces})
+    result = []
+    for bucket_start, pieces in buckets:
+        totals = _empty_totals()
+        for piece in pieces:
+            if piece in rows:
+                _add(totals, rows[piece]._mapping)
+        result.append({
+            'date': bucket_start.isoformat(),
+            'period': period,
+            'stories_read': totals['stories_read'],
+            'games_played': totals['games_played'],
+            'time_spent': totals['time_spent'],
+            'stars_earned': totals['stars_earned']
+        })
+    return result
+
+
+def _totals(rows):
+    """Add up daily report rows into (child_id, period, period_start) -> totals"""
+    totals = {}
+    for row in rows:
+        for key in _rollup_keys(row.child_id, row.report_date):
+            _add(totals.setdefault(key, _empty_totals()), row._mapping)
+    return totals
+
+
+def _rollup_rows(totals):
+    """report_rollups rows of totals (see _totals)"""
+    now = datetime.utcnow()
+    return [
+        dict(
+            {name: values[name] for name in COUNTERS},
+            child_id=child_id, period=period, period_start=period_start,
+            emotional_feedback=json.dumps(values['emotional_feedback']), updated_at=now
+        )
+        for (child_id, period, period_start), values in totals.items()
+    ]
+
+
+def _daily_report_query():
+    return select(
+        DailyReport.child_id, DailyReport.report_date,
+        *[getattr(DailyReport, name) for name in COUNTERS], DailyReport.emotional_feedback
+    )
+
+
+def rebuild(child_ids=None):
+    """
+    Recompute the rollups from the daily reports.
+
+    Returns:
+        int: Number of rollups written
+    """
+    query = _daily_report_query()
+    deleted = ReportRollup.query
+    if child_ids is not None:
+        query = query.where(DailyReport.child_id.in_(child_ids))
+        deleted = deleted.filter(ReportRollup.child_id.in_(child_ids))
+
+    totals = _totals(db.session.execute(query.execution_options(yield_per=1000)))
+    deleted.delete(synchronize_session=False)
+    if totals:
+        db.session.execute(ReportRollup.__table__.insert(), _rollup_rows(totals))
+    db.session.commit()
+    return len(totals)
+
+
+def _backfill(table, connection, **kw):
+    """Fill a newly created report_rollups table from the existing daily reports"""
+    if not inspect(connection).has_table(DailyReport.__tablename__):
+        return
+    totals = _totals(connection.execute(_daily_report_query()))
+    if totals:
+        connection.execute(table.insert(), _rollup_rows(totals))
+
+
+# The rollups are complete from the moment the table exists (create_all runs
+# at startup), so week and month reads never see a rollup with only the
+# changes made after deployment
+event.listen(ReportRollup.__table__, 'after_create', _backfill)
@@ -5,20 +5,29 @@ Handles generation and display of daily and weekly reports for children's activi
 
 import json
 from datetime import datetime, timedelta, date
-from sqlalchemy import func, desc, or_, and_
-from flask import jsonify
+from sqlalchemy import func, or_, and_, text
 
 from app import db
-from models import Child, Session, Event, Progress, DailyReport, WeeklyReport
+from models import Session, Event, Reward, CompletionEvent, DailyReport, WeeklyReport
+import tracking
+import report_counters
+import activity_calendar
+import report_rollups
+import data_retention
 
 
-def generate_daily_report(child_id, report_date=None):
+def generate_daily_report(child_id, report_date=None, recompute=False):
     """
     Generate a daily report for a child's activity
     
+    The report's counters are kept up to date as activity is recorded (see
+    report_counters), so this reads one row. Days without a report, e.g.
+    from before the counters existed, are recomputed from the activity tables.
+    
     Args:
         child_id (int): The ID of the child
         report_date (date, optional): The date for the report. Defaults to today.
+        recompute (bool): Recompute the report even if it exists
     
     Returns:
         DailyReport: The generated or updated report object
@@ -27,155 +36,182 @@ def generate_daily_report(child_id, report_date=None):
     if report_date is None:
         report_date = date.today()
     
-    # Check if a report already exists for this date
-    existing_report = DailyReport.query.filter_by(
+    report = DailyReport.query.filter_by(
         child_id=child_id, 
         report_date=report_date
     ).first()
     
-    if existing_report:
-        # Update existing report
-        report = existing_report
-    else:
-        # Create new report
+    # Only new, recomputed or changed reports are written. The streak query
+    # autoflushes, so the session can't tell whether the report changed.
+    changed = report is None or (recompute and report_date >= data_retention.retained_since())
+    if changed:
+        report = recompute_daily_report(child_id, report_date, report)
+    
+    daily_streak = activity_calendar.current_streak(child_id, today=report_date)
+    if report.daily_streak != daily_streak:
+        report.daily_streak = daily_streak
+        changed = True
+    
+    if changed:
+        db.session.commit()
+    
+    return report
+
+
+def recompute_daily_report(child_id, report_date, report=None):
+    """
+    Recompute a daily report from sessions, events, completions and rewards.
+    Nothing is committed.
+    
+    Args:
+        child_id (int): The ID of the child
+        report_date (date): The date for the report
+        report (DailyReport, optional): The existing report to overwrite
+    
+    Returns:
+        DailyReport: The recomputed report object
+    """
+    if report is None:
         report = DailyReport(
             child_id=child_id,
             report_date=report_date
         )
+        db.session.add(report)
     
     # Get start and end of the day
     day_start = datetime.combine(report_date, datetime.min.time())
     day_end = datetime.combine(report_date, datetime.max.time())
-    
-    # Calculate metrics from data
-    
-    # 1. Time spent in app
-    sessions = Session.query.filter(
-        Session.user_id == child_id,
-        Session.user_type == 'child',
-        Session.start_time.between(day_start, day_end)
-    ).all()
-    
-    total_minutes = 0
-    for session in sessions:
-        # Calculate session duration
-        if session.end_time:
-            session_duration = (session.end_time - session.start_time).total_seconds() / 60
-        else:
-            # For open sessions, calculate duration up to now
-            current_time = datetime.now()
-            session_duration = (current_time - session.start_time).total_seconds() / 60
-        
-        total_minutes += session_duration
-    
-    # 2. Stories read
-    story_events = Event.query.filter(
+    child_events = (
         Event.user_id == child_id,
         Event.user_type == 'child',
-        Event.timestamp.between(day_start, day_end),
-        Event.event_type == 'story',
-        Event.event_name.in_(['story_complete', 'story_page_complete'])
-    ).all()
+        Event.occurred_at.between(day_start, day_end)
+    )
     
-    # Count unique stories by tracking unique content IDs
-    unique_stories = set()
-    for event in story_events:
-        try:
-            if event.event_data:
-                data = json.loads(event.event_data) if isinstance(event.event_data, str) else event.event_data
-                if 'content_id' in data:
-                    unique_stories.add(data['content_id'])
-        except (json.JSONDecodeError, TypeError):
-            continue
-    
-    # 3. Games played
-    game_events = Event.query.filter(
-        Event.user_id == child_id,
-        Event.user_type == 'child',
-        Event.timestamp.between(day_start, day_end),
-        Event.event_type == 'game',
-        Event.event_name.in_(['game_complete', 'game_start'])
-    ).all()
-    
-    # Count unique games
-    unique_games = set()
-    for event in game_events:
-        try:
-            if event.event_data:
-                data = json.loads(event.event_data) if isinstance(event.event_data, str) else event.event_data
-                if 'content_id' in data:
-                    unique_games.add(data['content_id'])
-        except (json.JSONDecodeError, TypeError):
-            continue
-    
-    # 4. Stars earned (from progress data)
-    progress_records = Progress.query.filter(
-        Progress.child_id == child_id,
-        Progress.last_accessed.between(day_start, day_end)
-    ).all()
-    
-    stars_earned = 0
-    for progress in progress_records:
-        stars_earned += progress.stars or 0
-    
-    # 5. Emotional feedback
-    emotion_events = Event.query.filter(
-        Event.user_id == child_id,
-        Event.user_type == 'child',
-        Event.timestamp.between(day_start, day_end),
-        Event.event_type == 'emotional_feedback'
-    ).all()
-    
-    emotion_data = {}
-    for event in emotion_events:
-        try:
-            if event.event_data:
-                data = json.loads(event.event_data) if isinstance(event.event_data, str) else event.event_data
-                if 'emoji' in data:
-                    emoji = data['emoji']
-                    if emoji in emotion_data:
-                        emotion_data[emoji] += 1
-                    else:
-                        emotion_data[emoji] = 1
-        except (json.JSONDecodeError, TypeError):
-            continue
-    
-    # 6. Learning goals progress
-    # Include any metrics on learning goals
-    
-    # 7. Record all metrics in the report
-    report.stories_read = len(unique_stories)
-    report.games_played = len(unique_games)
-    report.time_spent = round(total_minutes)
-    report.stars_earned = stars_earned
-    
-    # Store emotion data
+    # 1. Time spent in app (closed sessions; open ones are counted when they close)
+    session_filter = (
+        Session.user_id == child_id,
+        Session.user_type == 'child',
+        Session.start_time.between(day_start, day_end),
+        Session.end_time.isnot(None)
+    )
+    # The day's total seconds come back with every session row (SUM as a window
+    # function) and are rounded to minutes once, like the running counters
+    sessions = db.session.query(
+        Session.start_time, Session.end_time, Session.device_type,
+        func.sum(_session_seconds()).over()
+    ).filter(*session_filter).order_by(Session.start_time).all()
+    total_minutes = report_counters.minutes(sessions[0][3] or 0) if sessions else 0
+    
+    # 2. Stories read and games played: distinct content of story/game events and completions
+    content_id = _json_text(Event.event_data, 'content_id')
+    event_content = db.session.query(Event.event_type, content_id).filter(
+        *child_events,
+        or_(
+            and_(Event.event_type == 'story', Event.event_name.in_(report_counters.STORY_EVENT_NAMES)),
+            and_(Event.event_type == 'game', Event.event_name.in_(report_counters.GAME_EVENT_NAMES))
+        ),
+        content_id.isnot(None)
+    )
+    completed_content = tracking.completed_content_query(child_id, day_start, day_end).filter(
+        CompletionEvent.content_type.in_(['story', 'game'])
+    )
+    content = {'story': [], 'game': []}
+    for content_type, content_key in event_content.union(completed_content):
+        content[content_type].append(content_key)
+    
+    # 3. Stars earned (reward points)
+    stars_earned = db.session.query(func.coalesce(func.sum(Reward.points_value), 0)).filter(
+        Reward.child_id == child_id,
+        Reward.earned_at.between(day_start, day_end)
+    ).scalar()
+    
+    # 4. Emotional feedback, counted per emoji
+    emoji = _json_text(Event.event_data, 'emoji')
+    emotion_data = dict(
+        db.session.query(emoji, func.count(Event.id)).filter(
+            *child_events,
+            Event.event_type == 'emotional_feedback',
+            emoji.isnot(None)
+        ).group_by(emoji).all()
+    )
+    
+    # 5. Record all metrics in the report
+    report.stories_read = len(content['story'])
+    report.games_played = len(content['game'])
+    report.time_spent = int(total_minutes)
+    report.stars_earned = int(stars_earned)
     report.emotional_feedback = json.dumps(emotion_data)
     
-    # Serialized activity breakdown
-    activity_breakdown = {
-        'stories': list(unique_stories),
-        'games': list(unique_games),
-        'sessions': [
-            {
-                'start': session.start_time.isoformat(),
-                'end': session.end_time.isoformat() if session.end_time else None,
-                'duration_minutes': round((session.end_time - session.start_time).total_seconds() / 60) if session.end_time else None,
-                'device': session.device_type
-            } 
-            for session in sessions
-        ]
-    }
-    report.activity_breakdown = json.dumps(activity_breakdown)
-    
-    # Save report to database
-    if not existing_report:
-        db.session.add(report)
-    db.session.commit()
+    # The story and game lists are also the distinct-content sets the counters extend
+    report.activity_breakdown = json.dumps({
+        'stories': content['story'],
+        'games': content['game'],
+        'sessions': [report_counters.session_entry(session) for session in sessions]
+    })
     
     return report
 
 
+def _json_text(column, key):
+    """A JSON column's value at key as text: column->>'key' (PostgreSQL) or json_extract (SQLite)"""
+    return column[key].as_string()
+
+
+def _session_seconds():
+    """SQL expression of a session's duration in seconds"""
+    if db.session.get_bind().dialect.name == 'postgresql':
+        return func.extract('epoch', Session.end_time - Session.start_time)
+    return (func.julianday(Session.end_time) - func.julianday(Session.start_time)) * 86400
+
+
+def _sum_daily_reports(child_id, start_day, end_day):
+    """
+    Add up a child's daily reports in a date range with one aggregate query.
+    
+    Returns:
+        dict: number of reports and summed stories_read, games_played, time_spent and stars_earned
+    """
+    count, stories_read, games_played, time_spent, stars_earned = db.session.query(
+        func.count(DailyReport.id),
+        func.coalesce(func.sum(DailyReport.stories_read), 0),
+        func.coalesce(func.sum(DailyReport.games_played), 0),
+        func.coalesce(func.sum(DailyReport.time_spent), 0),
+        func.coalesce(func.sum(DailyReport.stars_earned), 0)
+    ).filter(
+        DailyReport.child_id == child_id,
+        DailyReport.report_date.between(start_day, end_day)
+    ).one()
+    return {
+        'reports': count,
+        'stories_read': int(stories_read),
+        'games_played': int(games_played),
+        'time_spent': int(time_spent),
+        'stars_earned': int(stars_earned)
+    }
+
+
+def _sum_daily_emotions(child_id, start_day, end_day):
+    """Add up the emoji counts of a child's daily reports in a date range, grouped by emoji in SQL"""
+    if db.session.get_bind().dialect.name == 'postgresql':
+        sql = """
+            SELECT e.key, SUM(e.value::integer)
+            FROM daily_reports d, json_each_text(d.emotional_feedback::json) e
+            WHERE d.child_id = :child_id AND d.report_date BETWEEN :start_day AND :end_day
+              AND d.emotional_feedback LIKE '{%'
+            GROUP BY e.key
+        """
+    else:
+        sql = """
+            SELECT e.key, SUM(e.value)
+            FROM daily_reports d, json_each(d.emotional_feedback) e
+            WHERE d.child_id = :child_id AND d.report_date BETWEEN :start_day AND :end_day
+              AND json_valid(d.emotional_feedback)
+            GROUP BY e.key
+        """
+    rows = db.session.execute(text(sql), {'child_id': child_id, 'start_day': start_day, 'end_day': end_day})
+    return {emoji: int(count) for emoji, count in rows}
+
+
 def generate_weekly_report(child_id, week_start=None):
     """
     Generate a weekly report for a child's activity
@@ -213,48 +249,32 @@ def generate_weekly_report(child_id, week_start=None):
             week_end=week_end
         )
     
-    # Aggregate daily reports for the week
-    daily_reports = DailyReport.query.filter(
-        DailyReport.child_id == child_id,
-        DailyReport.report_date.between(week_start, week_end)
-    ).all()
+    # Aggregate daily reports for the week in SQL
+    totals = _sum_daily_reports(child_id, week_start, week_end)
     
     # If no daily reports available, generate them for each day
-    if not daily_reports:
+    if not totals['reports']:
         for i in range(7):
             day_date = week_start + timedelta(days=i)
             if day_date <= date.today():  # Only generate for days up to today
                 generate_daily_report(child_id, day_date)
         
-        # Retrieve newly generated reports
-        daily_reports = DailyReport.query.filter(
-            DailyReport.child_id == child_id,
-            DailyReport.report_date.between(week_start, week_end)
-        ).all()
+        totals = _sum_daily_reports(child_id, week_start, week_end)
     
     # If still no daily reports, return None (no activity for the week)
-    if not daily_reports:
+    if not totals['reports']:
         return None
     
-    # Aggregate metrics from daily reports
-    stories_read = sum(report.stories_read for report in daily_reports)
-    games_played = sum(report.games_played for report in daily_reports)
-    time_spent = sum(report.time_spent for report in daily_reports)
-    stars_earned = sum(report.stars_earned for report in daily_reports)
-    
-    # Aggregate emotional feedback
-    all_emotions = {}
-    for daily_report in daily_reports:
-        if daily_report.emotional_feedback:
-            try:
-                emotions = json.loads(daily_report.emotional_feedback)
-                for emoji, count in emotions.items():
-                    if emoji in all_emotions:
-                        all_emotions[emoji] += count
-                    else:
-                        all_emotions[emoji] = count
-            except (json.JSONDecodeError, TypeError):
-                continue
+    all_emotions = _sum_daily_emotions(child_id, week_start, week_end)
+    
+    # Day-by-day breakdown (only the columns it shows)
+    daily_reports = db.session.query(
+        DailyReport.report_date, DailyReport.stories_read, DailyReport.games_played,
+        DailyReport.time_spent, DailyReport.stars_earned
+    ).filter(
+        DailyReport.child_id == child_id,
+        DailyReport.report_date.between(week_start, week_end)
+    ).all()
     
     # Build day-by-day breakdown
     daily_breakdown = []
@@ -280,41 +300,17 @@ def generate_weekly_report(child_id, week_start=None):
             })
     
     # Update report metrics
-    report.stories_read = stories_read
-    report.games_played = games_played
-    report.time_spent = time_spent
-    report.stars_earned = stars_earned
+    report.stories_read = totals['stories_read']
+    report.games_played = totals['games_played']
+    report.time_spent = totals['time_spent']
+    report.stars_earned = totals['stars_earned']
     report.emotional_feedback = json.dumps(all_emotions)
     report.daily_breakdown = json.dumps(daily_breakdown)
     
-    # Calculate streaks (consecutive days with activity)
-    active_days = [r.report_date for r in daily_reports if r.time_spent > 0]
-    active_days.sort()
-    
-    current_streak = 0
-    longest_streak = 0
-    last_date = None
-    
-    for idx, active_date in enumerate(active_days):
-        if idx == 0:
-            current_streak = 1
-            longest_streak = 1
-            last_date = active_date
-        else:
-            if (active_date - last_date).days == 1:
-                current_streak += 1
-                longest_streak = max(longest_streak, current_streak)
-            else:
-                current_streak = 1
-            last_date = active_date
-    
-    # Check if current streak is ongoing until today
-    if active_days and (date.today() - active_days[-1]).days <= 1:
-        report.current_streak = current_streak
-    else:
-        report.current_streak = 0
-    
-    report.longest_streak = longest_streak
+    # Streaks (consecutive days with activity) from the child's activity calendar
+    calendar = activity_calendar.get_bits(child_id)
+    report.current_streak = activity_calendar.current_streak(child_id, calendar=calendar)
+    report.longest_streak = activity_calendar.longest_streak(child_id, week_start, week_end, calendar)
     
     # Save report to database
     if not existing_report:
@@ -427,105 +423,31 @@ def get_report_data_for_period(child_id, period_type='week', start_date=None, en
         }
     
     elif period_type == 'month':
-        # Calculate month start
+        # Calculate month start and end
         if not start_date:
             start_date = date(today.year, today.month, 1)
+        end_date = report_rollups.month_end(start_date)
         
-        # Calculate month end
-        if today.month == 12:
-            next_month = date(today.year + 1, 1, 1)
-        else:
-            next_month = date(today.year, today.month + 1, 1)
-        
-        end_date = next_month - timedelta(days=1)
-        
-        # Get all daily reports for the month
-        daily_reports = DailyReport.query.filter(
-            DailyReport.child_id == child_id,
-            DailyReport.report_date.between(start_date, end_date)
-        ).order_by(DailyReport.report_date).all()
-        
-        # Generate missing daily reports
-        current_date = start_date
-        while current_date <= min(today, end_date):
-            if not any(r.report_date == current_date for r in daily_reports):
-                report = generate_daily_report(child_id, current_date)
-                if report:
-                    daily_reports.append(report)
-            current_date += timedelta(days=1)
-        
-        # Sort daily reports by date
-        daily_reports.sort(key=lambda x: x.report_date)
-        
-        # Aggregate monthly metrics
-        stories_read = sum(report.stories_read for report in daily_reports)
-        games_played = sum(report.games_played for report in daily_reports)
-        time_spent = sum(report.time_spent for report in daily_reports)
-        stars_earned = sum(report.stars_earned for report in daily_reports)
-        
-        # Aggregate emotional feedback
-        all_emotions = {}
-        for daily_report in daily_reports:
-            if daily_report.emotional_feedback:
-                try:
-                    emotions = json.loads(daily_report.emotional_feedback)
-                    for emoji, count in emotions.items():
-                        if emoji in all_emotions:
-                            all_emotions[emoji] += count
-                        else:
-                            all_emotions[emoji] = count
-                except (json.JSONDecodeError, TypeError):
-                    continue
-        
-        # Build day-by-day breakdown
-        daily_breakdown = []
-        for report in daily_reports:
-            daily_breakdown.append({
-                'date': report.report_date.isoformat(),
-                'stories_read': report.stories_read,
-                'games_played': report.games_played,
-                'time_spent': report.time_spent,
-                'stars_earned': report.stars_earned
-            })
+        # Totals and day-by-day breakdown from the report rollups
+        totals = report_rollups.sum_range(child_id, start_date, end_date)
+        daily_breakdown = report_rollups.breakdown(child_id, start_date, end_date)
         
-        # Calculate streaks
-        active_days = [r.report_date for r in daily_reports if r.time_spent > 0]
-        active_days.sort()
-        
-        current_streak = 0
-        longest_streak = 0
-        last_date = None
-        
-        for idx, active_date in enumerate(active_days):
-            if idx == 0:
-                current_streak = 1
-                longest_streak = 1
-                last_date = active_date
-            else:
-                if (active_date - last_date).days == 1:
-                    current_streak += 1
-                    longest_streak = max(longest_streak, current_streak)
-                else:
-                    current_streak = 1
-                last_date = active_date
-        
-        # Check if current streak is ongoing until today
-        if active_days and (today - active_days[-1]).days <= 1:
-            current_streak_value = current_streak
-        else:
-            current_streak_value = 0
+        # Streaks from the child's activity calendar
+        calendar = activity_calendar.get_bits(child_id)
+        current_streak_value = activity_calendar.current_streak(child_id, calendar=calendar)
+        longest_streak = activity_calendar.longest_streak(child_id, start_date, end_date, calendar)
         
         return {
             'period_type': 'month',
             'start_date': start_date.isoformat(),
             'end_date': end_date.isoformat(),
-            'stories_read': stories_read,
-            'games_played': games_played,
-            'time_spent': time_spent,
-            'stars_earned': stars_earned,
+            'stories_read': totals['stories_read'],
+            'games_played': totals['games_played'],
+            'time_spent': totals['time_spent'],
+            'stars_earned': totals['stars_earned'],
             'current_streak': current_streak_value,
             'longest_streak': longest_streak,
-            'emotional_feedback': all_emotions,
+            'emotional_feedback': totals['emotional_feedback'],
             'daily_breakdown': daily_breakdown
         }
     
@@ -540,64 +462,20 @@ def get_report_data_for_period(child_id, period_type='week', start_date=None, en
         if start_date > end_date:
             start_date, end_date = end_date, start_date
         
-        # Get all daily reports for the custom period
-        daily_reports = DailyReport.query.filter(
-            DailyReport.child_id == child_id,
-            DailyReport.report_date.between(start_date, end_date)
-        ).order_by(DailyReport.report_date).all()
-        
-        # Generate missing daily reports
-        current_date = start_date
-        while current_date <= min(today, end_date):
-            if not any(r.report_date == current_date for r in daily_reports):
-                report = generate_daily_report(child_id, current_date)
-                if report:
-                    daily_reports.append(report)
-            current_date += timedelta(days=1)
-        
-        # Sort daily reports by date
-        daily_reports.sort(key=lambda x: x.report_date)
-        
-        # Aggregate metrics
-        stories_read = sum(report.stories_read for report in daily_reports)
-        games_played = sum(report.games_played for report in daily_reports)
-        time_spent = sum(report.time_spent for report in daily_reports)
-        stars_earned = sum(report.stars_earned for report in daily_reports)
-        
-        # Aggregate emotional feedback
-        all_emotions = {}
-        for daily_report in daily_reports:
-            if daily_report.emotional_feedback:
-                try:
-                    emotions = json.loads(daily_report.emotional_feedback)
-                    for emoji, count in emotions.items():
-                        if emoji in all_emotions:
-                            all_emotions[emoji] += count
-                        else:
-                            all_emotions[emoji] = count
-                except (json.JSONDecodeError, TypeError):
-                    continue
-        
-        # Build day-by-day breakdown
-        daily_breakdown = []
-        for report in daily_reports:
-            daily_breakdown.append({
-                'date': report.report_date.isoformat(),
-                'stories_read': report.stories_read,
-                'games_played': report.games_played,
-                'time_spent': report.time_spent,
-                'stars_earned': report.stars_earned
-            })
+        # Totals from the coarsest covering rollups; the breakdown is per day,
+        # week or month depending on the length of the period
+        totals = report_rollups.sum_range(child_id, start_date, end_date)
+        daily_breakdown = report_rollups.breakdown(child_id, start_date, end_date)
         
         return {
             'period_type': 'custom',
             'start_date': start_date.isoformat(),
             'end_date': end_date.isoformat(),
-            'stories_read': stories_read,
-            'games_played': games_played,
-            'time_spent': time_spent,
-            'stars_earned': stars_earned,
-            'emotional_feedback': all_emotions,
+            'stories_read': totals['stories_read'],
+            'games_played': totals['games_played'],
+            'time_spent': totals['time_spent'],
+            'stars_earned': totals['stars_earned'],
+            'emotional_feedback': totals['emotional_feedback'],
             'daily_breakdown': daily_breakdown
         }
     
@@ -657,6 +535,12 @@ def generate_chart_data(report_data):
             if period_type == 'week':
                 # For week, show day names
                 label = day_date.strftime('%a')
+            elif day_data.get('period') == 'month':
+                # Long custom periods are broken down per month
+                label = day_date.strftime('%b')
+            elif day_data.get('period') == 'week':
+                # Medium custom periods are broken down per week
+                label = day_date.strftime('%d %b')
             else:
                 # For month/custom, show dates
                 label = day_date.strftime('%d')
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Benchmark daily report recomputation for Children's Castle application.
+
+Times the aggregate SQL queries of reports.recompute_daily_report against the
+previous row-by-row Python loops on a month of synthetic events, in a
+temporary SQLite database. Wall-clock timings depend on the machine, so this
+runs outside the test suite (test_app.py checks the results and query count).
+
+Usage:
+    python scripts/benchmark_daily_reports.py [--days 30] [--events 480] [--repeat 3]
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+from datetime import date, datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EMOJIS = ['happy', 'sad', 'wow', 'love', 'sleepy']
+
+
+def create_data(db, Parent, Child, Event, Session, days, events_per_day):
+    """Create a child with events and three sessions per day; returns the child's ID"""
+    parent = Parent(username='benchparent', email='bench@example.com')
+    parent.set_password('benchmark')
+    db.session.add(parent)
+    db.session.commit()
+    child = Child(parent_id=parent.id, username='benchchild', display_name='Bench Child', age=5)
+    db.session.add(child)
+    db.session.commit()
+
+    events = []
+    sessions = []
+    for day in days:
+        start = datetime.combine(day, datetime.min.time()) + timedelta(hours=8)
+        for i in range(events_per_day):
+            occurred_at = start + timedelta(seconds=60 * i // 4)
+            if i % 3 == 0:
+                kind = ('story', 'story_complete' if i % 2 else 'story_page_complete', {'content_id': f'story_{i % 25}'})
+            elif i % 3 == 1:
+                kind = ('game', 'game_start', {'content_id': f'game_{i % 20}'})
+            else:
+                kind = ('emotional_feedback', 'emoji_reaction', {'emoji': EMOJIS[i % 5], 'content_id': 'x'})
+            events.append({
+                'user_type': 'child', 'user_id': child.id, 'event_type': kind[0],
+                'event_name': kind[1], 'event_data': kind[2], 'occurred_at': occurred_at
+            })
+        for i in range(3):
+            session_start = start + timedelta(hours=i * 3)
+            sessions.append(Session(
+                user_type='child', user_id=child.id, start_time=session_start,
+                end_time=session_start + timedelta(minutes=10 + 7 * i)
+            ))
+    db.session.execute(Event.__table__.insert(), events)
+    db.session.add_all(sessions)
+    db.session.commit()
+    return child.id
+
+
+def python_daily_totals(Event, Session, child_id, day):
+    """The previous implementation: load every row and aggregate in Python"""
+    day_start = datetime.combine(day, datetime.min.time())
+    day_end = datetime.combine(day, datetime.max.time())
+    minutes = 0
+    for session in Session.query.filter(
+        Session.user_id == child_id, Session.user_type == 'child',
+        Session.start_time.between(day_start, day_end), Session.end_time.isnot(None)
+    ).all():
+        minutes += (session.end_time - session.start_time).total_seconds() / 60
+    stories, games, emotions = set(), set(), {}
+    for row in Event.query.filter(
+        Event.user_id == child_id, Event.user_type == 'child',
+        Event.occurred_at.between(day_start, day_end)
+    ).all():
+        data = row.event_data or {}
+        if row.event_type == 'story' and row.event_name in ('story_complete', 'story_page_complete'):
+            stories.add(data['content_id'])
+        elif row.event_type == 'game' and row.event_name in ('game_complete', 'game_start'):
+            games.add(data['content_id'])
+        elif row.event_type == 'emotional_feedback':
+            emotions[data['emoji']] = emotions.get(data['emoji'], 0) + 1
+    return len(stories), len(games), round(minutes), emotions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark daily report recomputation')
+    parser.add_argument('--days', type=int, default=30, help='Days of synthetic activity')
+    parser.add_argument('--events', type=int, default=480, help='Events per day')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of each implementation (best is reported)')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(directory, 'benchmark.db')}"
+    sys.path.insert(0, ROOT)
+
+    from main import app
+    from db import db
+    from models import Parent, Child, Event, Session
+    import reports
+
+    days = [date(2024, 1, 1) + timedelta(days=i) for i in range(args.days)]
+    with app.app_context():
+        child_id = create_data(db, Parent, Child, Event, Session, days, args.events)
+
+        python_seconds = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            expected = [python_daily_totals(Event, Session, child_id, day) for day in days]
+            python_seconds.append(time.perf_counter() - started)
+            db.session.rollback()
+
+        sql_seconds = []
+        for _ in range(args.repeat):
+            with db.session.no_autoflush:
+                started = time.perf_counter()
+                results = []
+                for day in days:
+                    report = reports.recompute_daily_report(child_id, day)
+                    results.append((report.stories_read, report.games_played, report.time_spent,
+                                    reports.report_counters.load_json(report.emotional_feedback, {})))
+                sql_seconds.append(time.perf_counter() - started)
+            db.session.rollback()
+
+    print(f"{args.days} day(s) x {args.events} event(s)")
+    print(f"Python loops:   {min(python_seconds):.3f}s")
+    print(f"SQL aggregates: {min(sql_seconds):.3f}s")
+    print(f"Results match:  {results == expected}")
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
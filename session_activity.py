@@ -0,0 +1,321 @@
+"""
+Session activity log for Children's Castle application.
+
+Session.record_activity used to rewrite a JSON array in the sessions row on
+every call. Activities are now buffered in memory for the current request and
+handed to a write-behind queue when the request ends, which bulk-inserts the
+activities of many requests into the session_activities table at once. A
+session's buffered activities are written in the caller's transaction when
+the session is closed.
+
+The ID of the user's open session is kept in the Flask session at login, so
+recording a page view needs only a primary key lookup (to check the session
+is still open) and no commit of its own. Activity after the stored session
+was closed (e.g. by logout in another tab) goes to a newly started session.
+Sessions left open (the browser was closed without logging out) are closed at
+their last activity by close_stale_sessions, which also counts them in the
+daily reports.
+"""
+
+import os
+import json
+import logging
+from datetime import datetime, timedelta
+
+from flask import g, has_request_context, request, session, current_app
+from flask_login import current_user
+from sqlalchemy import inspect, func
+
+from db import db
+from models import Session, SessionActivity
+from write_behind import create_queue
+import report_counters
+
+logger = logging.getLogger(__name__)
+
+# Hours without activity after which an open session is considered abandoned
+STALE_SESSION_HOURS = float(os.environ.get('STALE_SESSION_HOURS', 12))
+
+
+def _entry(activity_type, content_id=None, details=None):
+    """Build a session_activities row without its session_id"""
+    return {
+        'activity_type': activity_type,
+        'content_id': str(content_id) if content_id is not None else None,
+        'details': json.dumps(details) if details else None,
+        'occurred_at': datetime.utcnow()
+    }
+
+
+def _session_id(user_session):
+    """Get a session's primary key without triggering a refresh of expired attributes"""
+    if isinstance(user_session, int):
+        return user_session
+    identity = inspect(user_session).identity
+    return identity[0] if identity else None
+
+
+def _user_key():
+    """Identify the logged in user the way sessions are recorded ('child-3', 'guest-1', ...)"""
+    user_type = session.get('user_type')
+    if not user_type or not current_user or not current_user.is_authenticated:
+        return None
+    return f"{user_type}-{current_user.id}"
+
+
+def remember_session(user_session):
+    """Store a newly committed session's ID in the Flask session at login"""
+    session['active_session'] = {
+        'id': user_session.id,
+        'user': f"{user_session.user_type}-{user_session.user_id}"
+    }
+    g.active_session_id = user_session.id
+
+
+def forget_session():
+    """Drop the stored session ID at logout"""
+    session.pop('active_session', None)
+    g.pop('active_session_id', None)
+
+
+def _start_session(user_key):
+    """Open a new session for the logged in user, e.g. after their stored one was closed"""
+    from app import detect_device_type
+    import unit_of_work
+
+    user_type, user_id = user_key.split('-', 1)
+    user_agent = request.user_agent.string
+    user_session = Session(
+        user_type=user_type,
+        user_id=int(user_id),
+        ip_address=request.remote_addr,
+        user_agent=user_agent,
+        device_type=detect_device_type(user_agent)
+    )
+    db.session.add(user_session)
+    # Committed with the request, like the activity that needed the session
+    unit_of_work.commit()
+    record(user_session, 'session_resumed')
+    session['active_session'] = {'id': user_session.id, 'user': user_key}
+    return user_session.id
+
+
+def get_active_session_id(start_new=True):
+    """
+    Get the ID of the current user's open session, or None.
+
+    Resolved once per request: from the Flask session when it was stored at
+    login, otherwise (e.g. cookies from before this was stored) with one
+    query whose result is then stored for later requests. A stored session
+    is checked to still be open with a primary key lookup; if it was closed
+    (or the user has no open session), a new one is started unless
+    start_new is False.
+    """
+    if 'active_session_id' in g:
+        return g.active_session_id
+
+    user_key = _user_key()
+    session_id = None
+    if user_key:
+        stored = session.get('active_session')
+        if stored and stored.get('user') == user_key:
+            row = db.session.query(Session.end_time).filter_by(id=stored['id']).first()
+            if row is not None and row.end_time is None:
+                session_id = stored['id']
+        else:
+            user_type, user_id = user_key.split('-', 1)
+            row = db.session.query(Session.id).filter_by(
+                user_type=user_type,
+                user_id=int(user_id),
+                end_time=None
+            ).order_by(Session.start_time.desc()).first()
+            if row:
+                session_id = row[0]
+                session['active_session'] = {'id': session_id, 'user': user_key}
+
+        if session_id is None:
+            session.pop('active_session', None)
+            if start_new:
+                session_id = _start_session(user_key)
+
+    g.active_session_id = session_id
+    return session_id
+
+
+def get_active_session():
+    """Load the current user's open session (a primary key lookup), or None"""
+    session_id = get_active_session_id(start_new=False)
+    if session_id is None:
+        return None
+    user_session = db.session.get(Session, session_id)
+    if user_session is None or user_session.end_time is not None:
+        forget_session()
+        return None
+    return user_session
+
+
+def _insert(rows):
+    """Insert activity rows in the current transaction with one statement"""
+    if rows:
+        db.session.execute(SessionActivity.__table__.insert(), rows)
+
+
+def record(user_session, activity_type, content_id=None, details=None):
+    """
+    Add an activity to a session's log. user_session is a Session or a session ID.
+
+    Inside a request the activity is buffered until the request ends; outside
+    one it is inserted into the current transaction right away.
+    """
+    entry = _entry(activity_type, content_id, details)
+
+    if has_request_context():
+        g.setdefault('session_activities', []).append((user_session, entry))
+        return
+
+    session_id = _session_id(user_session)
+    if session_id is None:
+        db.session.flush()
+        session_id = user_session.id
+    _insert([dict(entry, session_id=session_id)])
+
+
+def record_current(activity_type, content_id=None, details=None):
+    """Add an activity to the current user's open session, if there is one"""
+    session_id = get_active_session_id()
+    if session_id is not None:
+        record(session_id, activity_type, content_id, details)
+
+
+def _take_buffered(user_session=None):
+    """Remove and return the request's buffered (session, entry) pairs, optionally for one session"""
+    if not has_request_context():
+        return []
+
+    buffered = g.get('session_activities') or []
+    if user_session is None:
+        g.session_activities = []
+        return buffered
+
+    session_id = _session_id(user_session)
+
+    def matches(item):
+        return item[0] is user_session or (session_id is not None and _session_id(item[0]) == session_id)
+
+    taken = [item for item in buffered if matches(item)]
+    g.session_activities = [item for item in buffered if not matches(item)]
+    return taken
+
+
+def flush_session(user_session):
+    """Insert a session's buffered activities into the current transaction (the caller commits)"""
+    taken = _take_buffered(user_session)
+    if not taken:
+        return
+
+    session_id = _session_id(user_session)
+    if session_id is None:
+        db.session.flush()
+        session_id = user_session.id
+    _insert([dict(entry, session_id=session_id) for _, entry in taken])
+
+
+def _write_activities(rows):
+    """Bulk-insert queued activity rows (runs on the write-behind thread)"""
+    # Skip activities of sessions deleted since they were queued
+    session_ids = {row['session_id'] for row in rows}
+    existing = {
+        session_id for (session_id,) in
+        db.session.query(Session.id).filter(Session.id.in_(session_ids))
+    }
+
+    try:
+        _insert([row for row in rows if row['session_id'] in existing])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+activity_queue = create_queue('session-activities', _write_activities)
+
+
+def flush_request(response=None):
+    """Hand the activities buffered during the request to the write-behind queue"""
+    buffered = _take_buffered()
+    if not buffered:
+        return response
+
+    app = current_app._get_current_object()
+    for user_session, entry in buffered:
+        session_id = _session_id(user_session)
+        if session_id is None:
+            # The session was never committed, e.g. the handler failed before its commit
+            logger.warning(f"Dropping {entry['activity_type']} activity of an unsaved session")
+            continue
+        activity_queue.put(dict(entry, session_id=session_id), app=app)
+    return response
+
+
+def get_activities(session_ids):
+    """
+    Get the activity logs of several sessions with one query.
+
+    Returns:
+        dict: session ID -> list of activity dicts, oldest first
+    """
+    session_ids = list(session_ids)
+    activities = {session_id: [] for session_id in session_ids}
+    if not session_ids:
+        return activities
+
+    rows = SessionActivity.query.filter(
+        SessionActivity.session_id.in_(session_ids)
+    ).order_by(SessionActivity.session_id, SessionActivity.occurred_at, SessionActivity.id).all()
+    for row in rows:
+        activities[row.session_id].append(row.to_dict())
+    return activities
+
+
+def legacy_activities(user_session):
+    """Parse a session's legacy JSON activity log"""
+    try:
+        return json.loads(user_session.activities) if user_session.activities else []
+    except (TypeError, ValueError):
+        return []
+
+
+def close_stale_sessions(idle_hours=STALE_SESSION_HOURS, now=None):
+    """
+    Close open sessions with no activity for idle_hours, ending each at its
+    last recorded activity, and count them in the daily reports. Nothing is committed.
+
+    Returns:
+        int: Number of sessions closed
+    """
+    cutoff = (now or datetime.utcnow()) - timedelta(hours=idle_hours)
+    stale = Session.query.filter(Session.end_time.is_(None), Session.start_time < cutoff).all()
+    if not stale:
+        return 0
+
+    last_seen = dict(
+        db.session.query(SessionActivity.session_id, func.max(SessionActivity.occurred_at)).filter(
+            SessionActivity.session_id.in_([user_session.id for user_session in stale])
+        ).group_by(SessionActivity.session_id).all()
+    )
+
+    closed = 0
+    for user_session in stale:
+        ended = max(last_seen.get(user_session.id) or user_session.start_time, user_session.start_time)
+        if ended >= cutoff:
+            continue
+        user_session.end_time = ended
+        user_session.duration = int((ended - user_session.start_time).total_seconds())
+        report_counters.record_session(user_session)
+        closed += 1
+    return closed
+
+
+def init_app(app):
+    """Queue buffered activities at the end of every request"""
+    app.after_request(flush_request)
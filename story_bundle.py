@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+"""
+Packed story bundle for Children's Castle application.
+
+All plain-text books (the .txt files in the project root) and enhanced stories
+(static/stories/*.json) are packed into one indexed file that the server maps
+into memory, so a story or a single page is served by slicing the mapping
+instead of opening and reading a file per request.
+
+Bundle layout:
+    8 bytes   magic (b'CCSTORY1')
+    4 bytes   header length (unsigned, little endian)
+    N bytes   header (UTF-8 JSON index, see build_bundle)
+    ...       UTF-8 story bodies, back to back
+
+Every entry records the modification time of its source file. Stories edited
+at runtime (e.g. by the story enhancement routes or create_story_pages.py) are
+read from disk until the bundle is rebuilt, and a rebuilt bundle file is
+mapped again on the next read, so the bundle never serves an outdated story.
+
+Run this script after adding or editing stories to rebuild the bundle:
+    python story_bundle.py --output story_bundle.bin
+"""
+
+import os
+import io
+import json
+import mmap
+import struct
+import hashlib
+import logging
+import argparse
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Constants
+STORIES_DIR = "static/stories"
+TEXT_STORIES_DIR = "."
+BUNDLE_PATH = os.environ.get('STORY_BUNDLE_PATH', 'story_bundle.bin')
+BUNDLE_MAGIC = b'CCSTORY1'
+BUNDLE_VERSION = 2
+
+# Text files in the project root that are not stories
+NON_STORY_TEXT_FILES = {'requirements.txt'}
+
+_HEADER_LENGTH = struct.Struct('<I')
+
+
+def split_text_pages(text):
+    """
+    Split a plain-text story into pages.
+
+    Returns a list of (start, end) character offsets into text, one per
+    non-empty paragraph.
+    """
+    spans = []
+    position = 0
+    for paragraph in text.split('\n\n'):
+        stripped = paragraph.strip()
+        if stripped:
+            start = position + paragraph.index(stripped)
+            spans.append((start, start + len(stripped)))
+        position += len(paragraph) + 2
+    return spans
+
+
+def combine_enhanced_pages(story_data):
+    """
+    Build the combined text of an enhanced story as served by /api/story/<story_id>.
+
+    Returns the combined text and the (start, end) character offsets of each page's text.
+    """
+    content = story_data.get('title', '')
+    spans = []
+    for i, page in enumerate(story_data.get('pages', [])):
+        content += f"\n\n--- Page {i+1} ---\n\n"
+        start = len(content)
+        content += page.get('text', '')
+        spans.append((start, len(content)))
+    return content, spans
+
+
+def _encode_body(text, spans):
+    """Encode a story body and convert character spans into byte [offset, length] pairs"""
+    body = text.encode('utf-8')
+    pages = []
+    for start, end in spans:
+        byte_start = len(text[:start].encode('utf-8'))
+        byte_length = len(text[start:end].encode('utf-8'))
+        pages.append([byte_start, byte_length])
+    return body, pages
+
+
+def _iter_sources(text_dir, stories_dir):
+    """Yield (kind, story_id, path, body_text, page_spans, meta) for every story on disk"""
+    if os.path.isdir(text_dir):
+        for file_name in sorted(os.listdir(text_dir)):
+            if not file_name.endswith('.txt') or file_name in NON_STORY_TEXT_FILES:
+                continue
+            path = os.path.join(text_dir, file_name)
+            with open(path, 'r') as f:
+                text = f.read()
+            story_id = os.path.splitext(file_name)[0]
+            yield 'text', story_id, path, text, split_text_pages(text), {'file_name': file_name}
+
+    if os.path.isdir(stories_dir):
+        for file_name in sorted(os.listdir(stories_dir)):
+            if not file_name.endswith('.json'):
+                continue
+            path = os.path.join(stories_dir, file_name)
+            try:
+                with open(path, 'r') as f:
+                    story_data = json.load(f)
+            except Exception as e:
+                logger.warning(f"Skipping story file {file_name}: {str(e)}")
+                continue
+
+            story_id = os.path.splitext(file_name)[0]
+            content, spans = combine_enhanced_pages(story_data)
+
+            # Page texts live in the body, everything else stays in the index
+            meta = {key: value for key, value in story_data.items() if key != 'pages'}
+            meta['pages'] = [
+                {key: value for key, value in page.items() if key != 'text'}
+                for page in story_data.get('pages', [])
+            ]
+            yield 'enhanced', story_id, path, content, spans, meta
+
+
+def build_bundle(output_path=BUNDLE_PATH, text_dir=TEXT_STORIES_DIR, stories_dir=STORIES_DIR):
+    """
+    Pack all stories into a bundle file.
+
+    The header is a JSON object of the form
+        {"version": 2, "stories": {"text": {...}, "enhanced": {...}}}
+    where every story entry holds the byte offset (relative to the end of the
+    header) and length of its body, the [offset, length] of each page relative
+    to the body, a SHA-1 of the body, the path and modification time of its
+    source file and the story metadata.
+
+    Returns:
+        dict: Number of stories packed per kind
+    """
+    index = {'text': {}, 'enhanced': {}}
+    bodies = io.BytesIO()
+
+    for kind, story_id, path, text, spans, meta in _iter_sources(text_dir, stories_dir):
+        body, pages = _encode_body(text, spans)
+        index[kind][story_id] = {
+            'offset': bodies.tell(),
+            'length': len(body),
+            'pages': pages,
+            'sha1': hashlib.sha1(body).hexdigest(),
+            'source': path,
+            'mtime': os.stat(path).st_mtime,
+            'meta': meta
+        }
+        bodies.write(body)
+
+    header = {'version': BUNDLE_VERSION, 'stories': index}
+    header_bytes = json.dumps(header, separators=(',', ':')).encode('utf-8')
+
+    # Write to a temporary file first so running servers never map a half-written bundle
+    tmp_path = f"{output_path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(BUNDLE_MAGIC)
+        f.write(_HEADER_LENGTH.pack(len(header_bytes)))
+        f.write(header_bytes)
+        f.write(bodies.getvalue())
+    os.replace(tmp_path, output_path)
+
+    return {kind: len(entries) for kind, entries in index.items()}
+
+
+class StoryBundle:
+    """Read-only, memory-mapped view of a story bundle file"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._map[:len(BUNDLE_MAGIC)] != BUNDLE_MAGIC:
+            self._map.close()
+            raise ValueError(f"{path} is not a story bundle")
+
+        header_start = len(BUNDLE_MAGIC) + _HEADER_LENGTH.size
+        (header_length,) = _HEADER_LENGTH.unpack_from(self._map, len(BUNDLE_MAGIC))
+        header = json.loads(self._map[header_start:header_start + header_length])
+        if header.get('version') != BUNDLE_VERSION:
+            self._map.close()
+            raise ValueError(f"Unsupported story bundle version: {header.get('version')}")
+
+        self._view = memoryview(self._map)
+        self._data_start = header_start + header_length
+        self._stories = header['stories']
+
+    def get_entry(self, kind, story_id):
+        """Get the index entry of a story, or None if it is not in the bundle"""
+        return self._stories.get(kind, {}).get(story_id)
+
+    def get_fresh_entry(self, kind, story_id):
+        """Get the index entry of a story, or None if it is not in the bundle or its source file changed since"""
+        entry = self.get_entry(kind, story_id)
+        if entry is None:
+            return None
+        try:
+            if os.stat(entry['source']).st_mtime != entry['mtime']:
+                return None
+        except FileNotFoundError:
+            pass  # Deployed without the source files; the bundle is all there is
+        return entry
+
+    def story_ids(self, kind):
+        """Get the IDs of all stories of the given kind"""
+        return list(self._stories.get(kind, {}))
+
+    def get_bytes(self, kind, story_id):
+        """Get the UTF-8 body of a story as a zero-copy memoryview, or None"""
+        entry = self.get_entry(kind, story_id)
+        if not entry:
+            return None
+        start = self._data_start + entry['offset']
+        return self._view[start:start + entry['length']]
+
+    def get_page_bytes(self, kind, story_id, page_index):
+        """Get the UTF-8 text of one page (0-based) as a zero-copy memoryview, or None"""
+        entry = self.get_entry(kind, story_id)
+        if not entry or not 0 <= page_index < len(entry['pages']):
+            return None
+        page_offset, page_length = entry['pages'][page_index]
+        start = self._data_start + entry['offset'] + page_offset
+        return self._view[start:start + page_length]
+
+    def get_text(self, kind, story_id):
+        """Get the body of a story as a string, or None"""
+        if self.get_fresh_entry(kind, story_id) is None:
+            return None
+        body = self.get_bytes(kind, story_id)
+        return str(body, 'utf-8') if body is not None else None
+
+    def get_page_text(self, kind, story_id, page_index):
+        """Get the text of one page (0-based) as a string, or None"""
+        page = self.get_page_bytes(kind, story_id, page_index)
+        return str(page, 'utf-8') if page is not None else None
+
+    def get_enhanced_story(self, story_id):
+        """Rebuild the story JSON document of an enhanced story, or None"""
+        entry = self.get_fresh_entry('enhanced', story_id)
+        if not entry:
+            return None
+
+        story_data = dict(entry['meta'])
+        story_data['pages'] = [
+            dict(page, text=self.get_page_text('enhanced', story_id, i))
+            for i, page in enumerate(entry['meta']['pages'])
+        ]
+        return story_data
+
+    def close(self):
+        """Release the memory mapping"""
+        self._view.release()
+        self._map.close()
+
+
+_bundle = None
+_bundle_stat = None  # (inode, mtime) of the mapped bundle file, None if there is none
+_bundle_lock = threading.Lock()
+
+
+def _stat_key(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime
+
+
+def get_bundle():
+    """
+    Get the process-wide story bundle, or None if no bundle file has been built.
+
+    The bundle is mapped again when its file was replaced (build_bundle
+    renames a new file into place).
+    """
+    global _bundle, _bundle_stat
+
+    stat_key = _stat_key(BUNDLE_PATH)
+    if stat_key != _bundle_stat:
+        with _bundle_lock:
+            if stat_key != _bundle_stat:
+                # The old mapping is left to the garbage collector, readers may still hold slices of it
+                _bundle = None
+                if stat_key is not None:
+                    try:
+                        _bundle = StoryBundle(BUNDLE_PATH)
+                        logger.info(f"Loaded story bundle from {BUNDLE_PATH}")
+                    except Exception as e:
+                        logger.error(f"Error loading story bundle {BUNDLE_PATH}: {str(e)}")
+                _bundle_stat = stat_key
+
+    return _bundle
+
+
+def story_revision(story_id):
+    """
+    Revision of a story for cache keys: changes whenever its text or enhanced
+    source file is edited, or (without source files) the bundle is rebuilt.
+    """
+    revision = []
+    for kind, path in (('text', os.path.join(TEXT_STORIES_DIR, f"{story_id}.txt")),
+                       ('enhanced', os.path.join(STORIES_DIR, f"{story_id}.json"))):
+        try:
+            revision.append(os.stat(path).st_mtime)
+        except FileNotFoundError:
+            bundle = get_bundle()
+            entry = bundle.get_entry(kind, story_id) if bundle else None
+            revision.append(entry['sha1'] if entry else None)
+    return tuple(revision)
+
+
+def read_story_text(file_name):
+    """
+    Get the text of a plain-text story file, from the bundle when possible.
+
+    Returns None if the story is neither in the bundle nor on disk.
+    """
+    bundle = get_bundle()
+    if bundle:
+        text = bundle.get_text('text', os.path.splitext(file_name)[0])
+        if text is not None:
+            return text
+
+    path = os.path.join(TEXT_STORIES_DIR, file_name)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return f.read()
+
+
+def read_enhanced_story(story_id):
+    """
+    Get the story JSON document of an enhanced story, from the bundle when possible.
+
+    Returns None if the story is neither in the bundle nor on disk.
+    """
+    bundle = get_bundle()
+    if bundle:
+        story_data = bundle.get_enhanced_story(story_id)
+        if story_data is not None:
+            return story_data
+
+    path = os.path.join(STORIES_DIR, f"{story_id}.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def read_story_page(story_id, page_index):
+    """
+    Get one page (0-based) of a story, from the bundle when possible.
+
+    Enhanced stories are preferred since their pages carry images and audio;
+    plain-text stories fall back to one page per paragraph.
+
+    Returns:
+        tuple: (page, page_count, story_meta) where page is a dict with the
+        page text and media (None if page_index is out of range), or None if
+        the story doesn't exist
+    """
+    bundle = get_bundle()
+    if bundle:
+        # Only the requested page is decoded, whatever the length of the story
+        entry = bundle.get_fresh_entry('enhanced', story_id)
+        if entry:
+            meta = {key: value for key, value in entry['meta'].items() if key != 'pages'}
+            page_count = len(entry['pages'])
+            if not 0 <= page_index < page_count:
+                return None, page_count, meta
+            page = dict(entry['meta']['pages'][page_index])
+            page['text'] = bundle.get_page_text('enhanced', story_id, page_index)
+            return page, page_count, meta
+
+        # A text story only stands in for a story that has no enhanced version on disk
+        entry = bundle.get_fresh_entry('text', story_id)
+        if entry and not os.path.exists(os.path.join(STORIES_DIR, f"{story_id}.json")):
+            page_count = len(entry['pages'])
+            if not 0 <= page_index < page_count:
+                return None, page_count, {}
+            return {'text': bundle.get_page_text('text', story_id, page_index)}, page_count, {}
+
+    path = os.path.join(STORIES_DIR, f"{story_id}.json")
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            story_data = json.load(f)
+        pages = story_data.get('pages', [])
+        meta = {key: value for key, value in story_data.items() if key != 'pages'}
+        if not 0 <= page_index < len(pages):
+            return None, len(pages), meta
+        return dict(pages[page_index]), len(pages), meta
+
+    text = read_story_text(f"{story_id}.txt")
+    if text is None:
+        return None
+    spans = split_text_pages(text)
+    if not 0 <= page_index < len(spans):
+        return None, len(spans), {}
+    start, end = spans[page_index]
+    return {'text': text[start:end]}, len(spans), {}
+
+
+def main():
+    """Main function to parse arguments and build the bundle"""
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description='Pack all stories into a memory-mappable bundle')
+    parser.add_argument('--output', type=str, default=BUNDLE_PATH, help='Path of the bundle file to write')
+    parser.add_argument('--text-dir', type=str, default=TEXT_STORIES_DIR, help='Directory with .txt stories')
+    parser.add_argument('--stories-dir', type=str, default=STORIES_DIR, help='Directory with enhanced story JSON files')
+
+    args = parser.parse_args()
+
+    counts = build_bundle(args.output, args.text_dir, args.stories_dir)
+    logger.info(f"Packed {counts['text']} text stories and {counts['enhanced']} enhanced stories into {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Story catalog index for Children's Castle application.
+Keeps a process-wide summary of the enhanced story JSON files so the story
+shelf can be rendered without reading the stories directory on every request.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Constants
+STORIES_DIR = "static/stories"
+
+# Minimum number of seconds between two scans of the stories directory
+CATALOG_CHECK_INTERVAL = float(os.environ.get('STORY_CATALOG_CHECK_INTERVAL', 30))
+
+_lock = threading.Lock()
+_entries = {}  # story_id -> summary dict
+_signatures = {}  # story_id -> (mtime_ns, size) of the file the summary was built from
+_last_scan = None
+
+
+def _summarize(story_id, story_data):
+    """Build the catalog entry for a parsed story JSON document"""
+    pages = story_data.get('pages', [])
+
+    return {
+        'id': story_id,
+        'title': story_data.get('title', f"Story {story_id}"),
+        'pages': len(pages),
+        'has_audio': all('audio' in page and page['audio'] for page in pages)
+    }
+
+
+def refresh(force=False):
+    """
+    Re-scan the stories directory and update the index.
+
+    Only files whose modification time or size changed since the last scan are
+    parsed again. Unless force is True, scans are throttled to one every
+    CATALOG_CHECK_INTERVAL seconds.
+    """
+    global _last_scan
+
+    with _lock:
+        now = time.monotonic()
+        if not force and _last_scan is not None and now - _last_scan < CATALOG_CHECK_INTERVAL:
+            return
+        _last_scan = now
+
+        if not os.path.isdir(STORIES_DIR):
+            _entries.clear()
+            _signatures.clear()
+            return
+
+        seen = set()
+        with os.scandir(STORIES_DIR) as it:
+            for entry in it:
+                if not entry.name.endswith('.json') or not entry.is_file():
+                    continue
+
+                story_id = os.path.splitext(entry.name)[0]
+                seen.add(story_id)
+
+                stat = entry.stat()
+                signature = (stat.st_mtime_ns, stat.st_size)
+                if _signatures.get(story_id) == signature:
+                    continue
+
+                try:
+                    with open(entry.path, 'r') as f:
+                        story_data = json.load(f)
+                    _entries[story_id] = _summarize(story_id, story_data)
+                    _signatures[story_id] = signature
+                except Exception as e:
+                    logger.warning(f"Error reading story file {entry.name}: {str(e)}")
+                    _entries.pop(story_id, None)
+                    _signatures.pop(story_id, None)
+
+        # Drop stories whose files were removed
+        for story_id in set(_entries) - seen:
+            del _entries[story_id]
+            _signatures.pop(story_id, None)
+
+
+def get_enhanced_stories():
+    """Get the summaries of all enhanced stories, sorted by story ID"""
+    refresh()
+    with _lock:
+        return [dict(_entries[story_id]) for story_id in sorted(_entries)]
+
+
+def get_story_summary(story_id):
+    """Get the summary of a single enhanced story, or None if it is not in the catalog"""
+    refresh()
+    with _lock:
+        entry = _entries.get(story_id)
+        return dict(entry) if entry else None
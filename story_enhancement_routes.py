@@ -13,6 +13,9 @@ from flask import (
 from flask_login import login_required, current_user
 from werkzeug.utils import secure_filename
 from models import db, Progress, Child
+import story_catalog
+import tracking
+import story_bundle
 from generate_elevenlabs_audio import (
     initialize_elevenlabs, 
     generate_audio_for_text,
@@ -39,16 +42,13 @@ def story_preview(story_id):
     # Sanitize the story_id to prevent path traversal
     story_id = secure_filename(story_id)
     
-    # Load the story data
-    story_path = os.path.join(STORIES_DIR, f"{story_id}.json")
-    
-    if not os.path.exists(story_path):
-        flash("Story not found", "error")
-        return redirect(url_for('story_mode'))
-    
     try:
-        with open(story_path, 'r') as f:
-            story = json.load(f)
+        # Load the story data from the story bundle (or the JSON file if it isn't bundled)
+        story = story_bundle.read_enhanced_story(story_id)
+        
+        if story is None:
+            flash("Story not found", "error")
+            return redirect(url_for('story_mode'))
             
         # Render the preview template
         return render_template('story_preview.html', 
@@ -64,31 +64,7 @@ def story_preview(story_id):
 def available_stories():
     """Get a list of available enhanced stories"""
     try:
-        if not os.path.exists(STORIES_DIR):
-            return jsonify([])
-        
-        stories = []
-        for file in os.listdir(STORIES_DIR):
-            if file.endswith('.json'):
-                story_id = os.path.splitext(file)[0]
-                
-                # Load the story data
-                try:
-                    with open(os.path.join(STORIES_DIR, file), 'r') as f:
-                        story_data = json.load(f)
-                        
-                    # Check if the story has audio files
-                    has_audio = all('audio' in page and page['audio'] 
-                                    for page in story_data.get('pages', []))
-                    
-                    stories.append({
-                        'id': story_id,
-                        'title': story_data.get('title', f"Story {story_id}"),
-                        'pages': len(story_data.get('pages', [])),
-                        'has_audio': has_audio
-                    })
-                except Exception as e:
-                    logger.warning(f"Error reading story file {file}: {str(e)}")
+        stories = story_catalog.get_enhanced_stories()
         
         return jsonify(stories)
     except Exception as e:
@@ -215,7 +191,7 @@ def run_enhancement():
 @login_required
 def track_enhanced_story():
     """Track child's progress with enhanced stories"""
-    if not hasattr(current_user, 'type') or current_user.type != 'child':
+    if not isinstance(current_user, Child):
         return jsonify({
             'success': False,
             'error': 'Only child users can track story progress'
@@ -244,19 +220,18 @@ def track_enhanced_story():
                 story_data = json.load(f)
                 story_title = story_data.get('title', story_title)
         
-        # Create a progress record
-        progress = Progress(
-            child_id=current_user.id,
-            content_type='enhanced_story',
-            content_id=story_id,
-            content_title=story_title,
-            page_number=page_number,
-            completed=completed,
-            time_spent=time_spent
+        # Record the progress through the shared upsert
+        result = tracking.track_progress(
+            current_user.id, 'enhanced_story', story_id, story_title,
+            time_spent=time_spent,
+            pages_read=page_number,
+            completions=1 if completed else 0
         )
-        
-        db.session.add(progress)
-        db.session.commit()
+        if not result.get('success'):
+            return jsonify({
+                'success': False,
+                'error': result.get('message')
+            })
         
         return jsonify({
             'success': True,
@@ -0,0 +1,191 @@
+"""
+Story pagination engine for Children's Castle application.
+
+Segments story text into sentences once, caching the sentence boundaries by
+content hash, and lays the sentences out into pages either as a fixed number
+of balanced pages or against a target reading time for the reader's age.
+Pages are slices of the original text, so punctuation and quotes survive.
+"""
+
+import re
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Maximum number of segmented texts kept in memory
+MAX_CACHED_TEXTS = 1024
+
+# Default reader age when none is known (matches the story mode default)
+DEFAULT_AGE = 4
+
+# Reading profiles as (max_age, words_per_minute, target_seconds_per_page),
+# youngest first. Younger readers get slower narration and shorter pages.
+READING_PROFILES = [
+    (3, 80, 15),
+    (5, 100, 20),
+    (7, 120, 30),
+    (9, 150, 45),
+    (None, 180, 60)
+]
+
+# Words that end with a period without ending the sentence
+ABBREVIATIONS = {'mr', 'mrs', 'ms', 'dr', 'st', 'mt', 'prof', 'sr', 'jr', 'vs', 'etc', 'e.g', 'i.e'}
+
+# A run of terminal punctuation with any closing quotes/brackets, or a blank line
+_BOUNDARY = re.compile(
+    r'(?P<terminal>[.!?…]+["\'”’)\]]*)(?=\s|$)|(?P<paragraph>\n[ \t]*\n)'
+)
+_WORD = re.compile(r"\w+(?:['’]\w+)*")
+_LAST_WORD = re.compile(r'([\w.]+)$')
+
+_lock = threading.Lock()
+_cache = OrderedDict()  # sha1 of text -> tuple of (start, end, word_count)
+
+
+def _segment(text):
+    """Find the (start, end, word_count) of every sentence in text"""
+    sentences = []
+
+    def add(start, end):
+        while start < end and text[start].isspace():
+            start += 1
+        while end > start and text[end - 1].isspace():
+            end -= 1
+        if start < end:
+            sentences.append((start, end, len(_WORD.findall(text, start, end))))
+
+    start = 0
+    for match in _BOUNDARY.finditer(text):
+        if match.group('paragraph'):
+            add(start, match.start())
+            start = match.end()
+            continue
+
+        # "Mr. Fox" and "J. Bear" don't end a sentence
+        if match.group('terminal') == '.':
+            last_word = _LAST_WORD.search(text, start, match.start())
+            if last_word:
+                word = last_word.group(1).lower()
+                if word in ABBREVIATIONS or (len(word) == 1 and word.isalpha()):
+                    continue
+
+        add(start, match.end())
+        start = match.end()
+
+    add(start, len(text))
+    return tuple(sentences)
+
+
+def segment_sentences(text):
+    """
+    Get the sentence boundaries of a text, cached by content hash.
+
+    Returns:
+        tuple: (start, end, word_count) for each sentence
+    """
+    key = hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    with _lock:
+        sentences = _cache.get(key)
+        if sentences is not None:
+            _cache.move_to_end(key)
+            return sentences
+
+    sentences = _segment(text)
+
+    with _lock:
+        _cache[key] = sentences
+        while len(_cache) > MAX_CACHED_TEXTS:
+            _cache.popitem(last=False)
+    return sentences
+
+
+def reading_profile(age=None):
+    """Get (words_per_minute, target_seconds_per_page) for a reader's age"""
+    if age is None:
+        age = DEFAULT_AGE
+    for max_age, words_per_minute, page_seconds in READING_PROFILES:
+        if max_age is None or age <= max_age:
+            return words_per_minute, page_seconds
+
+
+def count_words(text):
+    """Count the words of a text using the cached segmentation"""
+    return sum(words for _, _, words in segment_sentences(text))
+
+
+def estimate_reading_time_minutes(text, age=None):
+    """Estimate how many minutes reading a text takes for a reader's age (at least 1)"""
+    words_per_minute, _ = reading_profile(age)
+    return max(1, round(count_words(text) / words_per_minute))
+
+
+def _balanced_groups(sentences, pages):
+    """Split sentences into the given number of pages with similar word counts"""
+    page_count = min(pages, len(sentences))
+    total_words = sum(words for _, _, words in sentences) or len(sentences)
+
+    groups = []
+    current = []
+    words_so_far = 0
+    for i, sentence in enumerate(sentences):
+        current.append(sentence)
+        words_so_far += sentence[2] or 1
+
+        remaining_sentences = len(sentences) - i - 1
+        remaining_pages = page_count - len(groups) - 1
+        # Close the page once it reaches its share of the words, keeping a sentence for every page left
+        target = total_words * (len(groups) + 1) / page_count
+        if remaining_pages and (words_so_far >= target or remaining_sentences == remaining_pages):
+            groups.append(current)
+            current = []
+
+    if current:
+        groups.append(current)
+    return groups
+
+
+def _timed_groups(sentences, words_per_page):
+    """Fill pages with whole sentences up to a word budget"""
+    groups = []
+    current = []
+    current_words = 0
+    for sentence in sentences:
+        if current and current_words + sentence[2] > words_per_page:
+            groups.append(current)
+            current = []
+            current_words = 0
+        current.append(sentence)
+        current_words += sentence[2]
+
+    if current:
+        groups.append(current)
+    return groups
+
+
+def paginate(text, pages=None, age=None, target_seconds=None):
+    """
+    Lay out a story's text into pages.
+
+    Args:
+        text (str): The full story text
+        pages (int): Exact number of balanced pages (fewer if there aren't enough sentences)
+        age (int): Reader age used to pick the reading speed and page length
+        target_seconds (int): Reading time per page, overrides the age default
+
+    Returns:
+        list: The text of each page
+    """
+    sentences = segment_sentences(text)
+    if not sentences:
+        return []
+
+    if pages:
+        groups = _balanced_groups(sentences, pages)
+    else:
+        words_per_minute, page_seconds = reading_profile(age)
+        words_per_page = max(1, words_per_minute * (target_seconds or page_seconds) // 60)
+        groups = _timed_groups(sentences, words_per_page)
+
+    # Each page is one slice of the original text, from its first sentence to its last
+    return [text[group[0][0]:group[-1][1]] for group in groups]
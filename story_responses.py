@@ -0,0 +1,90 @@
+"""
+Story response cache for Children's Castle application.
+Serializes and compresses each story payload once, then serves it with a
+content-hash ETag so repeat readers get a 304 or a pre-compressed body.
+"""
+
+import gzip
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+import brotli
+from flask import Response, request
+
+# Maximum number of story payloads kept in memory
+MAX_CACHED_STORIES = 512
+
+_lock = threading.Lock()
+_cache = OrderedDict()  # cache key -> CachedStory
+
+
+class CachedStory:
+    """A serialized story payload with its pre-compressed variants"""
+
+    def __init__(self, payload, last_modified=None, links=None):
+        self.title = payload.get('title')
+        self.last_modified = last_modified or datetime.utcnow()
+        self.links = list(links or [])
+        self.bodies = {'identity': json.dumps(payload).encode('utf-8')}
+        self.bodies['gzip'] = gzip.compress(self.bodies['identity'], compresslevel=9)
+        self.bodies['br'] = brotli.compress(self.bodies['identity'])
+        self.etag = hashlib.sha1(self.bodies['identity']).hexdigest()
+
+    def choose_encoding(self):
+        """Pick the best encoding the client accepts"""
+        return request.accept_encodings.best_match(
+            ['br', 'gzip'],
+            default='identity'
+        )
+
+
+def get(key):
+    """Get a cached story payload, or None if it hasn't been built yet"""
+    with _lock:
+        cached = _cache.get(key)
+        if cached is not None:
+            _cache.move_to_end(key)
+        return cached
+
+
+def store(key, payload, last_modified=None, links=None):
+    """
+    Serialize, compress and cache a story payload.
+    links are Link header values (e.g. preload hints) sent with every response.
+    """
+    cached = CachedStory(payload, last_modified, links)
+    with _lock:
+        _cache[key] = cached
+        _cache.move_to_end(key)
+        while len(_cache) > MAX_CACHED_STORIES:
+            _cache.popitem(last=False)
+    return cached
+
+
+def respond(cached):
+    """
+    Build the response for a cached story.
+
+    Returns 304 when the client's If-None-Match or If-Modified-Since matches,
+    otherwise the body in the best encoding the client accepts.
+    """
+    encoding = cached.choose_encoding()
+    response = Response(cached.bodies[encoding], mimetype='application/json')
+
+    # Each encoding is a different representation, so it gets its own strong ETag
+    if encoding == 'identity':
+        response.set_etag(cached.etag)
+    else:
+        response.set_etag(f"{cached.etag}-{encoding}")
+        response.headers['Content-Encoding'] = encoding
+
+    response.last_modified = cached.last_modified
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'private, no-cache'
+    if cached.links:
+        response.headers['Link'] = ', '.join(cached.links)
+
+    return response.make_conditional(request)
@@ -0,0 +1,396 @@
+"""
+Story search index for Children's Castle application.
+
+Books and enhanced stories are indexed by title, description, themes and
+full story text in a single search table:
+    - SQLite: an FTS5 virtual table ranked with bm25()
+    - PostgreSQL: a table with a weighted tsvector column and a GIN index
+
+Facet columns (age group, difficulty) are stored next to each document so a
+search and its facet counts come from one indexed query.
+
+Books are re-indexed when a transaction that writes them commits. Rebuild
+the index after adding or changing story files:
+    flask database build-search-index
+"""
+
+import re
+import json
+import logging
+
+from sqlalchemy import bindparam, event, text
+
+from db import db
+from models import AgeGroup, Book
+import story_bundle
+import story_catalog
+
+logger = logging.getLogger(__name__)
+
+# Name of the search table
+SEARCH_TABLE = "story_search"
+
+# Relative weights of the title, description, themes and content columns in SQLite's bm25()
+SQLITE_COLUMN_WEIGHTS = (10.0, 3.0, 5.0, 1.0)
+
+_SQLITE_SCHEMA = f"""
+CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5(
+    doc_id UNINDEXED,
+    kind UNINDEXED,
+    book_id UNINDEXED,
+    story_id UNINDEXED,
+    title,
+    description,
+    themes,
+    content,
+    age_group_id UNINDEXED,
+    age_group_name UNINDEXED,
+    difficulty_level UNINDEXED,
+    tokenize = 'porter unicode61'
+)
+"""
+
+_POSTGRES_SCHEMA = [
+    f"""
+    CREATE TABLE IF NOT EXISTS {SEARCH_TABLE} (
+        doc_id VARCHAR(160) PRIMARY KEY,
+        kind VARCHAR(16) NOT NULL,
+        book_id INTEGER,
+        story_id VARCHAR(128),
+        title TEXT,
+        description TEXT,
+        themes TEXT,
+        content TEXT,
+        age_group_id INTEGER,
+        age_group_name VARCHAR(64),
+        difficulty_level VARCHAR(32),
+        document TSVECTOR
+    )
+    """,
+    f"CREATE INDEX IF NOT EXISTS ix_{SEARCH_TABLE}_document ON {SEARCH_TABLE} USING GIN (document)"
+]
+
+_POSTGRES_DOCUMENT = """
+    setweight(to_tsvector('english', coalesce(:title, '')), 'A') ||
+    setweight(to_tsvector('english', coalesce(:themes, '')), 'B') ||
+    setweight(to_tsvector('english', coalesce(:description, '')), 'B') ||
+    setweight(to_tsvector('english', coalesce(:content, '')), 'C')
+"""
+
+_COLUMNS = [
+    'doc_id', 'kind', 'book_id', 'story_id', 'title', 'description', 'themes',
+    'content', 'age_group_id', 'age_group_name', 'difficulty_level'
+]
+
+
+def _dialect():
+    """Get the name of the configured database dialect"""
+    return db.engine.dialect.name
+
+
+def _search_terms(query):
+    """Split a user query into lowercase word tokens"""
+    return re.findall(r'\w+', query.lower())
+
+
+def _theme_list(themes):
+    """Parse a JSON themes column into a list"""
+    try:
+        return json.loads(themes) if themes else []
+    except (TypeError, ValueError):
+        return []
+
+
+def _book_document(book, age_group):
+    """Build the search document of a book"""
+    story_id = book.file_name.rsplit('.', 1)[0]
+    content = story_bundle.read_story_text(book.file_name) or ''
+    story_data = story_bundle.read_enhanced_story(story_id)
+    if story_data:
+        content += '\n\n' + '\n\n'.join(page.get('text', '') for page in story_data.get('pages', []))
+
+    return {
+        'doc_id': f"book:{book.id}",
+        'kind': 'book',
+        'book_id': book.id,
+        'story_id': story_id,
+        'title': book.title,
+        'description': book.description or '',
+        'themes': json.dumps(_theme_list(book.themes)),
+        'content': content,
+        'age_group_id': age_group.id,
+        'age_group_name': age_group.name,
+        'difficulty_level': book.difficulty_level
+    }
+
+
+def iter_documents():
+    """Yield a search document dict for every book and enhanced story"""
+    book_story_ids = set()
+
+    books = db.session.query(Book, AgeGroup).join(AgeGroup, Book.age_group_id == AgeGroup.id).all()
+    for book, age_group in books:
+        book_story_ids.add(book.file_name.rsplit('.', 1)[0])
+        yield _book_document(book, age_group)
+
+    # Enhanced stories without a book record are searchable too, without facets
+    for summary in story_catalog.get_enhanced_stories():
+        if summary['id'] in book_story_ids:
+            continue
+        story_data = story_bundle.read_enhanced_story(summary['id'])
+        if not story_data:
+            continue
+
+        yield {
+            'doc_id': f"story:{summary['id']}",
+            'kind': 'story',
+            'book_id': None,
+            'story_id': summary['id'],
+            'title': summary['title'],
+            'description': story_data.get('description', ''),
+            'themes': json.dumps(story_data.get('themes', [])),
+            'content': '\n\n'.join(page.get('text', '') for page in story_data.get('pages', [])),
+            'age_group_id': None,
+            'age_group_name': None,
+            'difficulty_level': None
+        }
+
+
+def create_index():
+    """Create the search table if it doesn't exist"""
+    dialect = _dialect()
+    if dialect == 'sqlite':
+        db.session.execute(text(_SQLITE_SCHEMA))
+    elif dialect == 'postgresql':
+        for statement in _POSTGRES_SCHEMA:
+            db.session.execute(text(statement))
+    else:
+        raise RuntimeError(f"Story search is not supported on {dialect}")
+    db.session.commit()
+
+
+def _insert_statement():
+    """Get the INSERT statement of a search document"""
+    column_list = ', '.join(_COLUMNS)
+    placeholders = ', '.join(f":{column}" for column in _COLUMNS)
+    if _dialect() == 'postgresql':
+        return text(
+            f"INSERT INTO {SEARCH_TABLE} ({column_list}, document) "
+            f"VALUES ({placeholders}, {_POSTGRES_DOCUMENT})"
+        )
+    return text(f"INSERT INTO {SEARCH_TABLE} ({column_list}) VALUES ({placeholders})")
+
+
+def build_index():
+    """
+    Rebuild the search index from the books table and story files.
+
+    Returns:
+        int: Number of indexed documents
+    """
+    create_index()
+    documents = list(iter_documents())
+
+    try:
+        db.session.execute(text(f"DELETE FROM {SEARCH_TABLE}"))
+        if documents:
+            db.session.execute(_insert_statement(), documents)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    logger.info(f"Indexed {len(documents)} documents for story search")
+    return len(documents)
+
+
+def index_exists():
+    """Check whether the search table has been created"""
+    from sqlalchemy import inspect
+    return inspect(db.engine).has_table(SEARCH_TABLE)
+
+
+_index_ready = False
+
+
+def refresh_books(book_ids):
+    """
+    Re-index some books in the current transaction (deleted books are removed).
+
+    Enhanced stories without a book record are only picked up by build_index.
+    """
+    book_ids = list(book_ids)
+    if not book_ids:
+        return
+    db.session.execute(
+        text(f"DELETE FROM {SEARCH_TABLE} WHERE doc_id IN :doc_ids").bindparams(bindparam('doc_ids', expanding=True)),
+        {'doc_ids': [f"book:{book_id}" for book_id in book_ids]}
+    )
+    books = db.session.query(Book, AgeGroup).join(AgeGroup, Book.age_group_id == AgeGroup.id).filter(
+        Book.id.in_(book_ids)
+    ).all()
+    documents = [_book_document(book, age_group) for book, age_group in books]
+    if documents:
+        # The story of a book replaces its book-less story document
+        db.session.execute(
+            text(f"DELETE FROM {SEARCH_TABLE} WHERE doc_id IN :doc_ids").bindparams(bindparam('doc_ids', expanding=True)),
+            {'doc_ids': [f"story:{document['story_id']}" for document in documents]}
+        )
+        db.session.execute(_insert_statement(), documents)
+
+
+def _after_flush(session, flush_context):
+    """Remember the books a transaction writes, to re-index them when it commits"""
+    book_ids = {
+        obj.id for obj in list(session.new) + list(session.dirty) + list(session.deleted)
+        if isinstance(obj, Book) and obj.id is not None
+    }
+    if book_ids:
+        session.info.setdefault('search_books', set()).update(book_ids)
+
+
+def _before_commit(session):
+    """Re-index the written books in the committing transaction"""
+    # Commit flushes anyway; flushing first collects the books it writes
+    session.flush()
+    book_ids = session.info.pop('search_books', None)
+    if book_ids and (_index_ready or index_exists()):
+        refresh_books(book_ids)
+        session.flush()
+
+
+def _after_rollback(session):
+    session.info.pop('search_books', None)
+
+
+event.listen(db.session, 'after_flush', _after_flush)
+event.listen(db.session, 'before_commit', _before_commit)
+event.listen(db.session, 'after_rollback', _after_rollback)
+
+
+def _ensure_index():
+    """Build the index on first use if it has never been built"""
+    global _index_ready
+    if not _index_ready:
+        if not index_exists():
+            build_index()
+        _index_ready = True
+
+
+def _match_clause(terms):
+    """Get the WHERE clause and parameters matching every term of a query"""
+    if _dialect() == 'postgresql':
+        # Prefix-match every term so partial words typed by parents still hit
+        ts_query = ' & '.join(f"{term}:*" for term in terms)
+        return "document @@ to_tsquery('english', :query)", {'query': ts_query}
+    fts_query = ' '.join(f'"{term}"*' for term in terms)
+    return f"{SEARCH_TABLE} MATCH :query", {'query': fts_query}
+
+
+def _filter_clause(age_group_id=None, difficulty_level=None, theme=None):
+    """Get the SQL conditions and parameters of the age group, difficulty and theme filters"""
+    conditions = []
+    params = {}
+    if age_group_id is not None:
+        conditions.append("age_group_id = :age_group_id")
+        params['age_group_id'] = age_group_id
+    if difficulty_level:
+        conditions.append("difficulty_level = :difficulty_level")
+        params['difficulty_level'] = difficulty_level
+    if theme:
+        if _dialect() == 'postgresql':
+            conditions.append("themes::jsonb ? :theme")
+        else:
+            conditions.append(f"EXISTS (SELECT 1 FROM json_each({SEARCH_TABLE}.themes) WHERE value = :theme)")
+        params['theme'] = theme
+    return ''.join(f" AND {condition}" for condition in conditions), params
+
+
+def _rank_expression():
+    """Get the SQL relevance expression of a match; higher ranks first"""
+    if _dialect() == 'postgresql':
+        return "ts_rank(document, to_tsquery('english', :query))"
+    # bm25() takes one weight per column, unindexed columns included; lower scores rank higher
+    weights = dict(zip(('title', 'description', 'themes', 'content'), SQLITE_COLUMN_WEIGHTS))
+    bm25_weights = ', '.join(str(weights.get(column, 0.0)) for column in _COLUMNS)
+    return f"-bm25({SEARCH_TABLE}, {bm25_weights})"
+
+
+def _facets(match, params):
+    """Count the age groups, difficulty levels and themes of all matches with GROUP BY"""
+    age_groups = db.session.execute(text(
+        f"SELECT age_group_id, age_group_name, COUNT(*) AS count FROM {SEARCH_TABLE} "
+        f"WHERE {match} AND age_group_id IS NOT NULL "
+        f"GROUP BY age_group_id, age_group_name ORDER BY count DESC, age_group_id"
+    ), params).all()
+    difficulty_levels = db.session.execute(text(
+        f"SELECT difficulty_level, COUNT(*) AS count FROM {SEARCH_TABLE} "
+        f"WHERE {match} AND difficulty_level IS NOT NULL AND difficulty_level != '' "
+        f"GROUP BY difficulty_level ORDER BY count DESC, difficulty_level"
+    ), params).all()
+    if _dialect() == 'postgresql':
+        theme_source = f"{SEARCH_TABLE}, jsonb_array_elements_text({SEARCH_TABLE}.themes::jsonb) AS theme(value)"
+    else:
+        theme_source = f"{SEARCH_TABLE}, json_each({SEARCH_TABLE}.themes) AS theme"
+    # A theme listed twice on one document still counts that document once
+    themes = db.session.execute(text(
+        f"SELECT theme.value, COUNT(DISTINCT doc_id) AS count FROM {theme_source} "
+        f"WHERE {match} GROUP BY theme.value ORDER BY count DESC, theme.value"
+    ), params).all()
+
+    return {
+        'age_groups': [
+            {'id': group_id, 'name': name, 'count': count} for group_id, name, count in age_groups
+        ],
+        'difficulty_levels': [{'value': value, 'count': count} for value, count in difficulty_levels],
+        'themes': [{'value': value, 'count': count} for value, count in themes]
+    }
+
+
+def search(query, age_group_id=None, difficulty_level=None, theme=None, limit=20, offset=0):
+    """
+    Search books and stories.
+
+    Facet counts are computed over all matches of the query; the age group,
+    difficulty and theme filters narrow down the total and the results.
+
+    Returns:
+        dict: total, results and facets (age_groups, difficulty_levels, themes)
+    """
+    terms = _search_terms(query or '')
+    if not terms:
+        return {'total': 0, 'results': [], 'facets': {'age_groups': [], 'difficulty_levels': [], 'themes': []}}
+
+    _ensure_index()
+    match, match_params = _match_clause(terms)
+    filters, filter_params = _filter_clause(age_group_id, difficulty_level, theme)
+    params = dict(match_params, **filter_params)
+
+    total = db.session.execute(
+        text(f"SELECT COUNT(*) FROM {SEARCH_TABLE} WHERE {match}{filters}"), params
+    ).scalar()
+
+    select_columns = ', '.join(column for column in _COLUMNS if column != 'content')
+    rows = db.session.execute(text(
+        f"SELECT {select_columns}, {_rank_expression()} AS rank FROM {SEARCH_TABLE} "
+        f"WHERE {match}{filters} ORDER BY rank DESC, doc_id LIMIT :limit OFFSET :offset"
+    ), dict(params, limit=limit, offset=offset)).mappings().all()
+
+    return {
+        'total': total,
+        'results': [
+            {
+                'kind': row['kind'],
+                'book_id': row['book_id'],
+                'story_id': row['story_id'],
+                'title': row['title'],
+                'description': row['description'],
+                'themes': _theme_list(row['themes']),
+                'age_group': {'id': row['age_group_id'], 'name': row['age_group_name']} if row['age_group_id'] else None,
+                'difficulty_level': row['difficulty_level'],
+                'score': round(float(row['rank']), 4)
+            }
+            for row in rows
+        ],
+        'facets': _facets(match, match_params)
+    }
@@ -1,18 +1,43 @@
 
+import os
+import json
+import tempfile
 import unittest
+from datetime import date, datetime, timedelta
+from sqlalchemy import event
+
+# main reads DATABASE_URL when it is imported, so point it (and the event
+# spill file) at throwaway files first instead of instance/
+_db_fd, _db_path = tempfile.mkstemp(suffix='.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{_db_path}'
+os.environ['EVENT_SPILL_FILE'] = f'{_db_path}.spill.jsonl'
+
 from main import app
 from db import db
-from models import Parent, Child
+from models import Parent, Child, AgeGroup, Book, ApprovedBooks, Event, Session
+import activity_calendar
+import book_catalog
+import write_behind
+
+
+def tearDownModule():
+    os.close(_db_fd)
+    os.remove(_db_path)
+
 
 class TestChildrensCastle(unittest.TestCase):
     def setUp(self):
         app.config['TESTING'] = True
-        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
         self.client = app.test_client()
         with app.app_context():
             db.create_all()
+        # Process-wide caches would outlive the tables dropped by the last test
+        book_catalog.invalidate()
+        activity_calendar._marked.clear()
 
     def tearDown(self):
+        # Write what the test queued before its tables are dropped
+        write_behind.flush_all()
         with app.app_context():
             db.session.remove()
             db.drop_all()
@@ -32,5 +57,1016 @@ class TestChildrensCastle(unittest.TestCase):
         })
         self.assertEqual(response.status_code, 302)  # Redirect after successful registration
 
+    def test_approved_books_query_count(self):
+        # The parent's approval screen must not issue a query per book
+        with app.app_context():
+            parent = Parent(username='queryparent', email='query@example.com')
+            parent.set_password('test1234')
+            db.session.add(parent)
+            db.session.commit()
+            child = Child(parent_id=parent.id, username='querychild', display_name='Query Child', age=5)
+            db.session.add(child)
+            young = AgeGroup(name='Query 4-5', min_age=4, max_age=5)
+            older = AgeGroup(name='Query 6-8', min_age=6, max_age=8)
+            db.session.add_all([young, older])
+            db.session.commit()
+            books = [
+                Book(title=f'Book {i}', file_name=f'query_book_{i}.txt',
+                     age_group_id=young.id if i % 2 else older.id)
+                for i in range(50)
+            ]
+            db.session.add_all(books)
+            db.session.commit()
+            for book in books[:10]:
+                db.session.add(ApprovedBooks(child_id=child.id, book_id=book.id, approved_by=parent.id))
+            db.session.commit()
+            parent_id, child_id = parent.id, child.id
+            engine = db.engine
+
+        with self.client.session_transaction() as sess:
+            sess['_user_id'] = f'parent-{parent_id}'
+            sess['user_type'] = 'parent'
+
+        statements = []
+        def count_statement(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(engine, 'before_cursor_execute', count_statement)
+        try:
+            response = self.client.get(f'/api/books/get-child-approved?child_id={child_id}')
+        finally:
+            event.remove(engine, 'before_cursor_execute', count_statement)
+
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+        self.assertEqual(len(data['books']), 50)
+        self.assertEqual(sum(book['is_approved'] for book in data['books']), 10)
+        # Loading the parent, the child and the annotated catalog
+        self.assertLessEqual(len(statements), 3, statements)
+
+    def test_daily_report_sql_aggregation(self):
+        # Recomputing daily reports with aggregate queries must match the old
+        # row-by-row Python loops on a month of synthetic events with a handful
+        # of queries per report (timings: scripts/benchmark_daily_reports.py)
+        import reports
+
+        first_day = date(2024, 1, 1)
+        days = [first_day + timedelta(days=i) for i in range(30)]
+        emojis = ['happy', 'sad', 'wow', 'love', 'sleepy']
+
+        with app.app_context():
+            parent = Parent(username='benchparent', email='bench@example.com')
+            parent.set_password('test1234')
+            db.session.add(parent)
+            db.session.commit()
+            child = Child(parent_id=parent.id, username='benchchild', display_name='Bench Child', age=5)
+            db.session.add(child)
+            db.session.commit()
+            child_id = child.id
+
+            events = []
+            sessions = []
+            for day in days:
+                start = datetime.combine(day, datetime.min.time()) + timedelta(hours=8)
+                for i in range(480):
+                    occurred_at = start + timedelta(seconds=60 * i // 4)
+                    if i % 3 == 0:
+                        kind = ('story', 'story_complete' if i % 2 else 'story_page_complete', {'content_id': f'story_{i % 25}'})
+                    elif i % 3 == 1:
+                        kind = ('game', 'game_start', {'content_id': f'game_{i % 20}'})
+                    else:
+                        kind = ('emotional_feedback', 'emoji_reaction', {'emoji': emojis[i % 5], 'content_id': 'x'})
+                    events.append({
+                        'user_type': 'child', 'user_id': child_id, 'event_type': kind[0],
+                        'event_name': kind[1], 'event_data': kind[2], 'occurred_at': occurred_at
+                    })
+                for i in range(3):
+                    session_start = start + timedelta(hours=i * 3)
+                    sessions.append(Session(
+                        user_type='child', user_id=child_id, start_time=session_start,
+                        end_time=session_start + timedelta(minutes=10 + 7 * i)
+                    ))
+            db.session.execute(Event.__table__.insert(), events)
+            db.session.add_all(sessions)
+            db.session.commit()
+
+            def old_daily_totals(day):
+                # The previous implementation: load every row and aggregate in Python
+                day_start = datetime.combine(day, datetime.min.time())
+                day_end = datetime.combine(day, datetime.max.time())
+                minutes = 0
+                for session in Session.query.filter(
+                    Session.user_id == child_id, Session.user_type == 'child',
+                    Session.start_time.between(day_start, day_end), Session.end_time.isnot(None)
+                ).all():
+                    minutes += (session.end_time - session.start_time).total_seconds() / 60
+                day_events = Event.query.filter(
+                    Event.user_id == child_id, Event.user_type == 'child',
+                    Event.occurred_at.between(day_start, day_end)
+                ).all()
+                stories, games, emotions = set(), set(), {}
+                for row in day_events:
+                    data = row.event_data or {}
+                    if row.event_type == 'story' and row.event_name in ('story_complete', 'story_page_complete'):
+                        stories.add(data['content_id'])
+                    elif row.event_type == 'game' and row.event_name in ('game_complete', 'game_start'):
+                        games.add(data['content_id'])
+                    elif row.event_type == 'emotional_feedback':
+                        emotions[data['emoji']] = emotions.get(data['emoji'], 0) + 1
+                return len(stories), len(games), round(minutes), emotions
+
+            old = [old_daily_totals(day) for day in days]
+
+            engine = db.engine
+            statements = []
+            def count_statement(conn, cursor, statement, parameters, context, executemany):
+                statements.append(statement)
+
+            event.listen(engine, 'before_cursor_execute', count_statement)
+            try:
+                # Measure the aggregation only; the reports are rolled back below
+                with db.session.no_autoflush:
+                    new = []
+                    for day in days:
+                        report = reports.recompute_daily_report(child_id, day)
+                        new.append((report.stories_read, report.games_played, report.time_spent,
+                                    reports.report_counters.load_json(report.emotional_feedback, {})))
+            finally:
+                event.remove(engine, 'before_cursor_execute', count_statement)
+                db.session.rollback()
+
+            self.assertEqual(new, old)
+            self.assertEqual(new[0][:3], (25, 20, 51))
+            # A handful of aggregate queries per report
+            self.assertLessEqual(len(statements), 4 * len(days), statements[:10])
+
+    def test_rollup_decompose(self):
+        import report_rollups
+
+        def covered(pieces):
+            days = []
+            for period, start in pieces:
+                end = {
+                    'day': start,
+                    'week': start + timedelta(days=6),
+                    'month': report_rollups.month_end(start)
+                }[period]
+                days.extend(start + timedelta(days=i) for i in range((end - start).days + 1))
+            return days
+
+        # A calendar year is its 12 months
+        pieces = report_rollups.decompose(date(2024, 1, 1), date(2024, 12, 31))
+        self.assertEqual(pieces, [('month', date(2024, month, 1)) for month in range(1, 13)])
+
+        # Single days up to the first Monday, whole weeks, then single days again
+        pieces = report_rollups.decompose(date(2024, 1, 3), date(2024, 2, 14))
+        self.assertEqual(pieces, (
+            [('day', date(2024, 1, d)) for d in range(3, 8)]
+            + [('week', date(2024, 1, d)) for d in (8, 15, 22, 29)]
+            + [('week', date(2024, 2, 5))]
+            + [('day', date(2024, 2, d)) for d in (12, 13, 14)]
+        ))
+
+        # A week reaching into a month the range covers completely is split into days
+        pieces = report_rollups.decompose(date(2024, 1, 29), date(2024, 3, 31))
+        self.assertEqual(pieces, [('day', date(2024, 1, d)) for d in (29, 30, 31)] + [
+            ('month', date(2024, 2, 1)), ('month', date(2024, 3, 1))
+        ])
+
+        # Every day of any range is covered exactly once, in order
+        for start, end in [(date(2023, 12, 20), date(2024, 3, 5)), (date(2024, 2, 29), date(2024, 2, 29)),
+                           (date(2024, 5, 6), date(2024, 5, 12))]:
+            self.assertEqual(covered(report_rollups.decompose(start, end)),
+                             [start + timedelta(days=i) for i in range((end - start).days + 1)])
+
+    def _create_child(self, name='rollup'):
+        parent = Parent(username=f'{name}parent', email=f'{name}@example.com')
+        parent.set_password('test1234')
+        db.session.add(parent)
+        db.session.commit()
+        child = Child(parent_id=parent.id, username=f'{name}child', display_name=f'{name.title()} Child', age=5)
+        db.session.add(child)
+        db.session.commit()
+        return child.id
+
+    def _login_child(self, child_id):
+        with self.client.session_transaction() as sess:
+            sess['_user_id'] = f'child-{child_id}'
+            sess['user_type'] = 'child'
+
+    def _rollups(self, child_id):
+        from models import ReportRollup
+        return {
+            (rollup.period, rollup.period_start): (
+                rollup.stories_read, rollup.games_played, rollup.time_spent, rollup.stars_earned,
+                json.loads(rollup.emotional_feedback)
+            )
+            for rollup in ReportRollup.query.filter_by(child_id=child_id).populate_existing()
+        }
+
+    def test_rollup_deltas_and_rollback(self):
+        import report_rollups
+        from models import DailyReport
+
+        week, month = ('week', date(2024, 1, 8)), ('month', date(2024, 1, 1))
+        with app.app_context():
+            child_id = self._create_child()
+
+            monday = DailyReport(child_id=child_id, report_date=date(2024, 1, 8), stories_read=2,
+                                 games_played=1, time_spent=30, stars_earned=5,
+                                 emotional_feedback=json.dumps({'happy': 2}))
+            tuesday = DailyReport(child_id=child_id, report_date=date(2024, 1, 9), stories_read=1,
+                                  games_played=0, time_spent=10, stars_earned=0,
+                                  emotional_feedback=json.dumps({'sad': 1}))
+            db.session.add_all([monday, tuesday])
+            db.session.commit()
+            expected = (3, 1, 40, 5, {'happy': 2, 'sad': 1})
+            self.assertEqual(self._rollups(child_id), {week: expected, month: expected})
+
+            # Changes add only their difference
+            monday.stories_read = 4
+            monday.emotional_feedback = json.dumps({'happy': 3, 'wow': 1})
+            db.session.commit()
+            expected = (5, 1, 40, 5, {'happy': 3, 'sad': 1, 'wow': 1})
+            self.assertEqual(self._rollups(child_id), {week: expected, month: expected})
+
+            # A rolled back change leaves the rollups alone
+            tuesday.time_spent = 100
+            tuesday.emotional_feedback = json.dumps({})
+            db.session.flush()
+            db.session.rollback()
+            self.assertEqual(self._rollups(child_id), {week: expected, month: expected})
+
+            # Deleting subtracts what the report counted
+            db.session.delete(db.session.get(DailyReport, tuesday.id))
+            db.session.commit()
+            expected = (4, 1, 30, 5, {'happy': 3, 'wow': 1})
+            self.assertEqual(self._rollups(child_id), {week: expected, month: expected})
+
+            totals = report_rollups.sum_range(child_id, date(2024, 1, 1), date(2024, 1, 31))
+            self.assertEqual((totals['stories_read'], totals['time_spent'], totals['emotional_feedback']),
+                             (4, 30, {'happy': 3, 'wow': 1}))
+
+    def test_rollups_backfilled_on_create(self):
+        from models import DailyReport, ReportRollup
+
+        with app.app_context():
+            child_id = self._create_child()
+            db.session.add_all([
+                DailyReport(child_id=child_id, report_date=date(2024, 3, d), stories_read=1,
+                            games_played=2, time_spent=15, stars_earned=1,
+                            emotional_feedback=json.dumps({'love': 1}))
+                for d in (4, 5, 11)
+            ])
+            db.session.commit()
+
+            # A deployment that predates the rollups gets them filled when the table is created
+            ReportRollup.__table__.drop(db.engine)
+            db.create_all()
+            self.assertEqual(self._rollups(child_id), {
+                ('week', date(2024, 3, 4)): (2, 4, 30, 2, {'love': 2}),
+                ('week', date(2024, 3, 11)): (1, 2, 15, 1, {'love': 1}),
+                ('month', date(2024, 3, 1)): (3, 6, 45, 3, {'love': 3})
+            })
+
+    def test_unit_of_work(self):
+        import unit_of_work
+
+        for status, saved in ((500, 0), (200, 1)):
+            with app.test_request_context():
+                db.session.add(Parent(username=f'uow{status}', email=f'uow{status}@example.com'))
+                unit_of_work.commit()
+                # Flushed, not committed, until the request ends
+                self.assertTrue(Parent.query.filter_by(username=f'uow{status}').count())
+                unit_of_work.end_request(app.response_class(status=status))
+            with app.app_context():
+                self.assertEqual(Parent.query.filter_by(username=f'uow{status}').count(), saved, status)
+
+    def test_story_bundle_serves_edited_stories(self):
+        import story_bundle
+
+        with tempfile.TemporaryDirectory() as directory:
+            stories_dir = os.path.join(directory, 'stories')
+            os.makedirs(stories_dir)
+            story_path = os.path.join(stories_dir, 'fox.json')
+            text_path = os.path.join(directory, 'bear.txt')
+            bundle_path = os.path.join(directory, 'story_bundle.bin')
+
+            def write_story(text, mtime):
+                with open(story_path, 'w') as f:
+                    json.dump({'title': 'Fox', 'pages': [{'text': text, 'image': 'fox.png'}]}, f)
+                os.utime(story_path, (mtime, mtime))
+
+            write_story('Old page.', 1000)
+            with open(text_path, 'w') as f:
+                f.write('First.\n\nSecond.')
+
+            saved = story_bundle.BUNDLE_PATH, story_bundle.STORIES_DIR, story_bundle.TEXT_STORIES_DIR
+            story_bundle.BUNDLE_PATH, story_bundle.STORIES_DIR, story_bundle.TEXT_STORIES_DIR = (
+                bundle_path, stories_dir, directory
+            )
+            try:
+                self.assertEqual(story_bundle.build_bundle(bundle_path, directory, stories_dir),
+                                 {'text': 1, 'enhanced': 1})
+                bundle = story_bundle.get_bundle()
+                self.assertIsNotNone(bundle)
+                self.assertEqual(story_bundle.read_story_page('fox', 0)[0]['text'], 'Old page.')
+                self.assertEqual(story_bundle.read_story_page('bear', 1)[0]['text'], 'Second.')
+
+                # A story rewritten at runtime is read from disk instead of the bundle
+                write_story('New page.', 2000)
+                self.assertEqual(story_bundle.read_story_page('fox', 0)[0]['text'], 'New page.')
+                self.assertEqual(story_bundle.read_enhanced_story('fox')['pages'][0]['text'], 'New page.')
+                self.assertIs(story_bundle.get_bundle(), bundle)
+
+                # A rebuilt bundle is mapped again
+                story_bundle.build_bundle(bundle_path, directory, stories_dir)
+                self.assertIsNot(story_bundle.get_bundle(), bundle)
+                self.assertEqual(story_bundle.get_bundle().get_text('enhanced', 'fox'), 'Fox\n\n--- Page 1 ---\n\nNew page.')
+            finally:
+                story_bundle.BUNDLE_PATH, story_bundle.STORIES_DIR, story_bundle.TEXT_STORIES_DIR = saved
+                story_bundle.get_bundle()
+
+    def test_story_etag_and_precompressed_bodies(self):
+        import gzip
+        import brotli
+        import story_bundle
+
+        with app.app_context():
+            child_id = self._create_child('etag')
+        self._login_child(child_id)
+
+        response = self.client.get('/api/story/little_fox')
+        self.assertEqual(response.status_code, 200)
+        payload = response.get_json()
+        self.assertTrue(payload['success'])
+        etag = response.headers['ETag']
+
+        # Unchanged stories are answered with 304
+        response = self.client.get('/api/story/little_fox', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+        # Each encoding is served pre-compressed under its own ETag
+        for encoding, decompress in (('gzip', gzip.decompress), ('br', brotli.decompress)):
+            response = self.client.get('/api/story/little_fox', headers={'Accept-Encoding': encoding})
+            self.assertEqual(response.headers['Content-Encoding'], encoding)
+            self.assertEqual(json.loads(decompress(response.data)), payload)
+            self.assertNotEqual(response.headers['ETag'], etag)
+            response = self.client.get('/api/story/little_fox', headers={
+                'Accept-Encoding': encoding, 'If-None-Match': response.headers['ETag']
+            })
+            self.assertEqual(response.status_code, 304)
+        response = self.client.get('/api/story/little_fox', headers={'Accept-Encoding': 'gzip, br'})
+        self.assertEqual(response.headers['Content-Encoding'], 'br')
+
+        # An edited story gets a new body and ETag instead of the cached one
+        with tempfile.TemporaryDirectory() as directory:
+            saved = story_bundle.TEXT_STORIES_DIR
+            story_bundle.TEXT_STORIES_DIR = directory
+            try:
+                path = os.path.join(directory, 'edited_story.txt')
+                with open(path, 'w') as f:
+                    f.write('Once upon a time.')
+                os.utime(path, (1000, 1000))
+                first = self.client.get('/api/story/edited_story')
+                self.assertEqual(first.get_json()['content'], 'Once upon a time.')
+
+                with open(path, 'w') as f:
+                    f.write('Once upon a later time.')
+                os.utime(path, (2000, 2000))
+                second = self.client.get('/api/story/edited_story', headers={'If-None-Match': first.headers['ETag']})
+                self.assertEqual(second.status_code, 200)
+                self.assertEqual(second.get_json()['content'], 'Once upon a later time.')
+            finally:
+                story_bundle.TEXT_STORIES_DIR = saved
+
+    def test_write_behind_queue(self):
+        from write_behind import WriteBehindQueue
+
+        batches, spilled = [], []
+        queue = WriteBehindQueue('test', batches.append, flush_interval=60, batch_size=2, spill_fn=spilled.extend)
+        for i in range(5):
+            self.assertTrue(queue.put(i, app=app))
+        queue.flush()
+        # Everything is written in order, at most batch_size items at a time
+        self.assertEqual([item for batch in batches for item in batch], [0, 1, 2, 3, 4])
+        self.assertTrue(all(len(batch) <= 2 for batch in batches))
+        self.assertEqual(len(queue), 0)
+
+        # A batch that fails to write goes to the spill function
+        def fail(items):
+            raise RuntimeError('database down')
+        failing = WriteBehindQueue('failing', fail, flush_interval=60, batch_size=10, spill_fn=spilled.extend)
+        failing.put('a', app=app)
+        failing.put('b', app=app)
+        self.assertEqual(failing.flush(), 0)
+        self.assertEqual(spilled, ['a', 'b'])
+
+
+    def test_story_views_written_behind(self):
+        import tracking
+        from models import Progress
+
+        with app.app_context():
+            child_id = self._create_child('views')
+        self._login_child(child_id)
+        for _ in range(2):
+            self.assertEqual(self.client.get('/api/story/little_fox').status_code, 200)
+
+        # The views are merged into one progress row by the write-behind queue
+        tracking.story_view_queue.flush()
+        with app.app_context():
+            row = Progress.query.filter_by(child_id=child_id, content_type='story', content_id='little_fox').one()
+            self.assertEqual(row.access_count, 2)
+
+    def test_story_page_api(self):
+        import tracking
+
+        with app.app_context():
+            child_id = self._create_child('page')
+        self._login_child(child_id)
+
+        response = self.client.get('/api/story/little_fox/pages/1')
+        self.assertEqual(response.status_code, 200)
+        page = response.get_json()
+        self.assertEqual((page['page_number'], page['total_pages']), (1, 5))
+        self.assertTrue(page['text'])
+        self.assertTrue(page['next_page'].endswith('/api/story/little_fox/pages/2'))
+        # The next page's media is announced as preload hints
+        self.assertEqual(response.headers.get('Link'), ', '.join(page['preload']) or None)
+
+        last = self.client.get('/api/story/little_fox/pages/5').get_json()
+        self.assertIsNone(last['next_page'])
+        self.assertEqual(self.client.get('/api/story/little_fox/pages/6').status_code, 404)
+        self.assertEqual(self.client.get('/api/story/no_such_story/pages/1').status_code, 404)
+
+        # Pages are cached responses with ETags like whole stories
+        response = self.client.get('/api/story/little_fox/pages/1', headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+        # Only opening the first page counts as a story view, written behind the requests
+        tracking.story_view_queue.flush()
+        with app.app_context():
+            from models import Progress
+            row = Progress.query.filter_by(child_id=child_id, content_id='little_fox').one()
+            self.assertEqual(row.access_count, 2)
+
+    def test_child_shelf_age_filter(self):
+        with app.app_context():
+            child_id = self._create_child('shelf')
+            parent_id = db.session.get(Child, child_id).parent_id
+            young = AgeGroup(name='Shelf 4-5', min_age=4, max_age=5)
+            older = AgeGroup(name='Shelf 9-12', min_age=9, max_age=12)
+            db.session.add_all([young, older])
+            db.session.commit()
+            young_book = Book(title='Young Book', file_name='shelf_young.txt', age_group_id=young.id)
+            older_book = Book(title='Older Book', file_name='shelf_older.txt', age_group_id=older.id)
+            db.session.add_all([young_book, older_book])
+            db.session.commit()
+
+            # Without approvals the age filter applies
+            age_groups, books = book_catalog.get_child_shelf(child_id, max_age=5)
+            self.assertEqual([book.title for book in books], ['Young Book'])
+            self.assertEqual([group.name for group in age_groups], ['Shelf 4-5'])
+
+            # Approved books are shown whatever the age filter, and only those
+            db.session.add(ApprovedBooks(child_id=child_id, book_id=older_book.id, approved_by=parent_id))
+            db.session.commit()
+            book_catalog.invalidate()
+            _, books = book_catalog.get_child_shelf(child_id, max_age=5)
+            self.assertEqual([book.title for book in books], ['Older Book'])
+
+    def test_story_search_and_facets(self):
+        import story_search
+
+        with app.app_context():
+            young = AgeGroup(name='Search 4-5', min_age=4, max_age=5)
+            older = AgeGroup(name='Search 9-12', min_age=9, max_age=12)
+            db.session.add_all([young, older])
+            db.session.commit()
+            books = [
+                Book(title='Zephyrquest Dragon', file_name='search_dragon.txt', age_group_id=young.id,
+                     difficulty_level='easy', themes=json.dumps(['dragons', 'friendship'])),
+                Book(title='Zephyrquest Castle', file_name='search_castle.txt', age_group_id=older.id,
+                     difficulty_level='medium', themes=json.dumps(['castles', 'friendship'])),
+                Book(title='Zephyrquest Sea', file_name='search_sea.txt', age_group_id=young.id,
+                     difficulty_level='easy', themes=json.dumps(['sea'])),
+                Book(title='Another Book', file_name='search_other.txt', age_group_id=older.id)
+            ]
+            db.session.add_all(books)
+            db.session.commit()
+            # The search table outlives the dropped tables of other tests
+            story_search.build_index()
+
+            result = story_search.search('zephyrquest')
+            self.assertEqual(result['total'], 3)
+            facets = result['facets']
+            self.assertEqual([(g['name'], g['count']) for g in facets['age_groups']],
+                             [('Search 4-5', 2), ('Search 9-12', 1)])
+            self.assertEqual([(d['value'], d['count']) for d in facets['difficulty_levels']],
+                             [('easy', 2), ('medium', 1)])
+            self.assertEqual(facets['themes'][0], {'value': 'friendship', 'count': 2})
+
+            # Filters narrow the total and results, facets still count every match
+            result = story_search.search('zephyrquest', theme='friendship', age_group_id=young.id)
+            self.assertEqual((result['total'], [r['title'] for r in result['results']]),
+                             (1, ['Zephyrquest Dragon']))
+            self.assertEqual(result['facets'], facets)
+
+            # Only the requested page is returned, with the total of all matches
+            result = story_search.search('zephyrquest', limit=2, offset=2)
+            self.assertEqual((result['total'], len(result['results'])), (3, 1))
+            self.assertEqual(story_search.search('   ')['total'], 0)
+
+            # Books are re-indexed when a transaction writing them commits
+            books[3].title = 'Zephyrquest Meadow'
+            db.session.delete(books[2])
+            db.session.commit()
+            titles = {r['title'] for r in story_search.search('zephyrquest')['results']}
+            self.assertEqual(titles, {'Zephyrquest Dragon', 'Zephyrquest Castle', 'Zephyrquest Meadow'})
+
+    def test_paginate(self):
+        import story_pagination
+
+        text = ' '.join(f'Sentence number {i} is here.' for i in range(30))
+        pages = story_pagination.paginate(text, pages=3)
+        self.assertEqual(len(pages), 3)
+        # Pages are slices of the text, in order, splitting only between sentences
+        self.assertEqual(' '.join(pages), text)
+        self.assertTrue(all(page.endswith('.') for page in pages))
+
+        # Younger readers read slower, so their pages hold fewer words
+        young = story_pagination.paginate(text, age=4)
+        older = story_pagination.paginate(text, age=10)
+        self.assertGreater(len(young), len(older))
+        self.assertGreater(len(story_pagination.paginate(text, age=10, target_seconds=5)), len(older))
+        self.assertEqual(story_pagination.paginate(''), [])
+
+        with app.app_context():
+            child_id = self._create_child('paginate')
+        self._login_child(child_id)
+        response = self.client.get('/api/story/little_fox/paginate?seconds=20')
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+        self.assertEqual((data['seconds_per_page'], data['total_pages']), (20, len(data['pages'])))
+        self.assertEqual(self.client.get('/api/story/little_fox/paginate?seconds=1').status_code, 400)
+
+    def test_track_progress_batch(self):
+        from unittest import mock
+        from models import Progress, Reward
+
+        with app.app_context():
+            child_id = self._create_child('batch')
+        self._login_child(child_id)
+
+        # Updates of the same content are merged; 5 and "5" are the same content
+        response = self.client.post('/api/track-progress/batch', json={'updates': [
+            {'content_type': 'game', 'content_id': 5, 'time_spent': 10, 'score': 40},
+            {'content_type': 'game', 'content_id': '5', 'time_spent': 20, 'score': 90, 'completed': True},
+            {'content_type': 'story', 'content_id': 'little_fox', 'pages_read': 3}
+        ]})
+        self.assertEqual(response.status_code, 200, response.data)
+        data = response.get_json()
+        self.assertEqual((data['received'], data['merged']), (3, 2))
+        with app.app_context():
+            game = Progress.query.filter_by(child_id=child_id, content_type='game', content_id='5').one()
+            self.assertEqual((game.access_count, game.time_spent, game.score, game.completion_count),
+                             (2, 30, 90, 1))
+            self.assertEqual(Reward.query.filter_by(child_id=child_id, badge_id='game_5').count(), 1)
+
+        # Malformed updates are rejected as a whole, before anything is written
+        for update in ({'content_type': 'game', 'content_id': 6, 'time_spent': '10'},
+                       {'content_type': 'game', 'content_id': 6, 'score': True},
+                       {'content_type': 'game', 'content_id': 6, 'pages_read': -1},
+                       {'content_type': 'game', 'content_id': 6, 'engagement_rating': 4.5},
+                       {'content_type': 'game', 'content_id': None},
+                       {'content_type': 'game', 'content_id': ['6']},
+                       'game 6'):
+            response = self.client.post('/api/track-progress/batch', json={'updates': [
+                {'content_type': 'story', 'content_id': 'ok_story'}, update
+            ]})
+            self.assertEqual(response.status_code, 400, update)
+            self.assertFalse(response.get_json()['success'])
+        self.assertEqual(self.client.post('/api/track-progress', json={
+            'content_type': 'game', 'content_id': 6, 'time_spent': '10'
+        }).status_code, 400)
+
+        # A failure while writing rolls back the whole batch
+        with mock.patch('app._record_progress_activity', side_effect=RuntimeError('boom')):
+            response = self.client.post('/api/track-progress/batch', json={'updates': [
+                {'content_type': 'story', 'content_id': 'rolled_back', 'completed': True},
+                {'content_type': 'game', 'content_id': 5, 'time_spent': 100}
+            ]})
+        self.assertEqual(response.status_code, 500)
+        with app.app_context():
+            self.assertEqual(Progress.query.filter_by(child_id=child_id, content_id='ok_story').count(), 0)
+            self.assertEqual(Progress.query.filter_by(child_id=child_id, content_id='rolled_back').count(), 0)
+            self.assertEqual(Reward.query.filter_by(child_id=child_id, badge_id='story_rolled_back').count(), 0)
+            game = Progress.query.filter_by(child_id=child_id, content_type='game', content_id='5').one()
+            self.assertEqual(game.time_spent, 30)
+
+    def test_upsert_progress(self):
+        import tracking
+        from models import Progress
+
+        with app.app_context():
+            child_id = self._create_child('upsert')
+            progress_id, count, first = tracking.upsert_progress(
+                child_id, 'story', 'little_fox', content_title='The Little Fox', time_spent=60, completions=1
+            )
+            self.assertEqual((count, first), (1, True))
+            again_id, count, first = tracking.upsert_progress(
+                child_id, 'story', 'little_fox', time_spent=30, completions=1, pages_read=3
+            )
+            self.assertEqual((again_id, count, first), (progress_id, 2, False))
+            db.session.commit()
+
+            # One row, with the counters added up by the database
+            rows = Progress.query.filter_by(child_id=child_id).all()
+            self.assertEqual(len(rows), 1)
+            row = rows[0]
+            self.assertEqual((row.access_count, row.time_spent, row.completion_count, row.pages_read),
+                             (2, 90, 2, 3))
+            self.assertEqual(row.content_title, 'The Little Fox')
+
+    def test_session_activity_log(self):
+        import session_activity
+        from models import SessionActivity
+
+        with app.app_context():
+            child_id = self._create_child('activity')
+            user_session = Session(user_type='child', user_id=child_id)
+            db.session.add(user_session)
+            db.session.commit()
+            session_id = user_session.id
+
+        # Activities are buffered during the request and queued when it ends
+        with app.test_request_context():
+            session_activity.record(db.session.get(Session, session_id), 'page_view', 'little_fox', {'page': 1})
+            session_activity.record(session_id, 'page_view', 'little_fox', {'page': 2})
+            self.assertEqual(SessionActivity.query.filter_by(session_id=session_id).count(), 0)
+            session_activity.flush_request()
+        session_activity.activity_queue.flush()
+
+        with app.app_context():
+            activities = session_activity.get_activities([session_id])[session_id]
+            self.assertEqual([(a['type'], a['details']['page']) for a in activities],
+                             [('page_view', 1), ('page_view', 2)])
+
+        # Closing a session writes its buffered activities in the caller's transaction
+        with app.test_request_context():
+            user_session = db.session.get(Session, session_id)
+            session_activity.record(user_session, 'logout')
+            user_session.close()
+            db.session.commit()
+            self.assertIsNotNone(user_session.end_time)
+        with app.app_context():
+            activities = session_activity.get_activities([session_id])[session_id]
+            self.assertEqual([a['type'] for a in activities], ['page_view', 'page_view', 'logout'])
+
+    def test_active_session_resolution(self):
+        from flask import g, session as flask_session
+        from flask_login import login_user
+        import session_activity
+
+        with app.app_context():
+            child_id = self._create_child('resolve')
+            user_session = Session(user_type='child', user_id=child_id)
+            db.session.add(user_session)
+            db.session.commit()
+            session_id = user_session.id
+
+        def request_as_child(stored_id=None):
+            context = app.test_request_context()
+            context.push()
+            login_user(db.session.get(Child, child_id))
+            flask_session['user_type'] = 'child'
+            if stored_id is not None:
+                flask_session['active_session'] = {'id': stored_id, 'user': f'child-{child_id}'}
+            return context
+
+        # The ID stored at login is used and resolved once per request
+        context = request_as_child(session_id)
+        try:
+            self.assertEqual(session_activity.get_active_session_id(), session_id)
+            self.assertEqual(g.active_session_id, session_id)
+        finally:
+            context.pop()
+
+        # Without a stored ID the open session is looked up and stored
+        context = request_as_child()
+        try:
+            self.assertEqual(session_activity.get_active_session_id(), session_id)
+            self.assertEqual(flask_session['active_session']['id'], session_id)
+        finally:
+            context.pop()
+
+        with app.app_context():
+            db.session.get(Session, session_id).close()
+            db.session.commit()
+
+        # A closed stored session isn't reused: lookups without start_new find none...
+        context = request_as_child(session_id)
+        try:
+            self.assertIsNone(session_activity.get_active_session())
+            self.assertNotIn('active_session', flask_session)
+        finally:
+            context.pop()
+
+        # ...and activity starts a new session
+        context = request_as_child(session_id)
+        try:
+            new_id = session_activity.get_active_session_id()
+            self.assertNotEqual(new_id, session_id)
+            self.assertEqual(flask_session['active_session']['id'], new_id)
+            new_session = db.session.get(Session, new_id)
+            self.assertEqual((new_session.user_type, new_session.user_id, new_session.end_time),
+                             ('child', child_id, None))
+            self.assertEqual([entry['activity_type'] for _, entry in g.session_activities], ['session_resumed'])
+            db.session.commit()
+        finally:
+            context.pop()
+
+    def test_event_spill_and_replay(self):
+        import event_pipeline
+        from models import DailyReport
+
+        with app.app_context():
+            child_id = self._create_child('spill')
+            occurred_at = datetime(2024, 4, 2, 10, 0)
+            rows = [
+                {'user_type': 'child', 'user_id': child_id, 'event_type': 'story', 'event_name': 'story_complete',
+                 'event_data': {'content_id': f'story_{i}'}, 'occurred_at': occurred_at, 'session_id': None}
+                for i in range(3)
+            ]
+            event_pipeline.spill(rows[:2])
+            event_pipeline.spill(rows[2:])
+            self.assertTrue(os.path.exists(event_pipeline.EVENT_SPILL_FILE))
+
+            self.assertEqual(event_pipeline.replay_spill(), 3)
+            self.assertFalse(os.path.exists(event_pipeline.EVENT_SPILL_FILE))
+            self.assertEqual(Event.query.filter_by(user_id=child_id).count(), 3)
+            # Counted in the daily report in the same transaction
+            report = DailyReport.query.filter_by(child_id=child_id, report_date=occurred_at.date()).one()
+            self.assertEqual(report.stories_read, 3)
+            # Nothing left to replay
+            self.assertEqual(event_pipeline.replay_spill(), 0)
+
+    def test_retention_keeps_daily_reports(self):
+        import data_retention
+        from models import DailyReport
+
+        with app.app_context():
+            child_id = self._create_child('retention')
+            old, kept = datetime(2024, 1, 10, 9, 0), datetime(2024, 5, 10, 9, 0)
+            db.session.execute(Event.__table__.insert(), [
+                {'user_type': 'child', 'user_id': child_id, 'event_type': 'story', 'event_name': 'story_complete',
+                 'event_data': {'content_id': story_id}, 'occurred_at': occurred_at}
+                for story_id, occurred_at in (('fox', old), ('bear', old), ('fox', kept))
+            ])
+            db.session.add_all([
+                Session(user_type='child', user_id=child_id, start_time=old, end_time=old + timedelta(minutes=30)),
+                Session(user_type='child', user_id=child_id, start_time=kept, end_time=kept + timedelta(minutes=5))
+            ])
+            # A day whose report already exists is left alone
+            db.session.add(DailyReport(child_id=child_id, report_date=date(2024, 1, 11), stories_read=7))
+            db.session.execute(Event.__table__.insert(), [{
+                'user_type': 'child', 'user_id': child_id, 'event_type': 'story', 'event_name': 'story_complete',
+                'event_data': {'content_id': 'owl'}, 'occurred_at': datetime(2024, 1, 11, 9, 0)
+            }])
+            db.session.commit()
+
+            summary = data_retention.apply_retention(3, 3, today=date(2024, 6, 15))
+            # Keeping 3 months in June removes everything before April
+            expired = ['2024-01', '2024-02', '2024-03']
+            self.assertEqual(summary['events'], {'months': expired, 'reports': 1})
+            self.assertEqual(summary['sessions'], {'months': expired, 'reports': 0})
+
+            # The old raw rows are gone, their daily report stays
+            self.assertEqual([e.occurred_at for e in Event.query.filter_by(user_id=child_id)], [kept])
+            self.assertEqual([s.start_time for s in Session.query.filter_by(user_id=child_id)], [kept])
+            report = DailyReport.query.filter_by(child_id=child_id, report_date=old.date()).one()
+            self.assertEqual((report.stories_read, report.time_spent), (2, 30))
+            self.assertEqual(
+                DailyReport.query.filter_by(child_id=child_id, report_date=date(2024, 1, 11)).one().stories_read, 7
+            )
+            self.assertEqual(DailyReport.query.filter_by(child_id=child_id, report_date=kept.date()).count(), 0)
+
+    def test_milestones_from_progress(self):
+        import tracking
+        from models import DailyReport, Milestone, Reward
+
+        with app.app_context():
+            child_id = self._create_child('milestone')
+            for i in range(5):
+                tracking.upsert_progress(child_id, 'story', f'story_{i}', completions=1,
+                                         time_spent=3600 if i == 0 else 0)
+            db.session.commit()
+
+            milestones = {m.milestone_id: m for m in Milestone.query.filter_by(child_id=child_id)}
+            for milestone_id in ('read_first_story', 'read_5_stories', 'time_spent_60'):
+                self.assertTrue(milestones[milestone_id].completed, milestone_id)
+            self.assertEqual(milestones['read_5_stories'].progress, 5)
+            self.assertFalse(milestones.get('play_first_game') and milestones['play_first_game'].completed)
+
+            # 3 milestone rewards of 5 points, counted as today's stars
+            rewards = Reward.query.filter_by(child_id=child_id, source_type='milestone').all()
+            self.assertEqual(sum(reward.points_value for reward in rewards), 15)
+            report = DailyReport.query.filter_by(child_id=child_id, report_date=datetime.utcnow().date()).one()
+            self.assertEqual(report.stars_earned, 15)
+
+    def test_activity_calendar(self):
+        with app.app_context():
+            child_id = self._create_child('calendar')
+            for day in (date(2024, 3, 1), date(2024, 3, 2), date(2024, 3, 3), date(2024, 3, 5)):
+                self.assertTrue(activity_calendar.mark_active(child_id, day))
+            # A day before the first one moves the calendar's start
+            self.assertTrue(activity_calendar.mark_active(child_id, date(2024, 2, 29)))
+            db.session.commit()
+            self.assertFalse(activity_calendar.mark_active(child_id, date(2024, 3, 5)))
+
+            self.assertEqual(activity_calendar.current_streak(child_id, today=date(2024, 3, 5)), 1)
+            # Not active yet today: the streak ending yesterday still counts
+            self.assertEqual(activity_calendar.current_streak(child_id, today=date(2024, 3, 4)), 4)
+            self.assertEqual(activity_calendar.current_streak(child_id, today=date(2024, 3, 8)), 0)
+            self.assertEqual(activity_calendar.longest_streak(child_id), 4)
+            self.assertEqual(activity_calendar.longest_streak(child_id, start_day=date(2024, 3, 2)), 2)
+            self.assertEqual(activity_calendar.days_active(child_id, date(2024, 3, 1), date(2024, 3, 31)), 4)
+
+            summary = activity_calendar.summary(child_id, today=date(2024, 3, 5))
+            self.assertEqual(summary['days_active_this_week'], 1)
+            self.assertEqual(summary['days_active_this_month'], 4)
+
+    def test_favorites(self):
+        import favorites
+        import tracking
+        from models import ChildFavorites
+
+        with app.app_context():
+            child_id = self._create_child('favorite')
+            tracking.upsert_progress(child_id, 'story', 'often', accesses=5, completions=3)
+            tracking.upsert_progress(child_id, 'story', 'once')
+            tracking.upsert_progress(child_id, 'game', 'starred', is_favorite=True)
+            db.session.commit()
+
+            # Reading never writes; the row is built by the write-behind queue
+            self.assertEqual([e['content_id'] for e in favorites.get(child_id, 'story')], ['often', 'once'])
+            self.assertIsNone(db.session.get(ChildFavorites, child_id))
+            favorites.favorites_queue.flush()
+            db.session.expire_all()
+            self.assertIsNotNone(db.session.get(ChildFavorites, child_id))
+            self.assertEqual([e['content_id'] for e in favorites.get(child_id)], ['starred', 'often', 'once'])
+
+            # A committed progress change queues a rebuild
+            tracking.upsert_progress(child_id, 'story', 'once', accesses=50, completions=20)
+            db.session.commit()
+            favorites.favorites_queue.flush()
+            self.assertEqual([e['content_id'] for e in favorites.get(child_id, 'story')], ['once', 'often'])
+
+    def test_running_report_counters_match_recompute(self):
+        import event_pipeline
+        import report_counters
+        import reports
+        import tracking
+        from models import DailyReport, Reward
+
+        day = date(2024, 2, 5)
+        at = datetime.combine(day, datetime.min.time())
+        with app.app_context():
+            child_id = self._create_child('counter')
+
+            def story_event(name, content_id, minute):
+                return {'user_type': 'child', 'user_id': child_id, 'event_type': 'story', 'event_name': name,
+                        'event_data': {'content_id': content_id}, 'occurred_at': at + timedelta(minutes=minute),
+                        'session_id': None}
+
+            event_pipeline.write_events([
+                story_event('story_complete', 'fox', 1),
+                story_event('story_page_complete', 'fox', 2),  # Same story, counted once
+                {'user_type': 'child', 'user_id': child_id, 'event_type': 'game', 'event_name': 'game_start',
+                 'event_data': {'content_id': 'puzzle'}, 'occurred_at': at, 'session_id': None},
+                {'user_type': 'child', 'user_id': child_id, 'event_type': 'emotional_feedback',
+                 'event_name': 'emoji_reaction', 'event_data': {'emoji': 'happy'}, 'occurred_at': at, 'session_id': None}
+            ])
+            tracking.record_completions(child_id, {('story', 'bear'): 1, ('story', 'fox'): 1}, completed_at=at)
+            report_counters.add_reward(Reward(child_id=child_id, badge_id='counter', badge_name='Counter',
+                                              points_value=4, earned_at=at))
+            # Two 90 second sessions are 3 minutes, not two rounded 2 minute sessions
+            for hour in (9, 10):
+                start = at + timedelta(hours=hour)
+                user_session = Session(user_type='child', user_id=child_id, start_time=start)
+                db.session.add(user_session)
+                db.session.flush()
+                user_session.end_time = start + timedelta(seconds=90)
+                report_counters.record_session(user_session)
+            db.session.commit()
+
+            report = DailyReport.query.filter_by(child_id=child_id, report_date=day).one()
+            running = (report.stories_read, report.games_played, report.time_spent, report.stars_earned,
+                       json.loads(report.emotional_feedback))
+            self.assertEqual(running, (2, 1, 3, 4, {'happy': 1}))
+
+            with db.session.no_autoflush:
+                recomputed = reports.recompute_daily_report(child_id, day, DailyReport(child_id=child_id, report_date=day))
+                self.assertEqual((recomputed.stories_read, recomputed.games_played, recomputed.time_spent,
+                                  recomputed.stars_earned, json.loads(recomputed.emotional_feedback)), running)
+            db.session.rollback()
+
+    def test_generated_daily_report_is_committed(self):
+        import reports
+        from models import DailyReport
+
+        day = date(2024, 3, 4)
+        with app.app_context():
+            child_id = self._create_child('generated')
+            reports.generate_daily_report(child_id, day)
+            db.session.remove()
+            self.assertEqual(DailyReport.query.filter_by(child_id=child_id, report_date=day).count(), 1)
+
+    def test_report_batch_checkpoints(self):
+        from unittest import mock
+        import report_batch
+        import reports
+        from models import DailyReport
+
+        day = date(2024, 3, 4)
+        key = f"{day.isoformat()}:{day.isoformat()}:daily"
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        checkpoint_path = os.path.join(directory.name, 'checkpoint.json')
+        with app.app_context():
+            child_ids = [self._create_child(name) for name in ('first', 'second', 'third')]
+
+            # A previous run completed the first child's chunk
+            with open(checkpoint_path, 'w', encoding='utf-8') as f:
+                json.dump({'job': key, 'completed': [[child_ids[0], child_ids[0]]]}, f)
+
+            # Workers are forked, so they inherit the patched report function
+            generate = reports.generate_daily_report
+
+            def fail_second(child_id, report_day):
+                if child_id == child_ids[1]:
+                    raise RuntimeError('boom')
+                return generate(child_id, report_day)
+
+            with mock.patch('reports.generate_daily_report', side_effect=fail_second):
+                totals = report_batch.run(day, day, workers=1, chunk_size=1, weekly=False,
+                                          checkpoint_path=checkpoint_path)
+            self.assertEqual((totals['chunks'], totals['children'], totals['reports']), (2, 1, 1))
+            self.assertEqual(totals['errors'], {child_ids[1]: 'boom'})
+            with open(checkpoint_path, encoding='utf-8') as f:
+                checkpoint = json.load(f)
+            self.assertEqual(checkpoint['job'], key)
+            self.assertEqual(sorted(checkpoint['completed']), [[child_ids[0], child_ids[0]], [child_ids[2], child_ids[2]]])
+
+            # The resumed run only generates the failed chunk, and a complete job drops its checkpoint
+            totals = report_batch.run(day, day, workers=1, chunk_size=1, weekly=False, checkpoint_path=checkpoint_path)
+            self.assertEqual((totals['chunks'], totals['children'], totals['errors']), (1, 1, {}))
+            self.assertFalse(os.path.exists(checkpoint_path))
+            reported = {child_id for (child_id,) in db.session.query(DailyReport.child_id).filter_by(report_date=day)}
+            self.assertEqual(reported, set(child_ids[1:]))
+
+            # A checkpoint of another job is ignored
+            with open(checkpoint_path, 'w', encoding='utf-8') as f:
+                json.dump({'job': 'other', 'completed': [[child_ids[0], child_ids[-1]]]}, f)
+            totals = report_batch.run(day, day, workers=1, chunk_size=3, weekly=False, checkpoint_path=checkpoint_path)
+            self.assertEqual((totals['chunks'], totals['children']), (1, 3))
+
+    def test_rollups_follow_report_updates(self):
+        import event_pipeline
+        import report_rollups
+        import reports
+        from models import DailyReport
+
+        day = date.today() - timedelta(days=1)
+        keys = [('week', report_rollups.week_start(day)), ('month', day.replace(day=1))]
+        with app.app_context():
+            child_id = self._create_child()
+            report = DailyReport(child_id=child_id, report_date=day, stories_read=5, games_played=0,
+                                 time_spent=20, stars_earned=0, emotional_feedback=json.dumps({}))
+            db.session.add(report)
+            db.session.commit()
+
+            # Setting an attribute expired by the commit adds only the difference
+            report.time_spent = 25
+            db.session.commit()
+            self.assertEqual(self._rollups(child_id), {key: (5, 0, 25, 0, {}) for key in keys})
+
+            # The running counters update the committed (expired) report
+            event_pipeline.write_events([{
+                'user_type': 'child', 'user_id': child_id, 'event_type': 'emotional_feedback',
+                'event_name': 'emoji_reaction', 'event_data': {'emoji': 'happy'},
+                'occurred_at': datetime.combine(day, datetime.min.time()), 'session_id': None
+            }])
+            db.session.commit()
+            expected = (5, 0, 25, 0, {'happy': 1})
+            self.assertEqual(self._rollups(child_id), {key: expected for key in keys})
+
+            # Recomputing replaces the report's counters with the activity tables' totals
+            reports.generate_daily_report(child_id, day, recompute=True)
+            expected = (0, 0, 0, 0, {'happy': 1})
+            self.assertEqual(self._rollups(child_id), {key: expected for key in keys})
+
 if __name__ == '__main__':
     unittest.main()
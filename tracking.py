@@ -4,12 +4,21 @@ Tracking and analytics helper functions for Children's Castle application.
 
 from datetime import datetime, timedelta
 from flask_login import current_user
+from sqlalchemy import case, false, func, or_
+from sqlalchemy.dialects import postgresql, sqlite
 from app import db
-from models import Progress, Milestone, Event, ErrorLog, Reward, Session, Child
-
-def track_milestone_progress(child_id, milestone_id, check_only=False):
+from models import Progress, Milestone, Event, ErrorLog, Reward, Session, Child, CompletionEvent
+from write_behind import create_queue
+import session_activity
+import milestones
+import activity_calendar
+import unit_of_work
+import favorites
+import report_counters
+
+def track_milestone_progress(child_id, milestone_id, value=1, check_only=False):
     """
-    Track progress towards a milestone.
+    Add value to the progress of a milestone.
     Returns True if the milestone was just completed, False otherwise.
     If check_only is True, just check if the milestone is already completed.
     """
@@ -30,183 +39,48 @@ def track_milestone_progress(child_id, milestone_id, check_only=False):
         if check_only:
             return milestone.completed
 
-        # Update progress and check if completed
+        # Update progress and award the reward for completing it in the same unit of work
         completed = milestone.update_progress(value)
-        db.session.commit()
-
         if completed:
-            # Award a reward for achieving the milestone
-            reward = Reward(
-                child_id=child_id,
-                badge_id=f"milestone_{milestone_id}",
-                badge_name=f"Achievement: {milestone.milestone_name}",
-                badge_description=milestone.milestone_description or f"Completed {milestone.milestone_name}",
-                badge_image=f"badges/milestone_{milestone_id}.png",
-                source_type='milestone',
-                source_id=milestone_id,
-                achievement_level='gold',  # Milestones are higher value
-                points_value=5  # Higher points for milestones
-            )
-            db.session.add(reward)
-            db.session.commit()
+            milestones.award(child_id, milestone)
+        unit_of_work.commit()
 
         return completed
     except Exception as e:
-        db.session.rollback()
+        unit_of_work.rollback()
         print(f"Error tracking milestone progress: {e}")
         return False
 
 
 def check_and_create_milestones(child_id):
     """
-    Check for milestone conditions and create new ones if needed.
-    This should be called periodically, like on login or at the end of a session.
+    Create the milestones a child doesn't have yet (see milestones.MILESTONE_RULES).
+    Progress comes from the child's running counters, not from their history.
     """
-    # Get child data
-    child = Child.query.get(child_id)
+    child = db.session.query(Child.id).filter_by(id=child_id).first()
     if not child:
         return []
 
-    # Get existing milestones to avoid duplicates
-    existing_milestones = Milestone.query.filter_by(child_id=child_id).all()
-    existing_ids = [m.milestone_id for m in existing_milestones]
-
-    # Get progress data
-    all_progress = Progress.query.filter_by(child_id=child_id).all()
-    story_progress = [p for p in all_progress if p.content_type == 'story']
-    game_progress = [p for p in all_progress if p.content_type == 'game']
-
-    # Calculate some stats
-    stories_read = sum(1 for p in story_progress if p.completed)
-    games_played = sum(1 for p in game_progress if p.completed)
-    total_time = sum(p.time_spent for p in all_progress) / 60  # minutes
-
-    # Define potential milestones
-    milestone_definitions = [
-        # Story milestones
-        {
-            'id': 'read_first_story',
-            'type': 'completion', 
-            'name': 'First Story',
-            'description': 'Read your first story',
-            'condition': stories_read >= 1,
-            'target': 1
-        },
-        {
-            'id': 'read_5_stories',
-            'type': 'completion', 
-            'name': 'Story Explorer',
-            'description': 'Read 5 different stories',
-            'condition': stories_read >= 5,
-            'target': 5
-        },
-        {
-            'id': 'read_all_stories',
-            'type': 'completion', 
-            'name': 'Story Master',
-            'description': 'Read all available stories',
-            'condition': stories_read >= 12,  # Assuming 12 stories
-            'target': 12
-        },
-
-        # Game milestones
-        {
-            'id': 'play_first_game',
-            'type': 'completion', 
-            'name': 'First Game',
-            'description': 'Complete your first game',
-            'condition': games_played >= 1,
-            'target': 1
-        },
-        {
-            'id': 'play_5_games',
-            'type': 'completion', 
-            'name': 'Game Explorer',
-            'description': 'Play 5 different games',
-            'condition': games_played >= 5,
-            'target': 5
-        },
-
-        # Time spent milestones
-        {
-            'id': 'time_spent_60',
-            'type': 'engagement', 
-            'name': 'One Hour Wonder',
-            'description': 'Spend at least 60 minutes learning and having fun',
-            'condition': total_time >= 60,
-            'target': 60
-        },
-
-        # Streak milestones - these will be created with progress=0 initially
-        {
-            'id': 'daily_login_3',
-            'type': 'streak', 
-            'name': '3-Day Streak',
-            'description': 'Log in for 3 days in a row',
-            'condition': False,  # Will be tracked separately
-            'target': 3
-        },
-        {
-            'id': 'daily_login_7',
-            'type': 'streak', 
-            'name': 'Weekly Streak',
-            'description': 'Log in for 7 days in a row',
-            'condition': False,  # Will be tracked separately
-            'target': 7
-        }
-    ]
-
-    # Create any missing milestones
-    created_milestones = []
-    for milestone_def in milestone_definitions:
-        if milestone_def['id'] not in existing_ids:
-            # Create the milestone
-            milestone = Milestone(
-                child_id=child_id,
-                milestone_type=milestone_def['type'],
-                milestone_id=milestone_def['id'],
-                milestone_name=milestone_def['name'],
-                milestone_description=milestone_def['description'],
-                target_value=milestone_def['target']
-            )
-
-            # For completion-based milestones, set progress based on condition
-            if milestone_def['type'] == 'completion' and milestone_def['condition']:
-                milestone.progress = milestone_def['target']
-                milestone.completed = True
-                milestone.earned_at = datetime.utcnow()
-
-            db.session.add(milestone)
-            created_milestones.append(milestone)
-
-    if created_milestones:
-        db.session.commit()
-
+    created_milestones = milestones.sync_milestones(child_id)
+    unit_of_work.commit()
     return created_milestones
 
 def update_streak_milestones(child_id, current_streak):
     """Update streak-based milestones with the current streak count"""
-    child = Child.query.get(child_id)
+    child = db.session.query(Child.id).filter_by(id=child_id).first()
     if not child:
         print(f"Warning: Child with ID {child_id} not found, skipping streak milestone updates")
         return
 
-    # Check 3-day streak
-    track_milestone_progress(
-        child_id, 
-        'daily_login_3', 
-        value=current_streak if current_streak <= 3 else 3
-    )
-
-    # Check 7-day streak
-    track_milestone_progress(
-        child_id, 
-        'daily_login_7',
-        value=current_streak if current_streak <= 7 else 7
-    )
+    try:
+        milestones.record_login_streak(child_id, current_streak)
+        unit_of_work.commit()
+    except Exception as e:
+        unit_of_work.rollback()
+        print(f"Error updating streak milestones: {e}")
 
 def track_custom_event(event_type, event_name, event_data=None):
-    """Track a custom event for the current user"""
+    """Track a custom event for the current user; the event is written in the background"""
     if not current_user or not current_user.is_authenticated:
         return None
 
@@ -217,21 +91,14 @@ def track_custom_event(event_type, event_name, event_data=None):
     else:
         user_type = 'child'
 
-    # Find the current session
-    session = Session.query.filter_by(
-        user_type=user_type,
-        user_id=user_id,
-        end_time=None
-    ).order_by(Session.start_time.desc()).first()
-
-    # Create the event
+    # Queue the event with the current session (resolved once per request)
     return Event.track_event(
         user_type=user_type,
         user_id=user_id,
         event_type=event_type,
         event_name=event_name,
         event_data=event_data,
-        session_id=session.id if session else None
+        session_id=session_activity.get_active_session_id()
     )
 
 def log_error(error_type, error_message, error_context=None, stack_trace=None):
@@ -270,87 +137,204 @@ def log_error(error_type, error_message, error_context=None, stack_trace=None):
     )
 
 def get_favorites(child_id, content_type=None, limit=5):
-    """Get a child's favorite content based on engagement metrics"""
-    # Start with explicit favorites
-    query = Progress.query.filter_by(
+    """
+    Get a child's favorite content, best first (see favorites for the ranking).
+
+    Returns:
+        list: Favorite entry dicts
+    """
+    return favorites.get(child_id, content_type, limit)
+
+def upsert_progress(child_id, content_type, content_id, content_title=None, accesses=1,
+                    time_spent=0, completions=0, pages_read=None, score=None,
+                    difficulty_level=None, engagement_rating=None, is_favorite=None,
+                    session_duration=None, accessed_at=None):
+    """
+    Create or update a child's progress row for a piece of content in one statement.
+
+    This is the single write path for Progress. It runs INSERT ... ON CONFLICT
+    DO UPDATE against the (child_id, content_type, content_id) unique index,
+    and the database itself increments the counters, so concurrent requests
+    can neither race nor create duplicate rows. engagement_rating, is_favorite
+    and session_duration are only updated when given. The child's milestone
+    counters are updated in the same transaction. Nothing is committed.
+
+    Returns:
+        tuple: (progress_id, completion_count, first_completion)
+    """
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        insert = postgresql.insert
+    elif dialect == 'sqlite':
+        insert = sqlite.insert
+    else:
+        raise RuntimeError(f"Progress upserts are not supported on {dialect}")
+
+    now = accessed_at or datetime.utcnow()
+    today = datetime.now().date()
+    table = Progress.__table__
+
+    stmt = insert(table).values(
         child_id=child_id,
-        is_favorite=True
+        content_type=content_type,
+        content_id=content_id,
+        content_title=content_title or '',
+        completed=completions > 0,
+        completion_count=completions,
+        time_spent=time_spent,
+        pages_read=pages_read or 0,
+        score=score,
+        difficulty_level=difficulty_level,
+        is_favorite=bool(is_favorite),
+        engagement_rating=engagement_rating,
+        access_count=accesses,
+        last_session_duration=session_duration,
+        first_accessed=now,
+        last_accessed=now,
+        streak_count=1,
+        last_streak_date=today
     )
+    new = stmt.excluded
+
+    # All expressions see the row as it was before the update
+    updates = {
+        'access_count': func.coalesce(table.c.access_count, 0) + new.access_count,
+        'time_spent': func.coalesce(table.c.time_spent, 0) + new.time_spent,
+        'completion_count': func.coalesce(table.c.completion_count, 0) + new.completion_count,
+        'completed': or_(func.coalesce(table.c.completed, false()), new.completed),
+        'last_accessed': new.last_accessed,
+        'pages_read': case(
+            (new.pages_read > func.coalesce(table.c.pages_read, 0), new.pages_read),
+            else_=table.c.pages_read
+        ),
+        'score': case(
+            (new.score.is_(None), table.c.score),
+            (or_(table.c.score.is_(None), new.score > table.c.score), new.score),
+            else_=table.c.score
+        ),
+        'content_title': case(
+            (or_(table.c.content_title.is_(None), table.c.content_title == ''), new.content_title),
+            else_=table.c.content_title
+        ),
+        'difficulty_level': func.coalesce(table.c.difficulty_level, new.difficulty_level),
+        # Same rules as Progress.update_streak
+        'streak_count': case(
+            (table.c.last_streak_date == today, table.c.streak_count),
+            (table.c.last_streak_date == today - timedelta(days=1), func.coalesce(table.c.streak_count, 0) + 1),
+            else_=1
+        ),
+        'last_streak_date': new.last_streak_date
+    }
+    if engagement_rating is not None:
+        updates['engagement_rating'] = new.engagement_rating
+    if is_favorite is not None:
+        updates['is_favorite'] = new.is_favorite
+    if session_duration is not None:
+        updates['last_session_duration'] = new.last_session_duration
+
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['child_id', 'content_type', 'content_id'],
+        set_=updates
+    ).returning(table.c.id, table.c.completion_count)
+
+    row = db.session.execute(stmt).one()
+    progress_id, completion_count = row.id, row.completion_count
+
+    # The count only equals this call's completions if there were none before
+    first_completion = completions > 0 and completion_count == completions
+
+    # Running counters and the milestones that depend on them
+    milestones.record_progress(child_id, content_type, time_spent, first_completion)
+    record_child_activity(child_id)
+    favorites.record(child_id)
+    return progress_id, completion_count, first_completion
+
+
+def record_child_activity(child_id):
+    """
+    Mark today as active in the child's activity calendar and, the first time
+    each day, update the streak milestones. Nothing is committed.
+    """
+    if activity_calendar.mark_active(child_id):
+        milestones.record_login_streak(child_id, activity_calendar.current_streak(child_id))
 
-    if content_type:
-        query = query.filter_by(content_type=content_type)
 
-    favorites = query.all()
+def record_completions(child_id, completions, completed_at=None):
+    """
+    Append completion events in one bulk insert.
+
+    completions maps (content_type, content_id) to the number of completions.
+    Nothing is committed.
+    """
+    epoch = CompletionEvent.epoch(completed_at)
+    rows = [
+        {
+            'child_id': child_id,
+            'content_type': content_type,
+            'content_id': content_id,
+            'completed_at': epoch
+        }
+        for (content_type, content_id), count in completions.items()
+        for _ in range(count)
+    ]
+    if rows:
+        db.session.execute(CompletionEvent.__table__.insert(), rows)
+        report_counters.record_completions(child_id, completions, completed_at)
 
-    # If not enough explicit favorites, add most engaged with content
-    if len(favorites) < limit:
-        # Create a query for non-favorites ordered by engagement
-        query = Progress.query.filter_by(
-            child_id=child_id,
-            is_favorite=False
-        )
 
-        if content_type:
-            query = query.filter_by(content_type=content_type)
+def _epoch_range(start, end):
+    """Convert an optional naive UTC datetime range to epoch-second bounds"""
+    return (
+        CompletionEvent.epoch(start) if start else None,
+        CompletionEvent.epoch(end) if end else None
+    )
 
-        # Order by a combination of metrics to determine "implicit favorites"
-        # We prioritize completion count, time spent and access count
-        additional = query.order_by(
-            Progress.completion_count.desc(),
-            Progress.time_spent.desc(), 
-            Progress.access_count.desc()
-        ).limit(limit - len(favorites)).all()
 
-        favorites.extend(additional)
+def _completion_query(query, child_id, start=None, end=None, content_type=None):
+    """Restrict a completion event query to a child, time range and content type"""
+    start_epoch, end_epoch = _epoch_range(start, end)
+    query = query.filter(CompletionEvent.child_id == child_id)
+    if start_epoch is not None:
+        query = query.filter(CompletionEvent.completed_at >= start_epoch)
+    if end_epoch is not None:
+        query = query.filter(CompletionEvent.completed_at <= end_epoch)
+    if content_type:
+        query = query.filter(CompletionEvent.content_type == content_type)
+    return query
+
+
+def completed_content_query(child_id, start=None, end=None):
+    """Query of the distinct (content_type, content_id) a child completed in a time range"""
+    return _completion_query(
+        db.session.query(CompletionEvent.content_type, CompletionEvent.content_id).distinct(),
+        child_id, start, end
+    )
 
-    return favorites
 
 def track_story_progress(child_id, story_id, story_title, completed=False):
     try:
-        # First check if child exists using direct SQL to prevent ORM issues
-        from sqlalchemy import text
-        from db import db
-        result = db.session.execute(text("SELECT COUNT(*) FROM children WHERE id = :child_id"), 
-                                  {"child_id": child_id}).scalar()
-        
-        if not result:
+        child = db.session.query(Child.id).filter_by(id=child_id).first()
+        if not child:
             print(f"Warning: Child with ID {child_id} not found, skipping story progress tracking")
             return {"success": False, "message": f"Child with ID {child_id} not found"}, 404
 
-        # Check for existing progress
-        existing_progress = Progress.query.filter_by(
-            child_id=child_id,
-            content_type='story',
-            content_id=story_id
-        ).first()
-
-        if existing_progress:
-            existing_progress.access_count += 1
-            existing_progress.last_accessed = datetime.utcnow()
-            existing_progress.completed = completed or existing_progress.completed
-            db.session.commit()
-            return {"success": True, "message": "Progress updated"}
-
-        # Create new progress entry
-        new_progress = Progress(
-            child_id=child_id,
-            content_type='story',
-            content_id=story_id,
+        progress_id, _, _ = upsert_progress(
+            child_id, 'story', story_id,
             content_title=story_title,
-            completed=completed,
-            access_count=1,
-            time_spent=0  # Updated later
+            completions=1 if completed else 0
         )
-        db.session.add(new_progress)
-        db.session.commit()
-        return new_progress
+        if completed:
+            record_completions(child_id, {('story', story_id): 1})
+        unit_of_work.commit()
+        return {"success": True, "message": "Progress updated", "progress_id": progress_id}
 
     except Exception as e:
-        db.session.rollback()  # Rollback on error
+        unit_of_work.rollback()  # Rollback on error
         print(f"Error tracking story progress: {e}")
         return {"success": False, "message": f"Error tracking story progress: {e}"}, 500
 
 def track_progress(child_id, content_type, content_id, content_title, **kwargs):
+    """Record progress for any content; kwargs are passed on to upsert_progress"""
     try:
         # Check if child exists
         child = db.session.query(Child).filter_by(id=child_id).first()
@@ -358,19 +342,233 @@ def track_progress(child_id, content_type, content_id, content_title, **kwargs):
             print(f"Warning: Child with ID {child_id} not found, skipping progress tracking")
             return {"success": False, "message": f"Child with ID {child_id} not found"}
 
-        # Create new progress entry
-        progress = Progress(
+        progress_id, _, _ = upsert_progress(child_id, content_type, content_id, content_title, **kwargs)
+        if kwargs.get('completions'):
+            record_completions(child_id, {(content_type, content_id): kwargs['completions']})
+        unit_of_work.commit()
+        return {"success": True, "data": db.session.get(Progress, progress_id)}
+
+    except Exception as e:
+        unit_of_work.rollback()  # Rollback on error
+        print(f"Error tracking progress: {e}")
+        return {"success": False, "message": f"Error tracking progress: {e}"}
+
+# Progress delta fields that must be non-negative integers when given
+PROGRESS_DELTA_INT_FIELDS = ('time_spent', 'pages_read', 'score', 'engagement_rating')
+
+
+def clean_progress_delta(delta):
+    """
+    Validate a progress delta reported by the client.
+
+    content_id may be a string or an integer and is returned as a string, the
+    type of Progress.content_id, so 5 and "5" are the same content.
+
+    Returns:
+        dict: The cleaned delta
+
+    Raises:
+        ValueError: If the delta is malformed
+    """
+    if not isinstance(delta, dict):
+        raise ValueError('Every update must be an object')
+
+    content_type = delta.get('content_type')
+    content_id = delta.get('content_id')
+    if isinstance(content_id, int) and not isinstance(content_id, bool):
+        content_id = str(content_id)
+    if not isinstance(content_type, str) or not content_type or not isinstance(content_id, str) or not content_id:
+        raise ValueError('Every update needs a content_type and content_id')
+
+    for field in PROGRESS_DELTA_INT_FIELDS:
+        value = delta.get(field)
+        if value is not None and (not isinstance(value, int) or isinstance(value, bool) or value < 0):
+            raise ValueError(f'{field} must be a non-negative integer')
+    for field in ('content_title', 'difficulty_level'):
+        if delta.get(field) is not None and not isinstance(delta[field], str):
+            raise ValueError(f'{field} must be a string')
+
+    return dict(delta, content_type=content_type, content_id=content_id)
+
+
+def merge_progress_deltas(deltas):
+    """
+    Merge progress deltas reported by the client per (content_type, content_id).
+
+    Deltas must have been checked with clean_progress_delta. Time spent is
+    summed, pages read and score keep their maximum, and every delta counts
+    as one access (and one completion if it says so).
+    Returns a dict mapping (content_type, content_id) to the merged delta.
+    """
+    merged = {}
+    for delta in deltas:
+        key = (delta.get('content_type'), delta.get('content_id'))
+        entry = merged.get(key)
+        if entry is None:
+            entry = merged[key] = {
+                'content_type': key[0],
+                'content_id': key[1],
+                'content_title': '',
+                'time_spent': 0,
+                'last_session_duration': 0,
+                'pages_read': 0,
+                'score': None,
+                'difficulty_level': None,
+                'engagement_rating': None,
+                'accesses': 0,
+                'completions': 0
+            }
+
+        time_spent = delta.get('time_spent', 0) or 0
+        entry['accesses'] += 1
+        entry['time_spent'] += time_spent
+        entry['last_session_duration'] = time_spent
+        entry['pages_read'] = max(entry['pages_read'], delta.get('pages_read', 0) or 0)
+
+        score = delta.get('score')
+        if score is not None and (entry['score'] is None or score > entry['score']):
+            entry['score'] = score
+        if delta.get('completed'):
+            entry['completions'] += 1
+        if delta.get('content_title') and not entry['content_title']:
+            entry['content_title'] = delta['content_title']
+        if delta.get('difficulty_level') and not entry['difficulty_level']:
+            entry['difficulty_level'] = delta['difficulty_level']
+        if delta.get('engagement_rating') is not None:
+            entry['engagement_rating'] = delta['engagement_rating']
+        if 'is_favorite' in delta:
+            entry['is_favorite'] = bool(delta['is_favorite'])
+
+    return merged
+
+
+def _completion_reward(child_id, entry):
+    """Build the reward for the first completion of a story or game"""
+    content_type = entry['content_type']
+    content_id = entry['content_id']
+    content_title = entry['content_title'] or content_id.title()
+    score = entry['score']
+
+    achievement_level = 'bronze'  # Default level
+    if content_type == 'game' and score is not None:
+        if score > 90:
+            achievement_level = 'gold'
+        elif score > 70:
+            achievement_level = 'silver'
+
+    if content_type == 'story':
+        return Reward(
             child_id=child_id,
-            content_type=content_type,
-            content_id=content_id,
-            content_title=content_title,
-            **kwargs
+            badge_id=f"story_{content_id}",
+            badge_name=f"Story Master: {content_title}",
+            badge_description=f"Completed the {content_title} story",
+            badge_image=f"badges/story_{content_id}.png",
+            source_type='story',
+            source_id=content_id,
+            achievement_level=achievement_level,
+            points_value=2  # Default points for story completion
+        )
+
+    return Reward(
+        child_id=child_id,
+        badge_id=f"game_{content_id}",
+        badge_name=f"Game Master: {content_title}",
+        badge_description=f"Completed the {content_title} game",
+        badge_image=f"badges/game_{content_id}.png",
+        source_type='game',
+        source_id=content_id,
+        achievement_level=achievement_level,
+        points_value=3  # Default points for game completion
+    )
+
+
+def apply_progress_deltas(child_id, merged):
+    """
+    Apply merged progress deltas (see merge_progress_deltas) for a child.
+
+    Every merged item is one upsert; rows are then loaded back with one query.
+    Nothing is committed; the caller commits all changes in one transaction.
+    Returns a dict mapping (content_type, content_id) to the Progress row.
+    """
+    progress_ids = {}
+    completions = {}
+    for key, entry in merged.items():
+        progress_id, _, first_completion = upsert_progress(
+            child_id, entry['content_type'], entry['content_id'],
+            content_title=entry['content_title'],
+            accesses=entry['accesses'],
+            time_spent=entry['time_spent'],
+            completions=entry['completions'],
+            pages_read=entry['pages_read'],
+            score=entry['score'],
+            difficulty_level=entry['difficulty_level'],
+            engagement_rating=entry['engagement_rating'],
+            is_favorite=entry.get('is_favorite'),
+            session_duration=entry['last_session_duration']
         )
-        db.session.add(progress)
+        progress_ids[key] = progress_id
+        if entry['completions']:
+            completions[key] = entry['completions']
+
+        # Reward the first completion of this content
+        if first_completion:
+            report_counters.add_reward(_completion_reward(child_id, entry))
+
+    record_completions(child_id, completions)
+
+    # Load the upserted rows; populate_existing replaces stale copies the upserts bypassed
+    rows = {
+        p.id: p for p in Progress.query.filter(
+            Progress.id.in_(list(progress_ids.values()))
+        ).execution_options(populate_existing=True)
+    }
+    return {key: rows[progress_id] for key, progress_id in progress_ids.items()}
+
+
+def _flush_story_views(views):
+    """Apply a batch of queued story views to the progress table in one transaction"""
+    # Coalesce repeated opens of the same story by the same child
+    merged = {}
+    for child_id, story_id, story_title, viewed_at in views:
+        view = merged.setdefault((child_id, story_id), {
+            'title': story_title,
+            'count': 0,
+            'first_viewed': viewed_at,
+            'last_viewed': viewed_at
+        })
+        view['count'] += 1
+        view['first_viewed'] = min(view['first_viewed'], viewed_at)
+        view['last_viewed'] = max(view['last_viewed'], viewed_at)
+
+    child_ids = {child_id for child_id, _ in merged}
+
+    # Skip views for children that no longer exist
+    existing_children = {
+        child_id for (child_id,) in
+        db.session.query(Child.id).filter(Child.id.in_(child_ids))
+    }
+
+    try:
+        for (child_id, story_id), view in merged.items():
+            if child_id not in existing_children:
+                continue
+
+            upsert_progress(
+                child_id, 'story', story_id,
+                content_title=view['title'],
+                accesses=view['count'],
+                accessed_at=view['last_viewed']
+            )
+
         db.session.commit()
-        return {"success": True, "data": progress}
+    except Exception:
+        db.session.rollback()
+        raise
 
-    except Exception as e:
-        db.session.rollback()  # Rollback on error
-        print(f"Error tracking progress: {e}")
-        return {"success": False, "message": f"Error tracking progress: {e}"}
\ No newline at end of file
+
+story_view_queue = create_queue('story-views', _flush_story_views)
+
+
+def queue_story_view(child_id, story_id, story_title):
+    """Record that a child opened a story; the progress update is written in the background"""
+    story_view_queue.put((child_id, story_id, story_title, datetime.utcnow()))
@@ -0,0 +1,59 @@
+"""
+Request-scoped unit of work for Children's Castle application.
+
+Tracking, milestone and reward helpers used to commit on their own, so one
+request could commit several times and a failure between two commits left
+half-applied changes (e.g. a completed milestone without its reward). They now
+call commit() here, which inside a request only flushes and marks the request's
+unit of work; everything is committed once after the view returns, or rolled
+back as a whole if the view failed. Outside a request (CLI commands,
+background writers) commit() commits immediately.
+"""
+
+import logging
+
+from flask import g, has_request_context
+
+from db import db
+
+logger = logging.getLogger(__name__)
+
+
+def commit():
+    """Commit now, or at the end of the current request"""
+    if has_request_context():
+        # Flushing surfaces constraint errors to the caller, like a commit would
+        db.session.flush()
+        g.unit_of_work_pending = True
+    else:
+        db.session.commit()
+
+
+def rollback():
+    """Roll back the current unit of work"""
+    db.session.rollback()
+    if has_request_context():
+        g.unit_of_work_pending = False
+
+
+def end_request(response):
+    """Commit the request's unit of work if the view succeeded, otherwise roll it back"""
+    if not g.pop('unit_of_work_pending', False):
+        return response
+
+    if response.status_code >= 400:
+        db.session.rollback()
+        return response
+
+    try:
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error committing request changes: {e}")
+        raise
+    return response
+
+
+def init_app(app):
+    """Commit or roll back each request's unit of work after its view returns"""
+    app.after_request(end_request)
@@ -0,0 +1,151 @@
+"""
+Write-behind queue for Children's Castle application.
+Collects low-priority writes in memory and flushes them to the database in
+batches from a background thread, so request handlers don't wait on commits.
+"""
+
+import os
+import atexit
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Default number of seconds between two flushes
+DEFAULT_FLUSH_INTERVAL = float(os.environ.get('WRITE_BEHIND_FLUSH_INTERVAL', 2))
+
+# Default number of queued items that triggers an early flush
+DEFAULT_BATCH_SIZE = int(os.environ.get('WRITE_BEHIND_BATCH_SIZE', 500))
+
+# Default number of seconds put() waits for room in a full queue
+DEFAULT_PUT_TIMEOUT = float(os.environ.get('WRITE_BEHIND_PUT_TIMEOUT', 0.1))
+
+
+class WriteBehindQueue:
+    """
+    In-process queue that hands queued items to flush_fn in batches.
+
+    flush_fn receives lists of at most batch_size items and runs inside an
+    application context. The flusher thread is started lazily on the first
+    put() in each process, so queues created at import time work with forking
+    servers like gunicorn.
+
+    With max_items set, put() applies backpressure: when the queue is full it
+    wakes the flusher and waits up to put_timeout seconds for room. Items that
+    can't be queued in time, and batches whose flush_fn raised, are handed to
+    spill_fn if given (e.g. to persist them to a file), otherwise dropped.
+    """
+
+    def __init__(self, name, flush_fn, flush_interval=DEFAULT_FLUSH_INTERVAL, batch_size=DEFAULT_BATCH_SIZE,
+                 max_items=None, put_timeout=DEFAULT_PUT_TIMEOUT, spill_fn=None):
+        self.name = name
+        self.flush_fn = flush_fn
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_items = max_items
+        self.put_timeout = put_timeout
+        self.spill_fn = spill_fn
+        self._items = deque()
+        self._room = threading.Condition()
+        self._wakeup = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._app = None
+
+    def put(self, item, app=None):
+        """Queue an item for the next flush. Returns False if the queue was full."""
+        if app is None:
+            from flask import current_app
+            app = current_app._get_current_object()
+        self._app = app
+        self._ensure_thread()
+
+        if self.max_items and len(self._items) >= self.max_items:
+            self._wakeup.set()
+            with self._room:
+                self._room.wait_for(lambda: len(self._items) < self.max_items, timeout=self.put_timeout)
+            if len(self._items) >= self.max_items:
+                self._spill([item], "queue full")
+                return False
+
+        self._items.append(item)
+        if len(self._items) >= self.batch_size:
+            self._wakeup.set()
+        return True
+
+    def __len__(self):
+        return len(self._items)
+
+    def flush(self):
+        """Write all queued items now, batch_size at a time. Returns the number of items flushed."""
+        flushed = 0
+        with self._flush_lock:
+            while self._items and self._app is not None:
+                items = []
+                while self._items and len(items) < self.batch_size:
+                    items.append(self._items.popleft())
+                with self._room:
+                    self._room.notify_all()
+
+                try:
+                    with self._app.app_context():
+                        self.flush_fn(items)
+                    flushed += len(items)
+                except Exception as e:
+                    logger.error(f"Error flushing {len(items)} item(s) from the {self.name} queue: {str(e)}")
+                    self._spill(items, str(e))
+                    break
+        return flushed
+
+    def _spill(self, items, reason):
+        """Hand items that couldn't be queued or written to spill_fn"""
+        if self.spill_fn is None:
+            logger.warning(f"Dropping {len(items)} item(s) from the {self.name} queue: {reason}")
+            return
+        try:
+            self.spill_fn(items)
+        except Exception as e:
+            logger.error(f"Error spilling {len(items)} item(s) from the {self.name} queue: {str(e)}")
+
+    def _ensure_thread(self):
+        """Start the flusher thread for this process if it isn't running"""
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+
+        with self._start_lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(
+                target=self._run,
+                name=f"write-behind-{self.name}",
+                daemon=True
+            )
+            self._thread.start()
+
+    def _run(self):
+        """Flusher thread loop"""
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+
+_queues = []
+
+
+def create_queue(name, flush_fn, **kwargs):
+    """Create a write-behind queue that is flushed when the process exits"""
+    queue = WriteBehindQueue(name, flush_fn, **kwargs)
+    _queues.append(queue)
+    return queue
+
+
+@atexit.register
+def flush_all():
+    """Flush every write-behind queue"""
+    for queue in _queues:
+        queue.flush()